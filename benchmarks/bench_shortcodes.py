@@ -0,0 +1,58 @@
+"""
+    Micro-benchmark of the media shortcode codec.
+
+    Compares `utils.shortcodes_to_ids` / `utils.ids_to_shortcodes` with the
+    per-call alphabet dict they replaced in `bot_get`.
+
+    Usage:
+        python benchmarks/bench_shortcodes.py [-n 100000]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../'))
+from instabot import utils  # noqa: E402
+
+
+def old_shortcode_to_id(code):
+    alphabet = {char: index for index, char in enumerate(utils.SHORTCODE_ALPHABET)}
+    result = 0
+    for char in code:
+        result = result * 64 + alphabet[char]
+    return result
+
+
+def old_id_to_shortcode(media_id):
+    alphabet = {char: index for index, char in enumerate(utils.SHORTCODE_ALPHABET)}
+    result = ''
+    while media_id:
+        media_id, char = media_id // 64, media_id % 64
+        result += list(alphabet.keys())[list(alphabet.values()).index(char)]
+    return result[::-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('-n', type=int, default=100000, help="number of media ids")
+    args = parser.parse_args()
+
+    media_ids = [random.getrandbits(62) for _ in range(args.n)]
+    shortcodes = utils.ids_to_shortcodes(media_ids)
+    cases = [
+        ('decode, old', lambda: [old_shortcode_to_id(code) for code in shortcodes]),
+        ('decode, new', lambda: utils.shortcodes_to_ids(shortcodes)),
+        ('encode, old', lambda: [old_id_to_shortcode(media_id) for media_id in media_ids]),
+        ('encode, new', lambda: utils.ids_to_shortcodes(media_ids)),
+    ]
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        print("{:<12} {:>8.3f} s  {:>12,.0f} codes/s".format(name, seconds, args.n / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+    Benchmarks of instabot workflows against the local API stand-in.
+
+    Every workflow runs in its own process with a fresh `Bot`, logged in
+    against `StandInServer`, with `time.sleep` replaced by a counter (the
+    requested sleep is reported, not spent). Reported per workflow:
+    requests, requests/s, p50 / p99 request latency, peak RSS and sleep.
+
+    With `--record DIR` the traffic of every workflow is saved to
+    `DIR/<workflow>.jsonl.gz`; `--replay DIR` serves it back from there,
+    without the stand-in (or any network), for CPU profiling in CI.
+
+    Usage:
+        python -m benchmarks.harness [followers follow_users like_hashtag]
+            [--followers 1000000] [--users 200] [--medias 200]
+            [--latency 0.0] [--jitter 0.0] [--record DIR | --replay DIR]
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from .server import BOT_USER_ID, TARGET_USER_ID, StandInServer
+
+WORKFLOWS = ('followers', 'follow_users', 'like_hashtag')
+
+
+def make_bot(api_url, base_path):
+    import requests
+
+    from instabot import Bot
+    from instabot.api import config
+
+    config.API_URL = api_url
+    bot = Bot(base_path=base_path, verbosity=False, like_delay=0, follow_delay=0,
+              max_likes_per_day=10 ** 9, max_follows_per_day=10 ** 9,
+              max_followers_to_follow=10 ** 9)
+    bot.api.logger.disabled = True
+    bot.logger.disabled = True
+    bot.api.is_logged_in = True
+    bot.api.session = requests.Session()
+    bot.api.session.cookies.set('csrftoken', 'benchmark')
+    bot.api.session.cookies.set('ds_user_id', str(BOT_USER_ID))
+    bot.api.set_user('benchmark', 'benchmark')
+    return bot
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # KB on Linux
+
+
+def cassette(folder, name):
+    return os.path.join(folder, '{}.jsonl.gz'.format(name))
+
+
+def recorded_api_url(fname):
+    """API_URL of the stand-in the cassette was recorded against"""
+    from instabot.api.api_transport import read_cassette
+
+    for interaction in read_cassette(fname):
+        return interaction['url'].split('/api/v1/')[0] + '/api/v1/'
+
+
+def run_workflow(name, api_url, options, results):
+    base_path = tempfile.mkdtemp()
+    slept = [0.0]
+
+    def sleep(seconds):
+        slept[0] += seconds
+
+    time.sleep = sleep  # This process only
+    # Progress bars and console messages of the bot
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        if options.get('replay'):
+            api_url = recorded_api_url(cassette(options['replay'], name))
+        bot = make_bot(api_url, base_path)
+        if options.get('record'):
+            bot.api.start_recording(cassette(options['record'], name))
+        elif options.get('replay'):
+            bot.api.start_replay(cassette(options['replay'], name), options['latency'] or None)
+        latencies = []
+        bot.api.session.hooks['response'].append(
+            lambda response, *args, **kwargs: latencies.append(response.elapsed.total_seconds()))
+
+        started = time.time()
+        if name == 'followers':
+            done = len(bot.get_user_followers(TARGET_USER_ID, None))
+        elif name == 'follow_users':
+            user_ids = [str(10 ** 6 + pk) for pk in range(options['users'])]
+            bot.follow_users(user_ids)
+            done = bot.total['follows']
+        else:
+            bot.like_hashtag('benchmark', amount=options['medias'])
+            done = bot.total['likes']
+        elapsed = time.time() - started
+        bot.api.stop_transport()
+
+        results.put({
+            'workflow': name,
+            'items': done,
+            'requests': len(latencies),
+            'seconds': elapsed,
+            'rps': len(latencies) / elapsed if elapsed else 0.0,
+            'p50': percentile(latencies, 50) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'rss': peak_rss_mb(),
+            'slept': slept[0],
+        })
+    except Exception:
+        results.put({'workflow': name, 'error': traceback.format_exc()})
+    finally:
+        shutil.rmtree(base_path, ignore_errors=True)
+
+
+def run(workflows=WORKFLOWS, followers=10 ** 6, users=200, medias=200, latency=0.0, jitter=0.0,
+        record=None, replay=None):
+    """Runs `workflows` one by one, each in a new process. Returns the list of reports."""
+    server = StandInServer(followers=followers, hashtag=medias, latency=latency, jitter=jitter)
+    if replay is None:
+        server.start()
+    if record and not os.path.exists(record):
+        os.makedirs(record)
+    options = {'users': users, 'medias': medias, 'latency': latency, 'record': record, 'replay': replay}
+    reports = []
+    try:
+        for name in workflows:
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_workflow, args=(name, server.api_url, options, results))
+            process.start()
+            reports.append(results.get())
+            process.join()
+    finally:
+        if replay is None:
+            server.stop()
+        else:
+            server.server_close()
+    return reports
+
+
+def print_reports(reports):
+    header = '{:<14} {:>9} {:>9} {:>9} {:>10} {:>9} {:>9} {:>10} {:>10}'
+    row = '{workflow:<14} {items:>9} {requests:>9} {seconds:>9.2f} {rps:>10.1f} {p50:>9.2f} {p99:>9.2f} {rss:>10.1f} {slept:>10.1f}'
+    print(header.format('workflow', 'items', 'requests', 'seconds', 'req/s', 'p50 ms', 'p99 ms', 'RSS MB', 'sleep s'))
+    for report in reports:
+        if 'error' in report:
+            print('{:<14} failed:\n{}'.format(report['workflow'], report['error']))
+        else:
+            print(row.format(**report))
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('workflows', nargs='*', default=WORKFLOWS, help="any of: {}".format(', '.join(WORKFLOWS)))
+    parser.add_argument('--followers', type=int, default=10 ** 6, help="followers to get")
+    parser.add_argument('--users', type=int, default=200, help="users to vet and follow")
+    parser.add_argument('--medias', type=int, default=200, help="hashtag medias to like")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random seconds added to every response")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--record', metavar='DIR', help="save the traffic of every workflow to DIR")
+    group.add_argument('--replay', metavar='DIR', help="serve the traffic saved with --record from DIR")
+    args = parser.parse_args()
+    print_reports(run(args.workflows, args.followers, args.users, args.medias, args.latency, args.jitter,
+                      args.record, args.replay))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+    Local stand-in of the Instagram private API for benchmarks.
+
+    Serves synthetic users, feeds, followers and comments, generated from
+    their ids, so any volume costs no memory on the server side. Paging
+    follows the real API (`max_id` / `next_max_id`, `big_list`,
+    `more_available`, `has_more_comments`); every response can be delayed
+    by `latency` seconds plus up to `jitter` seconds. Write endpoints
+    (like, follow, ...) and unknown ones answer `{"status": "ok"}`.
+
+    Usage:
+        server = StandInServer(followers=10 ** 6, latency=0.005)
+        server.start()
+        ... config.API_URL = server.api_url ...
+        server.stop()
+"""
+from __future__ import unicode_literals
+
+import json
+import random
+import re
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+
+TARGET_USER_ID = 1
+BOT_USER_ID = 2
+
+
+def user(pk):
+    pk = int(pk)
+    return {
+        'pk': pk,
+        'username': 'user{}'.format(pk),
+        'full_name': 'User {}'.format(pk),
+        'is_private': pk % 7 == 0,
+        'is_verified': pk % 11 == 0,
+        'is_business': pk % 13 == 0,
+        'has_anonymous_profile_picture': False,
+        'follower_count': 200 + pk % 800,
+        'following_count': 150 + pk % 500,
+        'media_count': 5 + pk % 100,
+        'biography': '',
+        'profile_pic_url': 'https://scontent.example/{}.jpg'.format(pk),
+    }
+
+
+def media(pk):
+    pk = int(str(pk).split('_')[0])
+    owner = 1000 + pk % 100000
+    return {
+        'pk': pk,
+        'id': '{}_{}'.format(pk, owner),
+        'media_type': 1,
+        'taken_at': 1500000000 + pk,
+        'like_count': 25 + pk % 70,
+        'comment_count': 0,
+        'has_liked': False,
+        'caption': {'text': 'caption {}'.format(pk)},
+        'user': user(owner),
+        'image_versions2': {'candidates': [{'url': 'https://scontent.example/p{}.jpg'.format(pk)}]},
+    }
+
+
+def comment(pk):
+    return {
+        'pk': pk,
+        'text': 'comment {}'.format(pk),
+        'created_at_utc': 1500000000 + pk,
+        'user_id': 1000 + pk % 100000,
+        'user': user(1000 + pk % 100000),
+    }
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.respond()
+
+    def respond(self):
+        server = self.server
+        latency = server.latency + random.uniform(0, server.jitter)
+        if latency:
+            time.sleep(latency)
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        endpoint = url.path.split('/api/v1/', 1)[-1]
+        body = json.dumps(server.route(endpoint, query)).encode('utf8')
+        with server.lock:
+            server.requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+        @param followers    Followers of `TARGET_USER_ID` (Integer)
+        @param hashtag      Medias of every hashtag feed (Integer)
+        @param comments     Comments of every media (Integer)
+        @param page_size    Users per followers / followings page (Integer)
+        @param latency      Seconds added to every response (Float)
+        @param jitter       Up to this many random seconds more (Float)
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, followers=10 ** 6, hashtag=1000, comments=200, page_size=200,
+                 feed_page_size=50, latency=0.0, jitter=0.0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), StandInHandler)
+        self.followers = followers
+        self.hashtag = hashtag
+        self.comments = comments
+        self.page_size = page_size
+        self.feed_page_size = feed_page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.lock = threading.Lock()
+        self._thread = None
+        self.routes = [
+            (r'^users/(\d+)/info/$', self.user_info),
+            (r'^users/([^/]+)/usernameinfo/$', self.username_info),
+            (r'^friendships/(\d+)/followers/$', self.friends),
+            (r'^friendships/(\d+)/following/$', self.friends),
+            (r'^feed/tag/([^/]+)/$', self.hashtag_feed),
+            (r'^feed/user/(\d+)/$', self.user_feed),
+            (r'^media/([\d_]+)/info/$', self.media_info),
+            (r'^media/([\d_]+)/comments/$', self.media_comments),
+        ]
+        self.routes = [(re.compile(pattern), func) for pattern, func in self.routes]
+
+    @property
+    def api_url(self):
+        return 'http://{}:{}/api/v1/'.format(*self.server_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def route(self, endpoint, query):
+        for pattern, func in self.routes:
+            match = pattern.match(endpoint)
+            if match:
+                return func(match.group(1), query)
+        return {'status': 'ok'}
+
+    def user_info(self, user_id, query):
+        info = user(user_id)
+        if int(user_id) == TARGET_USER_ID:
+            info.update(follower_count=self.followers, following_count=self.followers)
+        return {'status': 'ok', 'user': info}
+
+    def username_info(self, username, query):
+        pk = int(username[4:]) if re.match(r'^user\d+$', username) else TARGET_USER_ID
+        return self.user_info(pk, query)
+
+    def _page(self, total, page_size, query):
+        offset = int(query.get('max_id') or 0)
+        end = min(offset + page_size, total)
+        more = end < total
+        return offset, end, more, str(end) if more else None
+
+    def friends(self, user_id, query):
+        total = self.followers if int(user_id) == TARGET_USER_ID else 0
+        offset, end, more, next_max_id = self._page(total, self.page_size, query)
+        return {
+            'status': 'ok',
+            'users': [user(10 ** 6 + pk) for pk in range(offset, end)],
+            'big_list': more,
+            'next_max_id': next_max_id,
+            'page_size': self.page_size,
+        }
+
+    def hashtag_feed(self, hashtag, query):
+        offset, end, more, next_max_id = self._page(self.hashtag, self.feed_page_size, query)
+        return {
+            'status': 'ok',
+            'items': [media(10 ** 9 + pk) for pk in range(offset, end)],
+            'more_available': more,
+            'next_max_id': next_max_id,
+        }
+
+    def user_feed(self, user_id, query):
+        return self.hashtag_feed(user_id, query)
+
+    def media_info(self, media_id, query):
+        return {'status': 'ok', 'items': [media(media_id)]}
+
+    def media_comments(self, media_id, query):
+        offset, end, more, next_max_id = self._page(self.comments, self.feed_page_size, query)
+        return {
+            'status': 'ok',
+            'comments': [comment(pk) for pk in range(offset, end)],
+            'comment_count': self.comments,
+            'has_more_comments': more,
+            'next_max_id': next_max_id,
+        }
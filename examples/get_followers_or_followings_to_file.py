@@ -24,6 +24,8 @@ parser.add_argument('-file', type=str, help="speficy filename", required=True)
 parser.add_argument('-amount', type=int, help="set the total amount of followers/followings to check (if you set filters, returned amount could be less than this)")
 parser.add_argument('-overwrite', action="store_true", help="add this options to overwrite file if exists")
 parser.add_argument('-usernames', action="store_true", help="add this options to download usernames instead of user_ids")
+parser.add_argument('-format', type=str, default='txt', choices=['txt', 'csv', 'bin'],
+                    help="file format: txt (one user_id or username per line), csv or bin")
 parser.add_argument('-filter_private', action="store_true", help="add this options to filter private acccounts")
 parser.add_argument('-filter_business', action="store_true", help="add this options to filter business accounts")
 parser.add_argument('-filter_verified', action="store_true", help="add this options to filter verified accounts")
@@ -49,6 +51,7 @@ bot.api.get_total_followers_or_followings(user_id=user_id,
                                           to_file=args.file,
                                           overwrite=args.overwrite,
                                           usernames=args.usernames,
+                                          to_file_format=args.format,
                                           filter_private=args.filter_private,
                                           filter_business=args.filter_business,
                                           filter_verified=args.filter_verified)
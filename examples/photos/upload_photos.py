@@ -49,6 +49,9 @@ if len(pics) == 0:
         exit()
     else:
         bot.logger.error("The photo `{}` has already been posted".format(pics[0]))
+media_path = os.path.dirname(os.path.realpath(__file__)) + "/media/"
+# Resize the photos in background processes, the result is cached in `media_cache/` of the bot's base_path
+prepared = bot.prepare_media_batch([media_path + pic for pic in pics])
 try:
     for pic in pics:
         bot.logger.info("Checking {}".format(pic))
@@ -63,7 +66,7 @@ try:
                 except NameError:
                     caption = input("No caption found for this media. Type the caption now: ")
         bot.logger.info("Uploading pic `{pic}` with caption: `{caption}`".format(pic=pic, caption=caption))
-        if not bot.upload_photo(os.path.dirname(os.path.realpath(__file__)) + "/media/" + pic, caption=caption):
+        if not bot.upload_photo(media_path + pic, caption=caption, options={'prepared': prepared[media_path + pic]}):
             bot.logger.error("Something went wrong...")
             break
         posted_pic_list.append(pic)
@@ -1,5 +1,34 @@
-from .api import API
-from .bot import Bot
-from . import utils
+"""
+    `API`, `Bot`, `utils` and `__version__` are loaded on first access, so
+    `import instabot` doesn't import `requests` and the bot modules.
+"""
+import importlib
+import sys
 
-assert all((API, Bot, utils))  # silence pyflakes
+__all__ = ['API', 'Bot', 'utils', '__version__']
+
+_LAZY = {'API': '.api', 'Bot': '.bot', 'utils': '.utils'}
+
+
+def _load(name):
+    if name == '__version__':
+        from .utils import package_version
+        value = package_version()
+    else:
+        module = importlib.import_module(_LAZY[name], __name__)
+        value = module if name == 'utils' else getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name in _LAZY or name == '__version__':
+            return _load(name)
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    def __dir__():
+        return sorted(set(globals()) | set(__all__))
+else:  # No module `__getattr__` (PEP 562)
+    for _name in __all__:
+        _load(_name)
@@ -1,15 +1,13 @@
 import hashlib
 import hmac
 import json
-import logging
 import os
 import random
 import sys
+import threading
 import time
 import uuid
 
-from requests_toolbelt import MultipartEncoder
-
 try:
     from json.decoder import JSONDecodeError
 except ImportError:
@@ -18,19 +16,33 @@ except ImportError:
 import requests
 import requests.utils
 import six.moves.urllib as urllib
-from tqdm import tqdm
 
 from . import config, devices
+from .. import utils
+from ..profiling import span, timed
+from ..utils import tqdm
+from .api_dump import NullDumpWriter, UserDumpWriter
+from .api_logging import LOG_FILENAME, acquire_logger
+from .api_download import DOWNLOAD_INDEX, DOWNLOAD_PER_HOST, DOWNLOAD_WORKERS, MediaDownloader
+from .api_metrics import RequestMetrics
+from .api_media import MediaCache, prepare_media, prepare_media_batch
+from .api_pages import PREFETCH_DEPTH, PagePrefetcher
 from .api_photo import configure_photo, download_photo, upload_photo
 from .api_video import configure_video, download_video, upload_video
 from .api_story import download_story, upload_story_photo, configure_story
+from .api_transport import Transport
 from .prepare import delete_credentials, get_credentials
 
 PY2 = sys.version_info[0] == 2
 
 
 class API(object):
-    def __init__(self, device=None, base_path=''):
+    def __init__(self, device=None, base_path='', log_filename=LOG_FILENAME):
+        """
+            @param device        Key of `devices.DEVICES` (String)
+            @param base_path     Folder of the files of this instance (String)
+            @param log_filename  Log file in `base_path`, None to log to the console only (String)
+        """
         # Setup device and user_agent
         device = device or devices.DEFAULT_DEVICE
         self.device_settings = devices.DEVICES[device]
@@ -38,30 +50,36 @@ class API(object):
         self.base_path = base_path
 
         self.is_logged_in = False
+        # Record / replay of the requests, see `start_recording` and `start_replay`
+        self.transport = None
+        self._session = None
+        # `last_response` and `last_json` belong to the thread that made the request
+        self._local = threading.local()
         self.last_response = None
         self.total_requests = 0
+        # Per-endpoint counts, bytes and latencies, see `api_metrics`
+        self.metrics = RequestMetrics()
 
-        # Setup logging
-        self.logger = logging.getLogger('[instabot_{}]'.format(id(self)))
+        # Setup logging: shared handlers, the log file is opened on the first record
+        log_file = os.path.join(base_path, log_filename) if log_filename else None
+        self.logger, self._release_logger = acquire_logger(self, log_file)
 
-        if not os.path.exists("./config/"):
-            os.makedirs("./config/")  # create base_path if not exists
+        self.last_json = None
 
-        log_filename = os.path.join(base_path, 'instabot.log')
-        fh = logging.FileHandler(filename=log_filename)
-        fh.setLevel(logging.INFO)
-        fh.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        # Prepared media files, see `prepare_media`
+        self.use_media_cache = True
+        self._media_cache = None
 
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        ch.setFormatter(logging.Formatter(
-            '%(asctime)s - %(levelname)s - %(message)s'))
+        # CDN downloads, see `downloader`
+        self.download_workers = DOWNLOAD_WORKERS
+        self.download_per_host = DOWNLOAD_PER_HOST
+        self._downloader = None
 
-        self.logger.addHandler(fh)
-        self.logger.addHandler(ch)
-        self.logger.setLevel(logging.DEBUG)
+        # Feed pages fetched ahead, see `iter_pages`
+        self.prefetch_depth = PREFETCH_DEPTH
 
-        self.last_json = None
+        # user id -> is_business, see `get_business_users`
+        self.business_users = {}
 
     def set_user(self, username, password):
         self.username = username
@@ -91,8 +109,8 @@ class API(object):
                 self.logger.info("Logged-in successfully as '{}' using the cookie!".format(self.username))
                 return True
             except Exception:
-                print("The cookie is not found, but don't worry `instabot`"
-                      " will create it for you using your login details.")
+                utils.echo("The cookie is not found, but don't worry `instabot`"
+                           " will create it for you using your login details.")
 
         if not cookie_is_loaded and (not self.is_logged_in or force):
             self.session = requests.Session()
@@ -232,6 +250,15 @@ class API(object):
         self.is_logged_in = not self.send_request('accounts/logout/', data, with_signature=False)
         return not self.is_logged_in
 
+    def close(self):
+        """Release the log file, the download pool and the record / replay transport."""
+        self._release_logger()
+        if self._downloader is not None:
+            self._downloader.close()
+            self._downloader = None
+        if self.transport is not None:
+            self.stop_transport()
+
     def set_proxy(self):
         if self.proxy:
             parsed = urllib.parse.urlparse(self.proxy)
@@ -239,6 +266,7 @@ class API(object):
             self.session.proxies['http'] = scheme + self.proxy
             self.session.proxies['https'] = scheme + self.proxy
 
+    @timed()
     def send_request(self, endpoint, post=None, login=False, with_signature=True, headers=None):
         if (not self.is_logged_in and not login):
             msg = "Not logged in!"
@@ -255,11 +283,11 @@ class API(object):
                 if with_signature:
                     # Only `send_direct_item` doesn't need a signature
                     post = self.generate_signature(post)
-                response = self.session.post(
-                    config.API_URL + endpoint, data=post)
+                response = self.metrics.request(
+                    self.session, 'POST', config.API_URL + endpoint, data=post)
             else:  # GET
-                response = self.session.get(
-                    config.API_URL + endpoint)
+                response = self.metrics.request(
+                    self.session, 'GET', config.API_URL + endpoint)
         except Exception as e:
             self.logger.warning(str(e))
             return False
@@ -287,7 +315,8 @@ class API(object):
                 self.logger.warning(
                     "That means 'too many requests'. I'll go to sleep "
                     "for {} minutes.".format(sleep_minutes))
-                time.sleep(sleep_minutes * 60)
+                with span('sleep_429', 'sleep'):
+                    time.sleep(sleep_minutes * 60)
             elif response.status_code == 400:
                 response_data = json.loads(response.text)
 
@@ -297,15 +326,16 @@ class API(object):
                     two_factor_code = input("Enter 2FA verification code: ")
                     two_factor_id = response_data['two_factor_info']['two_factor_identifier']
 
-                    login = self.session.post(config.API_URL + 'accounts/two_factor_login/',
-                                              data={'username': self.username,
-                                                    'verification_code': two_factor_code,
-                                                    'two_factor_identifier': two_factor_id,
-                                                    'password': self.password,
-                                                    'device_id': self.device_id,
-                                                    'ig_sig_key_version': 4
-                                                    },
-                                              allow_redirects=True)
+                    login = self.metrics.request(self.session, 'POST',
+                                                 config.API_URL + 'accounts/two_factor_login/',
+                                                 data={'username': self.username,
+                                                       'verification_code': two_factor_code,
+                                                       'two_factor_identifier': two_factor_id,
+                                                       'password': self.password,
+                                                       'device_id': self.device_id,
+                                                       'ig_sig_key_version': 4
+                                                       },
+                                                 allow_redirects=True)
 
                     if login.status_code == 200:
                         resp_json = json.loads(login.text)
@@ -399,9 +429,11 @@ class API(object):
         @param upload_id     Unique upload_id (String). When None, then generate automatically
         @param from_video    A flag that signals whether the photo is loaded from the video or by itself (Boolean, DEPRECATED: not used)
         @param force_resize  Force photo resize (Boolean)
-        @param options       Object with difference options, e.g. configure_timeout, rename (Dict)
+        @param options       Object with difference options, e.g. configure_timeout, rename, prepared (Dict)
                              Designed to reduce the number of function arguments!
                              This is the simplest request object.
+                             `prepared` is the path `prepare_media_batch` returned for `photo`:
+                             it is uploaded instead, and `photo` is renamed when posted.
 
         @return Boolean
         """
@@ -456,6 +488,105 @@ class API(object):
         """
         return configure_video(self, upload_id, video, thumbnail, width, height, duration, caption, options)
 
+    @property
+    def last_json(self):
+        return getattr(self._local, 'last_json', None)
+
+    @last_json.setter
+    def last_json(self, value):
+        self._local.last_json = value
+
+    @property
+    def last_response(self):
+        return getattr(self._local, 'last_response', None)
+
+    @last_response.setter
+    def last_response(self, value):
+        self._local.last_response = value
+
+    @property
+    def media_cache(self):
+        if self._media_cache is None:
+            self._media_cache = MediaCache(os.path.join(self.base_path, 'media_cache'))
+        return self._media_cache
+
+    @property
+    def session(self):
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+        if self.transport is not None:
+            self.transport.mount(session)
+
+    def start_recording(self, fname):
+        """Record every request and response to the cassette `fname`, see `api_transport`"""
+        self._set_transport(Transport.recording(fname))
+
+    def start_replay(self, fname, latency=None):
+        """Answer the requests from the cassette `fname`, without network
+
+        @param fname    Cassette written by `start_recording` (String)
+        @param latency  None, seconds slept before every response (Float), or 'recorded'
+        """
+        self._set_transport(Transport.replay(fname, latency))
+
+    def stop_transport(self):
+        """Stop recording or replaying. New sessions are not affected any more."""
+        self._set_transport(None)
+
+    def _set_transport(self, transport):
+        sessions = [self.session]
+        if self._downloader is not None:
+            sessions.append(self._downloader.session)
+        if self.transport is not None:
+            for session in sessions:
+                self.transport.unmount(session)
+            self.transport.close()
+        self.transport = transport
+        if transport is not None:
+            for session in sessions:
+                transport.mount(session)
+
+    @property
+    def downloader(self):
+        """MediaDownloader for CDN urls, with the proxy and the User-Agent of this API"""
+        if self._downloader is None:
+            session = getattr(self, 'session', None)
+            self._downloader = MediaDownloader(
+                self.download_workers, self.download_per_host,
+                proxies=dict(session.proxies) if session else None,
+                headers={'User-Agent': self.user_agent},
+                index=os.path.join(self.base_path, DOWNLOAD_INDEX),
+                metrics=self.metrics)
+            if self.transport is not None:
+                self.transport.mount(self._downloader.session)
+        return self._downloader
+
+    def prepare_media(self, media, kind='feed', **knobs):
+        """Prepare one media file, reusing `media_cache` unless `use_media_cache` is False
+
+        @param media  Path to the source file (String)
+        @param kind   'feed', 'story' or 'video' (String)
+        @param knobs  `resize_video` parameters, e.g. preset, threads
+
+        @return       Prepared path, or (video, thumbnail, width, height, duration) for videos (or False)
+        """
+        cache = self.media_cache if self.use_media_cache else None
+        return prepare_media(media, kind, cache, **knobs)
+
+    def prepare_media_batch(self, paths, kind='feed', workers=None):
+        """Prepare media files for `upload_photo`, `upload_story_photo` or `upload_video` in a process pool
+
+        @param paths    Paths to the source files (List)
+        @param kind     'feed', 'story' or 'video' (String)
+        @param workers  Number of processes (Integer). When None, then the number of CPUs
+
+        @return         OrderedDict: source path -> prepared path, or (video, thumbnail, width, height, duration) for videos
+        """
+        return prepare_media_batch(paths, kind, workers, self.media_cache)
+
     def edit_media(self, media_id, captionText=''):
         data = self.json_data({'caption_text': captionText})
         url = 'media/{media_id}/edit_media/'.format(media_id=media_id)
@@ -734,6 +865,7 @@ class API(object):
                 'application/octet-stream',
                 {'Content-Transfer-Encoding': 'binary'})
 
+            from requests_toolbelt import MultipartEncoder  # imported on the first upload
             m = MultipartEncoder(data, boundary=self.uuid)
             data = m.to_string()
             headers.update({
@@ -783,9 +915,19 @@ class API(object):
                                           filter_verified=False,
                                           usernames=False,
                                           to_file=None,
-                                          overwrite=False):
-        from io import StringIO
-
+                                          overwrite=False,
+                                          to_file_format='txt'):
+        """Get followers or followings of `user_id`, optionally dumped to a file
+
+        @param amount          Number of users to get (Integer). When None, then all of them
+        @param which           'followers' or 'followings' (String)
+        @param usernames       Write usernames instead of user ids to a 'txt' file (Boolean)
+        @param to_file         Path of the dump (String)
+        @param overwrite       Replace an existing `to_file` (Boolean)
+        @param to_file_format  'txt', 'csv' or 'bin', see `api_dump` (String)
+
+        @return                List of user dicts (or False)
+        """
         if which == 'followers':
             key = 'follower_count'
             get = self.get_user_followers
@@ -802,53 +944,51 @@ class API(object):
             total = amount or username_info["user"][key]
 
             if total > 200000:
-                print("Consider temporarily saving the result of this big "
-                      "operation. This will take a while.\n")
+                utils.echo("Consider temporarily saving the result of this big "
+                           "operation. This will take a while.\n")
         else:
             return False
         if filter_business:
-            print("--> You are going to filter business accounts. This will take time! <--")
+            utils.echo("--> You are going to filter business accounts. This will take time! <--")
+        writer = NullDumpWriter()
         if to_file is not None:
             if os.path.isfile(to_file):
                 if not overwrite:
                     print("File `{}` already exists. Not overwriting.".format(to_file))
                     return False
                 else:
-                    print("Overwriting file `{}`".format(to_file))
-            with open(to_file, 'w'):
-                pass
+                    utils.echo("Overwriting file `{}`".format(to_file))
+            writer = UserDumpWriter(to_file, to_file_format, usernames)
         desc = "Getting {} of {}".format(which, user_id)
-        with tqdm(total=total, desc=desc, leave=True) as pbar:
+        with tqdm(total=total, desc=desc, leave=True) as pbar, writer:
             while True:
                 get(user_id, next_max_id)
                 last_json = self.last_json
                 try:
-                    with open(to_file, 'a') if to_file is not None else StringIO() as f:
-                        for item in last_json["users"]:
-                            if filter_private and item['is_private']:
-                                continue
-                            if filter_business:
-                                time.sleep(2 * random.random())
-                                self.get_username_info(item['pk'])
-                                item_info = self.last_json
-                                if item_info['user']['is_business']:
-                                    continue
-                            if filter_verified and item['is_verified']:
-                                continue
-                            if to_file is not None:
-                                if usernames:
-                                    f.write("{}\n".format(item['username']))
-                                else:
-                                    f.write("{}\n".format(item['pk']))
-                            result.append(item)
-                            pbar.update(1)
-                            sleep_track += 1
-                            if sleep_track >= 20000:
-                                sleep_time = random.uniform(120, 180)
-                                msg = "\nWaiting {:.2f} min. due to too many requests."
-                                print(msg.format(sleep_time / 60))
-                                time.sleep(sleep_time)
-                                sleep_track = 0
+                    # Page-local filters first, they cost nothing
+                    users = [
+                        item for item in last_json["users"]
+                        if not (filter_private and item['is_private'] or filter_verified and item['is_verified'])
+                    ]
+                    accepted = []
+                    while users and len(result) + len(accepted) < total:
+                        # Look up no more users than still needed
+                        need = total - len(result) - len(accepted)
+                        batch, users = users[:need], users[need:]
+                        if filter_business:
+                            business = self.get_business_users([item['pk'] for item in batch])
+                            batch = [item for item in batch if not business.get(item['pk'])]
+                        accepted += batch
+                    writer.write_page(accepted)
+                    result += accepted
+                    pbar.update(len(accepted))
+                    sleep_track += len(accepted)
+                    if sleep_track >= 20000:
+                        sleep_time = random.uniform(120, 180)
+                        msg = "\nWaiting {:.2f} min. due to too many requests."
+                        utils.echo(msg.format(sleep_time / 60))
+                        time.sleep(sleep_time)
+                        sleep_track = 0
                     if not last_json["users"] or len(result) >= total:
                         return result[:total]
                 except Exception as e:
@@ -860,6 +1000,21 @@ class API(object):
 
                 next_max_id = last_json.get("next_max_id", "")
 
+    def get_business_users(self, user_ids):
+        """Which users are business accounts, one `get_username_info` per user not seen before
+
+        @param user_ids  List of user ids
+
+        @return          Dict: user id -> is_business (Boolean), users that can't be looked up are left out
+        """
+        for user_id in user_ids:
+            if user_id in self.business_users:
+                continue
+            time.sleep(2 * random.random())
+            if self.get_username_info(user_id) and 'user' in self.last_json:
+                self.business_users[user_id] = bool(self.last_json['user'].get('is_business'))
+        return {user_id: self.business_users[user_id] for user_id in user_ids if user_id in self.business_users}
+
     def get_total_followers(self, user_id, amount=None):
         return self.get_total_followers_or_followings(
             user_id, amount, 'followers')
@@ -871,41 +1026,56 @@ class API(object):
     def get_total_user_feed(self, user_id, min_timestamp=None):
         return self.get_last_user_feed(user_id, amount=float('inf'), min_timestamp=min_timestamp)
 
+    def iter_pages(self, get, next_cursor, *args, **kwargs):
+        """Iterate the pages of a `max_id` feed, fetching `prefetch_depth` pages ahead
+
+        @param get          API method taking `max_id` as a keyword, e.g. `get_user_feed`
+        @param next_cursor  Function: page json -> next max_id, or None on the last page
+        @param args         Arguments of `get` before `max_id`
+
+        @return             PagePrefetcher, stop it (or leave its `with` block) when enough items are taken
+        """
+        def fetch(max_id):
+            return get(*args, max_id=max_id, **kwargs) is True, self.last_json
+
+        def on_page(page):
+            # As if the consumer had made the request itself
+            self.last_json = page
+        return PagePrefetcher(fetch, next_cursor, self.prefetch_depth, on_page)
+
     def get_last_user_feed(self, user_id, amount, min_timestamp=None):
         user_feed = []
-        next_max_id = ''
-        while True:
-            if len(user_feed) >= float(amount):
-                # one request returns max 13 items
-                return user_feed[:amount]
-            self.get_user_feed(user_id, next_max_id, min_timestamp)
-            last_json = self.last_json
-            if 'items' not in last_json:
-                return user_feed
-            user_feed += last_json["items"]
-            if not last_json.get("more_available"):
-                return user_feed
-            next_max_id = last_json.get("next_max_id", "")
+
+        def next_cursor(page):
+            return page.get("next_max_id", "") if page.get("more_available") else None
+
+        with self.iter_pages(self.get_user_feed, next_cursor, user_id, min_timestamp=min_timestamp) as pages:
+            for page in pages:
+                if 'items' not in page:
+                    break
+                user_feed += page["items"]
+                if len(user_feed) >= float(amount):
+                    # one request returns max 13 items
+                    return user_feed[:amount]
+        return user_feed
 
     def get_total_hashtag_feed(self, hashtag_str, amount=100):
         hashtag_feed = []
-        next_max_id = ''
 
-        with tqdm(total=amount, desc="Getting hashtag media.", leave=False) as pbar:
-            while True:
-                self.get_hashtag_feed(hashtag_str, next_max_id)
-                last_json = self.last_json
-                if 'items' not in last_json:
-                    return hashtag_feed[:amount]
-                items = last_json['items']
-                try:
-                    pbar.update(len(items))
-                    hashtag_feed += items
-                    if not items or len(hashtag_feed) >= amount:
-                        return hashtag_feed[:amount]
-                except Exception:
-                    return hashtag_feed[:amount]
-                next_max_id = last_json.get("next_max_id", "")
+        def next_cursor(page):
+            return page.get("next_max_id", "") if page.get('items') else None
+
+        with tqdm(total=amount, desc="Getting hashtag media.", leave=False) as pbar, \
+                self.iter_pages(self.get_hashtag_feed, next_cursor, hashtag_str) as pages:
+            for page in pages:
+                if 'items' not in page:
+                    break
+                items = page['items']
+                pbar.update(len(items))
+                hashtag_feed += items
+                if not items or amount is None or len(hashtag_feed) >= amount:
+                    break
+        return hashtag_feed[:amount]
 
     def get_total_self_user_feed(self, min_timestamp=None):
         return self.get_total_user_feed(self.user_id, min_timestamp)
@@ -1038,7 +1208,8 @@ class API(object):
             '_uid': self.user_id
         })
         data = self.generate_signature(data)
-        return self.session.post('https://i.instagram.com/api/v2/' + 'media/seen/', data=data).ok
+        return self.metrics.request(self.session, 'POST', 'https://i.instagram.com/api/v2/' + 'media/seen/',
+                                    data=data).ok
 
     def get_user_stories(self, user_id):
         url = 'feed/user/{}/story/'.format(user_id)
@@ -0,0 +1,374 @@
+"""
+    Concurrent downloads of media files from the Instagram CDN.
+
+    CDN urls are signed and are not rate limited like the private API, so
+    they are fetched in a bounded thread pool instead of one by one behind
+    the API delays. Every host gets its own connection limit.
+
+    Every file is written to `<path>.part` and renamed only after its size
+    (and the md5 ETag, when the CDN sends one) is verified, so a crash never
+    leaves a truncated photo behind, and an interrupted video is resumed with
+    a Range request. Files are asked for without a Content-Encoding, so the
+    sizes and ranges are those of the file on disk; an encoded body is still
+    decoded, but not resumed. Completed files are recorded in a `DownloadIndex`.
+"""
+from __future__ import unicode_literals
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import requests
+import six.moves.urllib as urllib
+from requests.packages.urllib3.exceptions import HTTPError as Urllib3Error
+
+from .. import utils
+from ..utils import tqdm
+from .api_metrics import RequestMetrics, TimedHTTPAdapter
+
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_PER_HOST = 4
+CHUNK_SIZE = 64 * 1024
+DOWNLOAD_INDEX = 'downloads.json'
+
+MD5_ETAG = re.compile(r'^[0-9a-f]{32}$')
+
+
+def media_pk(media_id):
+    """'<pk>_<user_id>' media ids and pks -> pk (String)"""
+    return str(media_id).split('_')[0]
+
+
+def media_key(kind, pk, index=0):
+    """Index key of one file of a media: its kind ('photo', 'video', 'story'), pk and carousel index (0 for the others)"""
+    return '{}/{}/{}'.format(kind, pk, index)
+
+
+def file_md5(fname):
+    checksum = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class DownloadIndex(object):
+    """
+        Completed downloads: absolute path -> {'size', 'etag'}, plus the ETag
+        of every unfinished `.part` file to resume it only when the remote
+        file is the same. Kept in one json file, so a new run skips already
+        downloaded files without reading them; an entry whose file was
+        deleted is dropped when looked up. Saved every `save_every` changes
+        and on `save()`.
+
+        Files of a media are also keyed by `media_key` (kind, pk and carousel
+        index) -> {'path', 'md5'}, and `medias` maps the kind ('photo',
+        'video') and the pk of a completely downloaded media to its paths.
+        A media is not fetched again under a new username or `filename`, and
+        a re-run over a feed skips a known media before asking the API for
+        its info.
+    """
+
+    def __init__(self, fname=None, save_every=50):
+        self.fname = fname
+        self.save_every = save_every
+        self.done = {}
+        self.parts = {}
+        self.files = {}
+        self.medias = {}
+        self._changes = 0
+        self._lock = threading.RLock()
+        if fname and os.path.exists(fname):
+            try:
+                with open(fname, 'r') as f:
+                    data = json.load(f)
+                self.done, self.parts = data.get('done', {}), data.get('parts', {})
+                self.files, self.medias = data.get('files', {}), data.get('medias', {})
+            except (IOError, OSError, ValueError):
+                pass
+
+    def __contains__(self, fname):
+        fname = os.path.abspath(fname)
+        if fname not in self.done:
+            return False
+        if not os.path.exists(fname):
+            self.remove(fname)
+            return False
+        return True
+
+    def add(self, fname, size, etag=None, md5=None, key=None):
+        with self._lock:
+            fname = os.path.abspath(fname)
+            self.done[fname] = {'size': size, 'etag': etag}
+            self.parts.pop(fname, None)
+            if key is not None:
+                self.files[key] = {'path': fname, 'md5': md5}
+            self._changed()
+
+    def find(self, key):
+        """Path of the file downloaded for `media_key` (or None)"""
+        entry = self.files.get(key)
+        if entry is None:
+            return None
+        if not os.path.exists(entry['path']):
+            with self._lock:
+                self.files.pop(key, None)
+                self._changed()
+            return None
+        return entry['path']
+
+    def add_media(self, pk, paths, kind='photo'):
+        with self._lock:
+            self.medias['{}/{}'.format(kind, media_pk(pk))] = list(paths)
+            self._changed()
+
+    def media_paths(self, pk, kind='photo'):
+        """Paths of a completely downloaded media (or None)"""
+        key = '{}/{}'.format(kind, media_pk(pk))
+        paths = self.medias.get(key)
+        if paths is None:
+            return None
+        if not all(os.path.exists(path) for path in paths):
+            with self._lock:
+                self.medias.pop(key, None)
+                self._changed()
+            return None
+        return paths
+
+    def add_part(self, fname, etag):
+        with self._lock:
+            self.parts[os.path.abspath(fname)] = etag
+            self._changed()
+
+    def part_etag(self, fname):
+        return self.parts.get(os.path.abspath(fname))
+
+    def remove(self, fname):
+        with self._lock:
+            fname = os.path.abspath(fname)
+            self.done.pop(fname, None)
+            self.parts.pop(fname, None)
+            self._changed()
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= self.save_every:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            if not self.fname or not self._changes:
+                return
+            data = {'done': self.done, 'parts': self.parts, 'files': self.files, 'medias': self.medias}
+            utils.atomic_write(self.fname, json.dumps(data))
+            self._changes = 0
+
+
+class MediaDownloader(object):
+    """
+        Downloads (url, path[, media_key]) jobs in a pool of `workers` threads with at most
+        `per_host` simultaneous connections to one host. Files in the `index`
+        (or already on disk) are not downloaded again. The pool and the
+        session are created on the first download. Every fetch is recorded
+        in `metrics`, under the CDN host name.
+    """
+
+    def __init__(self, workers=DOWNLOAD_WORKERS, per_host=DOWNLOAD_PER_HOST,
+                 proxies=None, headers=None, timeout=60, index=None, metrics=None):
+        self.index = index if isinstance(index, DownloadIndex) else DownloadIndex(index)
+        self.workers = workers
+        self.per_host = per_host
+        self.proxies = proxies or {}
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else RequestMetrics()
+        self._session = None
+        self._pool = None
+        self._hosts = {}
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            session = requests.Session()
+            adapter = TimedHTTPAdapter(pool_connections=self.workers, pool_maxsize=self.per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.proxies.update(self.proxies)
+            session.headers.update(self.headers)
+            session.headers['Accept-Encoding'] = 'identity'
+            self._session = session
+        return self._session
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool  # not needed by `import instabot`
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    def _limit(self, limits, key, size):
+        with self._lock:
+            if key not in limits:
+                limits[key] = threading.BoundedSemaphore(size)
+            return limits[key]
+
+    def host_limit(self, url):
+        return self._limit(self._hosts, urllib.parse.urlparse(url).netloc, self.per_host)
+
+    @contextlib.contextmanager
+    def path_lock(self, fname):
+        """Only one worker writes `fname` at a time; the lock is dropped by the last one."""
+        with self._lock:
+            entry = self._paths.setdefault(fname, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._paths[fname]
+
+    def fetch(self, url, fname, key=None):
+        """Downloads `url` to `fname`, resuming `fname.part`. Returns the absolute path or False.
+
+        With a `media_key`, a file downloaded for the same key before is returned instead.
+        """
+        known = self.index.find(key) if key is not None else None
+        if known:
+            return known
+        if fname in self.index:
+            return os.path.abspath(fname)
+        folder = os.path.dirname(fname)
+        if folder and not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:  # created by another worker
+                pass
+        with self.path_lock(os.path.abspath(fname)):
+            if fname in self.index:
+                return os.path.abspath(fname)
+            if os.path.exists(fname):  # downloaded before the index existed
+                self.index.add(fname, os.path.getsize(fname), md5=file_md5(fname), key=key)
+                return os.path.abspath(fname)
+            try:
+                with self.host_limit(url):
+                    return self._fetch_part(url, fname, key)
+            except (requests.RequestException, Urllib3Error, IOError, OSError):
+                # What was received stays in `.part` for the next attempt
+                return False
+
+    def _fetch_part(self, url, fname, key=None, retries=0):
+        part = fname + '.part'
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {}
+        etag = self.index.part_etag(fname)
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            if etag:
+                headers['If-Range'] = etag
+        sample = self.metrics.start('GET', url, retries)
+        try:
+            response = self.session.get(url, stream=True, timeout=self.timeout, headers=headers)
+        except Exception as e:
+            sample.finish(error=e)
+            raise
+        if response.status_code == 416 and offset:  # stale part, start over
+            sample.finish(response, bytes_out=0, bytes_in=0)
+            os.remove(part)
+            self.index.remove(fname)
+            return self._fetch_part(url, fname, key, retries + 1)
+        try:
+            return self._save_part(response, fname, key, offset)
+        finally:
+            sample.finish(response, bytes_out=0, bytes_in=response.raw.tell())
+
+    def _save_part(self, response, fname, key=None, offset=0):
+        part = fname + '.part'
+        if response.status_code == 200:
+            offset = 0
+            total = response.headers.get('Content-Length')
+        elif response.status_code == 206:
+            content_range, _, total = response.headers.get('Content-Range', '').rpartition('/')
+            if not content_range.startswith('bytes {}-'.format(offset)):
+                return False
+        else:
+            return False
+        total = int(total) if total and total.isdigit() else None
+        encoded = response.headers.get('Content-Encoding', 'identity').lower() not in ('', 'identity')
+        if encoded and offset:  # the range is of the encoded file, start over
+            os.remove(part)
+            self.index.remove(fname)
+            return False
+        etag = response.headers.get('ETag')
+        if etag != self.index.part_etag(fname):
+            self.index.add_part(fname, etag)
+
+        checksum = hashlib.md5()
+        if offset:
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    checksum.update(chunk)
+        with open(part, 'ab' if offset else 'wb') as f:
+            for chunk in response.raw.stream(CHUNK_SIZE, decode_content=True):
+                f.write(chunk)
+                checksum.update(chunk)
+
+        size = os.path.getsize(part)
+        # Content-Length and Content-Range count the body as sent
+        received = offset + response.raw.tell()
+        if total is not None and received != total:
+            if received > total or encoded:
+                os.remove(part)
+            return False
+        md5 = (etag or '').strip('"').lower()
+        if not encoded and MD5_ETAG.match(md5) and md5 != checksum.hexdigest():
+            os.remove(part)
+            self.index.remove(fname)
+            return False
+        utils.replace_file(part, fname)
+        self.index.add(fname, size, etag, checksum.hexdigest(), key)
+        return os.path.abspath(fname)
+
+    def _fetch(self, job):
+        return job[1], self.fetch(*job)
+
+    def submit(self, url, fname, key=None):
+        """Starts the download in background. Returns an AsyncResult of `fetch`."""
+        return self.pool.apply_async(self.fetch, (url, fname, key))
+
+    def download(self, jobs, progress=True, desc='Downloading media'):
+        """Downloads (url, path[, media_key]) `jobs` concurrently.
+
+        @param jobs      List of (url, path) or (url, path, media_key) tuples
+        @param progress  Show a progress bar (Boolean)
+        @param desc      Progress bar description (String)
+
+        @return          OrderedDict: path -> absolute path (or False on error)
+        """
+        results = OrderedDict((job[1], False) for job in jobs)
+        if not jobs:
+            return results
+        with tqdm(total=len(jobs), desc=desc, disable=not progress, leave=False) as pbar:
+            for fname, result in self.pool.imap_unordered(self._fetch, jobs):
+                results[fname] = result
+                pbar.update(1)
+        self.index.save()
+        return results
+
+    def close(self):
+        self.index.save()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
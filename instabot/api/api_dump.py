@@ -0,0 +1,101 @@
+"""
+    Writers for big follower / following dumps of
+    `get_total_followers_or_followings(to_file=...)`.
+
+    The file stays open for the whole dump and every page of users is
+    written at once, instead of one `write` per user.
+
+    Formats:
+        'txt'  One user id (or username) per line, as before
+        'csv'  Header and one row of `CSV_FIELDS` per user
+        'bin'  One `BIN_RECORD` per user (pk, private / verified flags,
+               username length) followed by the utf-8 username
+"""
+from __future__ import unicode_literals
+
+import csv
+import io
+import struct
+
+import six
+
+DUMP_FORMATS = ('txt', 'csv', 'bin')
+DUMP_BUFFER_SIZE = 1024 * 1024
+CSV_FIELDS = ('pk', 'username', 'full_name', 'is_private', 'is_verified')
+BIN_RECORD = struct.Struct('<QBB')
+BIN_PRIVATE, BIN_VERIFIED = 1, 2
+
+
+class UserDumpWriter(object):
+
+    def __init__(self, fname, fmt='txt', usernames=False, buffer_size=DUMP_BUFFER_SIZE):
+        if fmt not in DUMP_FORMATS:
+            raise ValueError("`fmt` must be one of {}".format(', '.join(DUMP_FORMATS)))
+        self.fname = fname
+        self.fmt = fmt
+        self.usernames = usernames
+        if fmt == 'bin' or (fmt == 'csv' and six.PY2):
+            self.f = open(fname, 'wb', buffer_size)
+        else:
+            self.f = io.open(fname, 'w', buffer_size, encoding='utf8', newline='')
+        if fmt == 'csv':
+            self.csv = csv.writer(self.f)
+            self.csv.writerow(CSV_FIELDS)
+
+    def write_page(self, users):
+        """Writes a list of user dicts of a followers / followings page."""
+        if self.fmt == 'txt':
+            key = 'username' if self.usernames else 'pk'
+            self.f.writelines(['{}\n'.format(item[key]) for item in users])
+        elif self.fmt == 'csv':
+            rows = [[item.get(field, '') for field in CSV_FIELDS] for item in users]
+            if six.PY2:
+                rows = [[six.text_type(value).encode('utf8') for value in row] for row in rows]
+            self.csv.writerows(rows)
+        else:
+            self.f.write(b''.join(pack_user(item) for item in users))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class NullDumpWriter(object):
+    """Used when there is no `to_file`."""
+
+    def write_page(self, users):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def pack_user(item):
+    username = item['username'].encode('utf8')[:255]
+    flags = (BIN_PRIVATE if item.get('is_private') else 0) | (BIN_VERIFIED if item.get('is_verified') else 0)
+    return BIN_RECORD.pack(int(item['pk']), flags, len(username)) + username
+
+
+def read_bin_dump(fname):
+    """Yields {'pk', 'username', 'is_private', 'is_verified'} from a 'bin' dump."""
+    with open(fname, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        pk, flags, length = BIN_RECORD.unpack_from(data, offset)
+        offset += BIN_RECORD.size
+        yield {
+            'pk': pk,
+            'username': data[offset:offset + length].decode('utf8'),
+            'is_private': bool(flags & BIN_PRIVATE),
+            'is_verified': bool(flags & BIN_VERIFIED),
+        }
+        offset += length
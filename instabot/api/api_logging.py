@@ -0,0 +1,211 @@
+"""
+    Shared, queued logging of `API` instances.
+
+    All instances log through the 'instabot' logger, whose only handler is
+    a `QueueHandler`: logging a record costs an enqueue, and a
+    `QueueListener` thread writes it to the console and the log files. The
+    listener has one console handler for the whole process, plus one
+    `FileHandler` per log file, shared by every instance writing to that
+    file (records are routed by the name of the file's child logger). File
+    handlers are reference counted: a handler is closed, after its queued
+    records, when the last instance using it is released (`API.close()`,
+    or garbage collection). Files are opened on the first record, not when
+    an instance is created.
+
+    `set_level` switches the console and file levels at runtime, of every
+    instance of the process; `flush` waits until the queued records are
+    written.
+"""
+from __future__ import unicode_literals
+
+import atexit
+import hashlib
+import logging
+import os
+import sys
+import threading
+
+from six.moves import queue
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:  # Python 2: records are written synchronously
+    QueueHandler = QueueListener = None
+
+try:
+    from weakref import finalize
+except ImportError:  # Python 2: released by `API.close()` only
+    finalize = None
+
+LOGGER_NAME = 'instabot'
+LOG_FILENAME = 'instabot.log'
+CONSOLE_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+FILE_FORMAT = '%(asctime)s %(message)s'
+
+_lock = threading.Lock()
+_files = {}  # absolute path -> [handler, number of owners]
+_levels = {'console': logging.DEBUG, 'file': logging.INFO}
+_state = {}  # 'console', 'dispatcher', 'queue', 'listener' once set up
+
+
+class ConsoleHandler(logging.StreamHandler):
+    """StreamHandler of the current `sys.stderr`, also after it is replaced"""
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class _Dispatcher(logging.Handler):
+    """Hands every record to the console and file handlers, in the listener thread."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.handlers = []
+
+    def handle(self, record):
+        closing = getattr(record, 'close_handler', None)
+        if closing is not None:
+            if closing in self.handlers:
+                self.handlers.remove(closing)
+            closing.close()
+            return
+        for handler in list(self.handlers):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def _setup():
+    if _state:
+        return
+    console = ConsoleHandler()
+    console.setLevel(_levels['console'])
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    dispatcher = _Dispatcher()
+    dispatcher.handlers.append(console)
+    _state.update(console=console, dispatcher=dispatcher)
+
+    logger = logging.getLogger(LOGGER_NAME)
+    if QueueHandler is not None:
+        records = queue.Queue()
+        listener = QueueListener(records, dispatcher)
+        listener.start()
+        atexit.register(listener.stop)
+        _state.update(queue=records, listener=listener)
+        logger.addHandler(QueueHandler(records))
+    else:
+        logger.addHandler(dispatcher)
+    _update_logger_level()
+
+
+def _update_logger_level():
+    # Records below every handler's level are dropped before the queue
+    levels = [_state['console'].level] + [handler.level for handler, _ in _files.values()]
+    logging.getLogger(LOGGER_NAME).setLevel(min(levels))
+
+
+def _send(record):
+    if 'queue' in _state:
+        _state['queue'].put_nowait(record)
+    else:
+        _state['dispatcher'].handle(record)
+
+
+def file_logger_name(path):
+    """Name of the logger of the log file `path`: one per file, however many instances"""
+    digest = hashlib.md5(os.path.abspath(path).encode('utf8')).hexdigest()[:12]
+    return '{}.file_{}'.format(LOGGER_NAME, digest)
+
+
+class _Release(object):
+    """Drops one reference to the handler of `path`, only once."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = False
+
+    def __call__(self):
+        with _lock:
+            if self.done or self.path is None:
+                return
+            self.done = True
+            entry = _files.get(self.path)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del _files[self.path]
+            # Closed by the listener, after the records queued before
+            record = logging.LogRecord(LOGGER_NAME, logging.CRITICAL, __file__, 0, 'close', None, None)
+            record.close_handler = entry[0]
+            _send(record)
+            _update_logger_level()
+
+
+def acquire_logger(owner, log_file=None):
+    """
+        Logger for `owner`, writing to the console and, unless `log_file` is
+        None, to `log_file`.
+
+        @return  (logger, release): `release()` drops the reference of `owner`
+                 to the file handler. It is idempotent and is also called
+                 when `owner` is garbage collected.
+    """
+    with _lock:
+        _setup()
+        if log_file is None:
+            return logging.getLogger(LOGGER_NAME), _Release(None)
+        path = os.path.abspath(log_file)
+        name = file_logger_name(path)
+        if path not in _files:
+            handler = logging.FileHandler(filename=path, delay=True)
+            handler.setLevel(_levels['file'])
+            handler.setFormatter(logging.Formatter(FILE_FORMAT))
+            handler.addFilter(logging.Filter(name))
+            _state['dispatcher'].handlers.append(handler)
+            _files[path] = [handler, 0]
+            _update_logger_level()
+        _files[path][1] += 1
+    release = _Release(path)
+    if finalize is not None:
+        finalize(owner, release)
+    return logging.getLogger(name), release
+
+
+def set_level(level, console=True, files=True):
+    """
+        Switches the log level at runtime.
+
+        @param level    logging level, e.g. logging.WARNING or 'WARNING'
+        @param console  Apply to the console (Boolean)
+        @param files    Apply to the log files (Boolean)
+    """
+    if not isinstance(level, int):
+        level = logging.getLevelName(level.upper())
+    with _lock:
+        _setup()
+        if console:
+            _levels['console'] = level
+            _state['console'].setLevel(level)
+        if files:
+            _levels['file'] = level
+            for handler, _ in _files.values():
+                handler.setLevel(level)
+        _update_logger_level()
+
+
+def flush():
+    """Waits until every queued record is written."""
+    if 'queue' in _state:
+        _state['queue'].join()
+
+
+def open_log_files():
+    """{path: number of owners} of the file handlers in use"""
+    with _lock:
+        return {path: entry[1] for path, entry in _files.items()}
@@ -0,0 +1,244 @@
+"""
+    Batch preparation of media files before uploading.
+
+    `resize_image`, `stories_shaper` and `resize_video` are CPU bound, so a
+    batch of files is prepared in a process pool ahead of the uploads, while
+    the network is busy with something else. Prepared files are kept in a
+    content addressed `MediaCache`, so they are never prepared twice.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+from .. import utils
+from .api_photo import compatible_aspect_ratio, get_image_size, resize_image, stories_shaper
+from .api_video import resize_video
+
+MEDIA_KINDS = ('feed', 'story', 'video')
+MEDIA_CACHE_SIZE = 1024 * 1024 * 1024  # 1 GB
+
+
+def file_checksum(fname, chunk_size=1024 * 1024):
+    """Returns the sha1 hex digest of the file content."""
+    checksum = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class MediaCache(object):
+    """
+        Content addressed cache of prepared media files.
+
+        Entries are keyed by the sha1 of the source file and the kind of
+        preparation ('feed', 'story', 'video'), so reposting the same file or
+        retrying a failed upload reuses the prepared output. `manifest.json`
+        keeps the files, the video metadata and the last use of every entry;
+        the least recently used entries are removed when the cache grows over
+        `max_size` bytes. Nothing is written until the first entry is added.
+    """
+
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, folder, max_size=MEDIA_CACHE_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            try:
+                with open(os.path.join(self.folder, self.MANIFEST), 'r') as f:
+                    self._manifest = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._manifest = {}
+        return self._manifest
+
+    def save(self):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        utils.atomic_write(os.path.join(self.folder, self.MANIFEST), json.dumps(self.manifest))
+
+    @property
+    def size(self):
+        return sum(entry['size'] for entry in self.manifest.values())
+
+    def get(self, checksum, kind):
+        """Returns the prepared result of `checksum` or None."""
+        key = '{}.{}'.format(checksum, kind)
+        entry = self.manifest.get(key)
+        if entry is None:
+            return None
+        files = [os.path.join(self.folder, fname) for fname in entry['files']]
+        if not all(os.path.exists(fname) for fname in files):
+            self.remove(key)
+            return None
+        entry['used'] = time.time()
+        self.save()
+        if kind == 'video':
+            return tuple(files) + tuple(entry['meta'])
+        return files[0]
+
+    def put(self, checksum, kind, result, source=None):
+        """Moves the prepared files of `result` into the cache.
+
+        `result` is the path returned by `resize_image` / `stories_shaper` or
+        the tuple returned by `resize_video`. `source` itself is copied, not moved.
+        Returns `result` with the paths inside the cache.
+        """
+        key = '{}.{}'.format(checksum, kind)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        if kind == 'video':
+            fnames, meta = list(result[:2]), list(result[2:])
+            targets = [key + '.mp4', key + '.thumbnail.jpg']
+        else:
+            fnames, meta = [result], []
+            targets = [key + '.jpg']
+        for fname, target in zip(fnames, targets):
+            if fname == source:
+                shutil.copyfile(fname, os.path.join(self.folder, target))
+            else:
+                shutil.move(fname, os.path.join(self.folder, target))
+        return self._add(key, targets, meta)
+
+    def put_data(self, checksum, kind, data):
+        """Stores prepared `data` bytes (e.g. an in-memory story) and returns its path."""
+        key = '{}.{}'.format(checksum, kind)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        utils.atomic_write(os.path.join(self.folder, key + '.jpg'), data, mode='wb')
+        return self._add(key, [key + '.jpg'], [])
+
+    def _add(self, key, targets, meta):
+        self.manifest[key] = {
+            'files': targets,
+            'meta': meta,
+            'size': sum(os.path.getsize(os.path.join(self.folder, fname)) for fname in targets),
+            'used': time.time(),
+        }
+        self.evict(keep=key)
+        self.save()
+        return self.get(*key.rsplit('.', 1))
+
+    def remove(self, key):
+        entry = self.manifest.pop(key, None)
+        if entry is None:
+            return
+        for fname in entry['files']:
+            fname = os.path.join(self.folder, fname)
+            if os.path.exists(fname):
+                os.remove(fname)
+        self.save()
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries while over `max_size`."""
+        total = self.size
+        for key in sorted(self.manifest, key=lambda k: self.manifest[k]['used']):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total -= self.manifest[key]['size']
+            self.remove(key)
+
+
+def _prepare_media(args):
+    """Process pool worker: returns the prepared result next to the source file."""
+    fname, kind, knobs = args
+    try:
+        if kind == 'feed':
+            result = fname
+            if not compatible_aspect_ratio(get_image_size(fname)):
+                result = resize_image(fname)
+        elif kind == 'story':
+            result = stories_shaper(fname)
+        else:
+            result = resize_video(fname, **knobs)
+        return fname, result or False
+    except Exception as e:
+        print("ERROR: can't prepare `{}`: {}".format(fname, e))
+        return fname, False
+
+
+def prepare_media(fname, kind='feed', cache=None, **knobs):
+    """Prepares one media file, reusing the cached result of the same content.
+
+    @param fname  Path to the source file (String)
+    @param kind   'feed', 'story' or 'video' (String)
+    @param cache  MediaCache, or None to prepare without caching
+    @param knobs  `resize_video` parameters, e.g. preset, threads
+
+    @return       Prepared path, or the `resize_video` tuple for videos (or False)
+    """
+    checksum = None
+    if cache is not None:
+        checksum = file_checksum(fname)
+        prepared = cache.get(checksum, kind)
+        if prepared:
+            return prepared
+    result = _prepare_media((fname, kind, knobs))[1]
+    if result and cache is not None:
+        result = cache.put(checksum, kind, result, source=fname)
+    return result
+
+
+def prepare_media_batch(paths, kind='feed', workers=None, cache='prepared'):
+    """Prepares media files for uploading in a process pool.
+
+    @param paths    Paths to the source files (List)
+    @param kind     'feed' (`upload_photo`), 'story' (`upload_story_photo`) or 'video' (`upload_video`)
+    @param workers  Number of processes (Integer). When None, then the number of CPUs
+    @param cache    MediaCache or its folder (String). Files are keyed by the content
+                    hash of the source, so identical sources are prepared once and
+                    already prepared ones are reused.
+
+    @return         OrderedDict: source path -> prepared path (or False on error).
+                    For videos the value is the (video, thumbnail, width, height, duration)
+                    tuple, to be passed to `upload_video` as `options={'prepared': ...}`.
+    """
+    if kind not in MEDIA_KINDS:
+        raise ValueError("`kind` must be one of {}".format(', '.join(MEDIA_KINDS)))
+    if not isinstance(cache, MediaCache):
+        cache = MediaCache(cache)
+
+    results = OrderedDict((fname, False) for fname in paths)
+    pending = OrderedDict()  # checksum -> source paths
+    for fname in results:
+        checksum = file_checksum(fname)
+        prepared = cache.get(checksum, kind)
+        if prepared:
+            results[fname] = prepared
+        else:
+            pending.setdefault(checksum, []).append(fname)
+    if not pending:
+        return results
+
+    import multiprocessing  # not needed by `import instabot`
+
+    tasks = [(fnames[0], kind, {}) for fnames in pending.values()]
+    workers = min(workers or multiprocessing.cpu_count(), len(tasks))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            prepared = dict(pool.imap_unordered(_prepare_media, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        prepared = dict(_prepare_media(task) for task in tasks)
+
+    for checksum, fnames in pending.items():
+        result = prepared[fnames[0]]
+        if result:
+            result = cache.put(checksum, kind, result, source=fnames[0])
+        for fname in fnames:
+            results[fname] = result
+    return results
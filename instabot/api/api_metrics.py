@@ -0,0 +1,438 @@
+"""
+    Per-endpoint instrumentation of the requests made by `API`.
+
+    Every request is recorded under its endpoint template (ids, hashtags
+    and usernames replaced by placeholders, e.g. 'media/{id}/like/') and
+    method: count by status, errors, bytes out and in, retries, and latency
+    histograms of the whole request and of opening a new connection:
+    'connect' (DNS lookup and TCP handshake) and 'tls'. Requests to other
+    hosts (CDN, uploads) are recorded under the host name.
+
+    Exporters get every sample as it happens (`record`) and the whole
+    `RequestMetrics` on `flush()`:
+        PrometheusTextfileExporter  for the node_exporter textfile collector
+        StatsdExporter              UDP, one packet per request
+        JsonLinesExporter           one json object per request
+
+    Usage:
+        api.metrics.exporters.append(PrometheusTextfileExporter('instabot.prom'))
+        ...
+        api.metrics.summary()
+"""
+from __future__ import unicode_literals
+
+import bisect
+import io
+import json
+import re
+import socket
+import threading
+import time
+
+import six
+import six.moves.urllib as urllib
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .. import utils
+from ..profiling import span
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PHASES = ('total', 'connect', 'tls')
+FLUSH_INTERVAL = 60
+
+ID_SEGMENT = re.compile(r'^\d+(_\d+)?$')
+API_PATH = re.compile(r'^/api/v\d+/')
+# A segment after one of these is a name, not an endpoint part
+NAMED_SEGMENTS = {'tag': '{tag}', 'tags': '{tag}'}
+# A segment before one of these is a name
+NAMED_BEFORE = {'usernameinfo': '{username}', 'story_quiz_answer': '{id}'}
+
+
+def normalize_endpoint(url):
+    """Endpoint template of an url: 'https://i.instagram.com/api/v1/media/123_4/like/' -> 'media/{id}/like/'"""
+    parsed = urllib.parse.urlparse(url)
+    if not API_PATH.match(parsed.path):
+        return parsed.netloc or parsed.path
+    segments = API_PATH.sub('', parsed.path).split('/')
+    for index, segment in enumerate(segments):
+        if ID_SEGMENT.match(segment):
+            segments[index] = '{id}'
+        elif index and segments[index - 1] in NAMED_SEGMENTS and segment:
+            segments[index] = NAMED_SEGMENTS[segments[index - 1]]
+        elif index + 1 < len(segments) and segments[index + 1] in NAMED_BEFORE:
+            segments[index] = NAMED_BEFORE[segments[index + 1]]
+    return '/'.join(segments)
+
+
+# Connection phases of the requests made by the current thread
+_phases = threading.local()
+
+
+def _reset_phases():
+    _phases.connect = None
+    _phases.tls = None
+
+
+def _add_phase(name, seconds):
+    setattr(_phases, name, (getattr(_phases, name, None) or 0) + seconds)
+
+
+class _TimedConnectionMixin(object):
+
+    def _new_conn(self):
+        started = time.time()
+        try:
+            return super(_TimedConnectionMixin, self)._new_conn()
+        finally:
+            _add_phase('connect', time.time() - started)
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+
+    def connect(self):
+        connect = getattr(_phases, 'connect', None) or 0
+        started = time.time()
+        try:
+            return super(TimedHTTPSConnection, self).connect()
+        finally:
+            # Whatever `connect` took besides `_new_conn` is the handshake
+            opened = (getattr(_phases, 'connect', None) or 0) - connect
+            _add_phase('tls', max(time.time() - started - opened, 0))
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose new connections record the 'connect' and 'tls' phases."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
+def instrument(session):
+    """Mounts a `TimedHTTPAdapter` on `session`, once."""
+    if not isinstance(session.get_adapter('https://'), TimedHTTPAdapter):
+        adapter = TimedHTTPAdapter()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return session
+
+
+def body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, six.text_type):
+        return len(body.encode('utf8'))
+    try:
+        return len(body)
+    except TypeError:  # generators, files
+        return 0
+
+
+class Histogram(object):
+    """Bucket counts, not cumulative: `counts[i]` are the values in (`buckets[i - 1]`, `buckets[i]`]"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket of the `q` quantile (0..1), None when empty"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class EndpointStats(object):
+
+    def __init__(self, endpoint, method):
+        self.endpoint = endpoint
+        self.method = method
+        self.statuses = {}
+        self.errors = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.retries = 0
+        self.histograms = {phase: Histogram() for phase in PHASES}
+
+    @property
+    def count(self):
+        return self.histograms['total'].count
+
+    def add(self, sample):
+        if sample['status'] is None:
+            self.errors += 1
+        status = sample['status'] or 'error'
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes_out += sample['bytes_out']
+        self.bytes_in += sample['bytes_in']
+        self.retries += sample['retries']
+        for phase in PHASES:
+            if sample[phase] is not None:
+                self.histograms[phase].observe(sample[phase])
+
+
+class RequestSample(object):
+    """One request being measured, see `RequestMetrics.start`."""
+
+    def __init__(self, metrics, method, url, retries=0, endpoint=None):
+        self.metrics = metrics
+        self.method = method.upper()
+        self.url = url
+        self.endpoint = endpoint
+        self.retries = retries
+        _reset_phases()
+        self.started = time.time()
+
+    def finish(self, response=None, error=None, bytes_out=None, bytes_in=None):
+        """Records the request. `bytes_in` defaults to the body of a not streamed `response`."""
+        total = time.time() - self.started
+        if bytes_out is None:
+            bytes_out = body_size(response.request.body) if response is not None else 0
+        if bytes_in is None:
+            bytes_in = len(response.content) if response is not None and response._content_consumed else 0
+        sample = {
+            'time': self.started,
+            'endpoint': self.endpoint or normalize_endpoint(self.url),
+            'method': self.method,
+            'status': response.status_code if response is not None else None,
+            'error': error.__class__.__name__ if error is not None else None,
+            'bytes_out': bytes_out,
+            'bytes_in': bytes_in,
+            'retries': self.retries,
+            'total': total,
+            'connect': getattr(_phases, 'connect', None),
+            'tls': getattr(_phases, 'tls', None),
+        }
+        self.metrics.add(sample)
+        return sample
+
+
+class RequestMetrics(object):
+    """
+        In-process per-endpoint request statistics of one `API`.
+
+        @param exporters       List of `MetricsExporter`
+        @param flush_interval  Seconds between automatic `flush()` calls (Integer)
+    """
+
+    def __init__(self, exporters=None, flush_interval=FLUSH_INTERVAL):
+        self.exporters = list(exporters or [])
+        self.flush_interval = flush_interval
+        self.enabled = True
+        self.endpoints = {}
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def start(self, method, url, retries=0, endpoint=None):
+        """Starts measuring a request; call `finish()` of the result when it is done."""
+        return RequestSample(self, method, url, retries, endpoint)
+
+    def request(self, session, method, url, retries=0, **kwargs):
+        """`session.request(method, url, **kwargs)`, recorded. Exceptions are recorded and re-raised."""
+        if not self.enabled:
+            with span('http', 'network'):
+                return session.request(method, url, **kwargs)
+        instrument(session)
+        sample = self.start(method, url, retries)
+        try:
+            with span('http', 'network'):
+                response = session.request(method, url, **kwargs)
+        except Exception as e:
+            sample.finish(error=e, bytes_out=body_size(kwargs.get('data')))
+            raise
+        sample.finish(response)
+        return response
+
+    def add(self, sample):
+        if not self.enabled:
+            return
+        key = (sample['endpoint'], sample['method'])
+        with self._lock:
+            if key not in self.endpoints:
+                self.endpoints[key] = EndpointStats(*key)
+            self.endpoints[key].add(sample)
+        for exporter in self.exporters:
+            exporter.record(sample)
+        if self.exporters and time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        for exporter in self.exporters:
+            exporter.flush(self)
+
+    def close(self):
+        self.flush()
+        for exporter in self.exporters:
+            exporter.close()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+
+    def summary(self, sort_by='count', limit=None):
+        """
+            Endpoints, most requested (`sort_by='count'`) or slowest in total
+            (`sort_by='time'`) first.
+
+            @return  List of dicts: endpoint, method, count, errors, statuses,
+                     bytes_out, bytes_in, retries, time, p50, p99
+        """
+        with self._lock:
+            stats = list(self.endpoints.values())
+        rows = [{
+            'endpoint': item.endpoint,
+            'method': item.method,
+            'count': item.count,
+            'errors': item.errors,
+            'statuses': dict(item.statuses),
+            'bytes_out': item.bytes_out,
+            'bytes_in': item.bytes_in,
+            'retries': item.retries,
+            'time': item.histograms['total'].sum,
+            'p50': item.histograms['total'].quantile(0.5),
+            'p99': item.histograms['total'].quantile(0.99),
+        } for item in stats]
+        rows.sort(key=lambda row: row[sort_by], reverse=True)
+        return rows[:limit] if limit else rows
+
+    def to_prometheus(self, prefix='instabot'):
+        """Prometheus text exposition format of all the endpoints"""
+        lines = []
+
+        def labels(item, **extra):
+            pairs = [('endpoint', item.endpoint), ('method', item.method)] + sorted(extra.items())
+            return '{' + ','.join('{}="{}"'.format(key, value) for key, value in pairs) + '}'
+
+        with self._lock:
+            stats = sorted(self.endpoints.values(), key=lambda item: (item.endpoint, item.method))
+            lines.append('# TYPE {}_requests_total counter'.format(prefix))
+            for item in stats:
+                for status, count in sorted(item.statuses.items(), key=str):
+                    lines.append('{}_requests_total{} {}'.format(prefix, labels(item, status=status), count))
+            for name in ('bytes_out', 'bytes_in', 'retries'):
+                lines.append('# TYPE {}_request_{}_total counter'.format(prefix, name))
+                for item in stats:
+                    lines.append('{}_request_{}_total{} {}'.format(prefix, name, labels(item), getattr(item, name)))
+            for phase in PHASES:
+                metric = '{}_request_{}_seconds'.format(prefix, phase)
+                lines.append('# TYPE {} histogram'.format(metric))
+                for item in stats:
+                    histogram = item.histograms[phase]
+                    if not histogram.count:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(metric, labels(item, le=bound), cumulative))
+                    lines.append('{}_sum{} {}'.format(metric, labels(item), histogram.sum))
+                    lines.append('{}_count{} {}'.format(metric, labels(item), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter(object):
+    """Base exporter: `record` gets every sample dict, `flush` the whole `RequestMetrics`."""
+
+    def record(self, sample):
+        pass
+
+    def flush(self, metrics):
+        pass
+
+    def close(self):
+        pass
+
+
+class PrometheusTextfileExporter(MetricsExporter):
+    """Rewrites `fname` (atomically) on every flush, for the node_exporter textfile collector."""
+
+    def __init__(self, fname, prefix='instabot'):
+        self.fname = fname
+        self.prefix = prefix
+
+    def flush(self, metrics):
+        utils.atomic_write(self.fname, metrics.to_prometheus(self.prefix))
+
+
+class StatsdExporter(MetricsExporter):
+    """Sends a counter, a timer and the byte counts of every request to a StatsD server over UDP."""
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='instabot'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def name(self, sample):
+        endpoint = re.sub(r'[^\w]+', '_', sample['endpoint'].replace('/', '.')).strip('._')
+        return '.'.join([self.prefix, endpoint or 'root', sample['method'].lower()])
+
+    def record(self, sample):
+        name = self.name(sample)
+        lines = [
+            '{}.{}:1|c'.format(name, sample['status'] or 'error'),
+            '{}.time:{:.3f}|ms'.format(name, sample['total'] * 1000),
+            '{}.bytes_out:{}|c'.format(name, sample['bytes_out']),
+            '{}.bytes_in:{}|c'.format(name, sample['bytes_in']),
+        ]
+        for phase in ('connect', 'tls'):
+            if sample[phase] is not None:
+                lines.append('{}.{}:{:.3f}|ms'.format(name, phase, sample[phase] * 1000))
+        try:
+            self.socket.sendto('\n'.join(lines).encode('utf8'), self.address)
+        except (socket.error, OSError):
+            pass  # Metrics never break a request
+
+    def close(self):
+        self.socket.close()
+
+
+class JsonLinesExporter(MetricsExporter):
+    """Appends every sample to `fname` as one json object per line."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.f = io.open(fname, 'a', encoding='utf8')
+        self._lock = threading.Lock()
+
+    def record(self, sample):
+        line = json.dumps(sample, sort_keys=True)
+        with self._lock:
+            self.f.write(six.text_type(line) + '\n')
+
+    def flush(self, metrics):
+        with self._lock:
+            self.f.flush()
+
+    def close(self):
+        with self._lock:
+            self.f.close()
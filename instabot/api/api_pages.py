@@ -0,0 +1,114 @@
+"""
+    Prefetching pagination of `max_id` feeds.
+
+    A feed page is requested as soon as the cursor of the previous page is
+    known, in a background thread, while the caller is still busy with the
+    previous page. At most `depth` pages are requested ahead of the page the
+    caller asked for last; `stop()` (or leaving the `with` block) waits for
+    the request in flight, drops the outstanding pages and no more pages
+    are requested. An exception of `fetch` or `next_cursor` is raised to the
+    caller after the pages received before it.
+"""
+from __future__ import unicode_literals
+
+import sys
+import threading
+
+import six
+from six.moves import queue
+
+PREFETCH_DEPTH = 1
+
+_END = object()
+
+
+class _Failure(object):
+    """An exception of the worker thread, raised again in the consumer's"""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class PagePrefetcher(object):
+    """
+        Iterates the pages of a feed.
+
+        @param fetch        Function: max_id -> (success, page json)
+        @param next_cursor  Function: page json -> next max_id, or None on the last page
+        @param depth        Number of pages fetched ahead of the consumer (Integer)
+        @param on_page      Function called with every fetched page json, failed
+                            ones included, in the consumer's thread
+    """
+
+    def __init__(self, fetch, next_cursor, depth=PREFETCH_DEPTH, on_page=None):
+        self.fetch = fetch
+        self.next_cursor = next_cursor
+        self.on_page = on_page
+        self.pages = queue.Queue()
+        self.stopped = threading.Event()
+        self._thread = None
+        # Pages the worker may still request: `depth`, plus one per page asked for
+        self._allowed = max(depth, 0)
+        self._turns = threading.Condition()
+
+    def _next_turn(self):
+        """Waits until one more page may be requested. False once stopped."""
+        with self._turns:
+            while self._allowed <= 0 and not self.stopped.is_set():
+                self._turns.wait()
+            if self.stopped.is_set():
+                return False
+            self._allowed -= 1
+            return True
+
+    def _run(self):
+        max_id = ''
+        try:
+            while self._next_turn():
+                success, page = self.fetch(max_id)
+                if not success:
+                    self.pages.put((False, page))
+                    break
+                self.pages.put((True, page))
+                max_id = self.next_cursor(page)
+                if max_id is None:
+                    break
+        except Exception:
+            self.pages.put(_Failure(sys.exc_info()))
+        finally:
+            self.pages.put(_END)
+
+    def __iter__(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        while not self.stopped.is_set():
+            with self._turns:
+                self._allowed += 1
+                self._turns.notify()
+            item = self.pages.get()
+            if item is _END:
+                break
+            if isinstance(item, _Failure):
+                six.reraise(*item.exc_info)
+            success, page = item
+            if self.on_page is not None:
+                self.on_page(page)
+            if not success:
+                break
+            yield page
+
+    def stop(self):
+        """Stops requesting pages, once the page being fetched now is received (and dropped)."""
+        self.stopped.set()
+        with self._turns:
+            self._turns.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
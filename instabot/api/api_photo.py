@@ -1,16 +1,42 @@
 from __future__ import unicode_literals
-import imghdr
 import os
-import shutil
 import struct
 import time
-
-from requests_toolbelt import MultipartEncoder
+from io import BytesIO
 
 from . import config
+from .. import utils
+from .api_download import media_key, media_pk
+
+# Enough to hold the header and the usual EXIF block of a JPEG
+PROBE_SIZE = 64 * 1024
+
+_image_sizes = {}  # (path, mtime) -> (width, height)
+
+
+def photo_download_jobs(media, media_id, folder='photos', filename=None):
+    """Returns the (url, path, media_key) of every photo of the `media` item, skipping videos."""
+    pk = media.get('pk') or media_pk(media_id)
+    if media['media_type'] == 1:
+        filename = ('{}_{}.jpg'.format(media['user']['username'], media_id)
+                    if not filename else '{}.jpg'.format(filename))
+        url = media['image_versions2']['candidates'][0]['url']
+        return [(url, os.path.join(folder, filename), media_key('photo', pk))]
+    jobs = []
+    for index, item in enumerate(media.get('carousel_media', [])):
+        if item['media_type'] != 1:
+            continue
+        filename_i = ('{}_{}_{}.jpg'.format(media['user']['username'], media_id, index)
+                      if not filename else '{}_{}.jpg'.format(filename, index))
+        url = item['image_versions2']['candidates'][0]['url']
+        jobs.append((url, os.path.join(folder, filename_i), media_key('photo', pk, index)))
+    return jobs
 
 
 def download_photo(self, media_id, filename, media=False, folder='photos'):
+    paths = self.downloader.index.media_paths(media.get('pk') if media else media_id)
+    if paths:
+        return paths[-1]
     if not media:
         self.media_info(media_id)
         if not self.last_json.get('items'):
@@ -18,50 +44,24 @@ def download_photo(self, media_id, filename, media=False, folder='photos'):
         media = self.last_json['items'][0]
     if media['media_type'] == 2:
         return True
-    elif media['media_type'] == 1:
-        filename = ('{}_{}.jpg'.format(media['user']['username'], media_id)
-                    if not filename else '{}.jpg'.format(filename))
-        images = media['image_versions2']['candidates']
-        fname = os.path.join(folder, filename)
-        if os.path.exists(fname):
-            self.logger.info("File already esists, skipping...")
-            return os.path.abspath(fname)
-        response = self.session.get(images[0]['url'], stream=True)
-        if response.status_code == 200:
-            with open(fname, 'wb') as f:
-                response.raw.decode_content = True
-                shutil.copyfileobj(response.raw, f)
-            return os.path.abspath(fname)
-    else:
-        success = False
-        video_included = False
-        for index in range(len(media["carousel_media"])):
-            if media["carousel_media"][index]["media_type"] != 1:
-                video_included = True
-                continue
-            filename_i = ('{}_{}_{}.jpg'.format(media['user']['username'], media_id, index)
-                          if not filename else '{}_{}.jpg'.format(filename, index))
-            images = media["carousel_media"][index]["image_versions2"]["candidates"]
-            fname = os.path.join(folder, filename_i)
-            if os.path.exists(fname):
-                return os.path.abspath(fname)
-            response = self.session.get(images[0]['url'], stream=True)
-            if response.status_code == 200:
-                success = True
-                with open(fname, 'wb') as f:
-                    response.raw.decode_content = True
-                    shutil.copyfileobj(response.raw, f)
-        if success:
-            return os.path.abspath(fname)
-        elif video_included:
-            return True
+    jobs = photo_download_jobs(media, media_id, folder, filename)
+    # Carousel items are fetched from the CDN at the same time
+    results = list(self.downloader.download(jobs, progress=False).values())
+    if jobs and all(results):
+        self.downloader.index.add_media(media.get('pk') or media_id, results)
+        self.downloader.index.save()
+    results = [path for path in results if path]
+    if results:
+        return results[-1]
+    if len(jobs) < len(media.get('carousel_media', [])):
+        return True  # Video included
 
 
 def compatible_aspect_ratio(size):
     min_ratio, max_ratio = 4.0 / 5.0, 90.0 / 47.0
     width, height = size
     ratio = width * 1. / height * 1.
-    print("FOUND: w:{} h:{} r:{}".format(width, height, ratio))
+    utils.echo("FOUND: w:{} h:{} r:{}".format(width, height, ratio))
     return min_ratio <= ratio <= max_ratio
 
 
@@ -93,9 +93,11 @@ def upload_photo(self, photo, caption=None, upload_id=None, from_video=False, fo
     @param upload_id     Unique upload_id (String). When None, then generate automatically
     @param from_video    A flag that signals whether the photo is loaded from the video or by itself (Boolean, DEPRECATED: not used)
     @param force_resize  Force photo resize (Boolean)
-    @param options       Object with difference options, e.g. configure_timeout, rename (Dict)
+    @param options       Object with difference options, e.g. configure_timeout, rename, prepared (Dict)
                          Designed to reduce the number of function arguments!
                          This is the simplest request object.
+                         `prepared` is the path `prepare_media_batch` returned for `photo`:
+                         it is uploaded instead, and `photo` is renamed when posted.
 
     @return Boolean
     """
@@ -107,10 +109,15 @@ def upload_photo(self, photo, caption=None, upload_id=None, from_video=False, fo
         upload_id = str(int(time.time() * 1000))
     if not photo:
         return False
-    if not compatible_aspect_ratio(get_image_size(photo)):
+    source = photo
+    if options.get('prepared'):
+        photo = options['prepared']
+    elif not compatible_aspect_ratio(get_image_size(photo)):
         self.logger.error('Photo does not have a compatible photo aspect ratio.')
         if force_resize:
-            photo = resize_image(photo)
+            photo = self.prepare_media(photo, 'feed')
+            if not photo:
+                return False
         else:
             return False
 
@@ -124,6 +131,7 @@ def upload_photo(self, photo, caption=None, upload_id=None, from_video=False, fo
         'image_compression': '{"lib_name":"jt","lib_version":"1.3.0","quality":"87"}',
         'photo': ('pending_media_%s.jpg' % upload_id, photo_bytes, 'application/octet-stream', {'Content-Transfer-Encoding': 'binary'})
     }
+    from requests_toolbelt import MultipartEncoder  # imported on the first upload
     m = MultipartEncoder(data, boundary=self.uuid)
     self.session.headers.update({'X-IG-Capabilities': '3Q4=',
                                  'X-IG-Connection-Type': 'WIFI',
@@ -133,8 +141,8 @@ def upload_photo(self, photo, caption=None, upload_id=None, from_video=False, fo
                                  'Content-type': m.content_type,
                                  'Connection': 'close',
                                  'User-Agent': self.user_agent})
-    response = self.session.post(
-        config.API_URL + "upload/photo/", data=m.to_string())
+    response = self.metrics.request(
+        self.session, 'POST', config.API_URL + "upload/photo/", data=m.to_string())
 
     configure_timeout = options.get('configure_timeout')
     if response.status_code == 200:
@@ -146,44 +154,99 @@ def upload_photo(self, photo, caption=None, upload_id=None, from_video=False, fo
                 self.expose()
                 if options.get('rename'):
                     from os import rename
-                    rename(photo, "{}.REMOVE_ME".format(photo))
+                    rename(source, "{}.REMOVE_ME".format(source))
                 return media
     return False
 
 
-def get_image_size(fname):
-    with open(fname, 'rb') as fhandle:
-        head = fhandle.read(24)
-        if len(head) != 24:
-            raise RuntimeError("Invalid Header")
-
-        if imghdr.what(fname) == 'png':
-            check = struct.unpack('>i', head[4:8])[0]
-            if check != 0x0d0a1a0a:
-                raise RuntimeError("PNG: Invalid check")
-            width, height = struct.unpack('>ii', head[16:24])
-        elif imghdr.what(fname) == 'gif':
-            width, height = struct.unpack('<HH', head[6:10])
-        elif imghdr.what(fname) == 'jpeg':
-            fhandle.seek(0)  # Read 0xff next
-            size = 2
-            ftype = 0
-            while not 0xc0 <= ftype <= 0xcf:
-                fhandle.seek(size, 1)
-                byte = fhandle.read(1)
-                while ord(byte) == 0xff:
-                    byte = fhandle.read(1)
-                ftype = ord(byte)
-                size = struct.unpack('>H', fhandle.read(2))[0] - 2
-            # We are at a SOFn block
-            fhandle.seek(1, 1)  # Skip `precision' byte.
-            height, width = struct.unpack('>HH', fhandle.read(4))
+def _jpeg_size(fhandle, buf):
+    """Walks JPEG markers in `buf` (reading more from `fhandle` if needed) up to SOFn."""
+    pos = 2
+    while True:
+        while pos + 9 > len(buf):
+            chunk = fhandle.read(PROBE_SIZE)
+            if not chunk:
+                raise RuntimeError("JPEG: SOF marker not found")
+            buf += bytearray(chunk)
+        if buf[pos] != 0xff:
+            raise RuntimeError("JPEG: Invalid marker")
+        while buf[pos] == 0xff and pos + 9 < len(buf):
+            pos += 1
+        if buf[pos] == 0xff:
+            # Fill bytes run past the buffer, read more
+            chunk = fhandle.read(PROBE_SIZE)
+            if not chunk:
+                raise RuntimeError("JPEG: SOF marker not found")
+            buf += bytearray(chunk)
+            continue
+        ftype = buf[pos]
+        if 0xc0 <= ftype <= 0xcf and ftype not in (0xc4, 0xc8, 0xcc):
+            # We are at a SOFn block, skip length and `precision' bytes
+            height, width = struct.unpack('>HH', bytes(buf[pos + 4:pos + 8]))
+            return width, height
+        size = struct.unpack('>H', bytes(buf[pos + 1:pos + 3]))[0]
+        pos += 1 + size
+
+
+def _probe_image_size(fhandle):
+    head = bytearray(fhandle.read(PROBE_SIZE))
+    if len(head) < 24:
+        raise RuntimeError("Invalid Header")
+
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        if head[12:16] != b'IHDR':
+            raise RuntimeError("PNG: Invalid check")
+        width, height = struct.unpack('>ii', bytes(head[16:24]))
+    elif head[:6] in (b'GIF87a', b'GIF89a'):
+        width, height = struct.unpack('<HH', bytes(head[6:10]))
+    elif head[:2] == b'\xff\xd8':
+        width, height = _jpeg_size(fhandle, head)
+    elif head[:4] == b'RIFF' and head[8:12] == b'WEBP' and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b'VP8 ':
+            width, height = struct.unpack('<HH', bytes(head[26:30]))
+            width, height = width & 0x3fff, height & 0x3fff
+        elif chunk == b'VP8L':
+            bits = struct.unpack('<I', bytes(head[21:25]))[0]
+            width, height = (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        elif chunk == b'VP8X':
+            width = (head[24] | head[25] << 8 | head[26] << 16) + 1
+            height = (head[27] | head[28] << 8 | head[29] << 16) + 1
         else:
-            raise RuntimeError("Unsupported format")
-        return width, height
+            raise RuntimeError("WEBP: Unsupported chunk")
+    else:
+        raise RuntimeError("Unsupported format")
+    return width, height
+
+
+def get_image_size(fname):
+    """Returns (width, height) of a PNG, GIF, JPEG or WEBP image.
+
+    The size is parsed from the file header with a single buffered read and
+    memoized per (path, mtime), so one upload probes each file only once.
+    `fname` can also be an in-memory file object, which is not memoized.
+    """
+    if hasattr(fname, 'read'):
+        fname.seek(0)
+        size = _probe_image_size(fname)
+        fname.seek(0)
+        return size
+    key = (os.path.abspath(fname), os.path.getmtime(fname))
+    if key not in _image_sizes:
+        if len(_image_sizes) >= 1024:
+            _image_sizes.clear()
+        with open(fname, 'rb') as fhandle:
+            _image_sizes[key] = _probe_image_size(fhandle)
+    return _image_sizes[key]
 
 
 def resize_image(fname):
+    """Crops and resizes an image to a compatible aspect ratio and max 1080px.
+
+    JPEGs are downscaled while decoding (`Image.draft`), EXIF rotation is a
+    lossless transpose and crop + resize is a single `resize(box=...)`.
+    Images without alpha skip the RGBA conversion and white background.
+    """
     from math import ceil
     try:
         from PIL import Image, ExifTags
@@ -192,89 +255,105 @@ def resize_image(fname):
         print("Required module `PIL` not installed\n"
               "Install with `pip install Pillow` and retry")
         return False
-    print("Analizing `{}`".format(fname))
+    utils.echo("Analizing `{}`".format(fname))
+    started = time.time()
     h_lim = {'w': 90., 'h': 47.}
     v_lim = {'w': 4., 'h': 5.}
     img = Image.open(fname)
     (w, h) = img.size
-    deg = 0
+    transpose = None
     try:
         for orientation in ExifTags.TAGS.keys():
             if ExifTags.TAGS[orientation] == 'Orientation':
                 break
         exif = dict(img._getexif().items())
         o = exif[orientation]
-        if o == 3:
-            deg = 180
-        if o == 6:
-            deg = 270
-        if o == 8:
-            deg = 90
-        if deg != 0:
-            print("Rotating by {d} degrees".format(d=deg))
-            img = img.rotate(deg, expand=True)
-            (w, h) = img.size
+        transpose = {3: Image.ROTATE_180, 6: Image.ROTATE_270, 8: Image.ROTATE_90}.get(o)
+        if transpose is not None:
+            utils.echo("Rotating by {d} degrees".format(d={3: 180, 6: 270, 8: 90}[o]))
+            if transpose != Image.ROTATE_180:
+                (w, h) = (h, w)
     except (AttributeError, KeyError, IndexError) as e:
-        print("No exif info found (ERR: {})".format(e))
+        utils.echo("No exif info found (ERR: {})".format(e))
         pass
-    img = img.convert("RGBA")
     ratio = w * 1. / h * 1.
-    print("FOUND w:{w}, h:{h}, ratio={r}".format(w=w, h=h, r=ratio))
+    utils.echo("FOUND w:{w}, h:{h}, ratio={r}".format(w=w, h=h, r=ratio))
+    box = (0, 0, w, h)
     if w > h:
-        print("Horizontal image")
+        utils.echo("Horizontal image")
         if ratio > (h_lim['w'] / h_lim['h']):
-            print("Cropping image")
+            utils.echo("Cropping image")
             cut = int(ceil((w - h * h_lim['w'] / h_lim['h']) / 2))
-            left = cut
-            right = w - cut
-            top = 0
-            bottom = h
-            img = img.crop((left, top, right, bottom))
-            (w, h) = img.size
-        if w > 1080:
-            print("Resizing image")
-            nw = 1080
-            nh = int(ceil(1080. * h / w))
-            img = img.resize((nw, nh), Image.ANTIALIAS)
+            box = (cut, 0, w - cut, h)
+        (cw, ch) = (box[2] - box[0], box[3] - box[1])
+        (nw, nh) = (cw, ch)
+        if cw > 1080:
+            utils.echo("Resizing image")
+            (nw, nh) = (1080, int(ceil(1080. * ch / cw)))
     elif w < h:
-        print("Vertical image")
+        utils.echo("Vertical image")
         if ratio < (v_lim['w'] / v_lim['h']):
-            print("Cropping image")
+            utils.echo("Cropping image")
             cut = int(ceil((h - w * v_lim['h'] / v_lim['w']) / 2))
-            left = 0
-            right = w
-            top = cut
-            bottom = h - cut
-            img = img.crop((left, top, right, bottom))
-            (w, h) = img.size
-        if h > 1080:
-            print("Resizing image")
-            nw = int(ceil(1080. * w / h))
-            nh = 1080
-            img = img.resize((nw, nh), Image.ANTIALIAS)
+            box = (0, cut, w, h - cut)
+        (cw, ch) = (box[2] - box[0], box[3] - box[1])
+        (nw, nh) = (cw, ch)
+        if ch > 1080:
+            utils.echo("Resizing image")
+            (nw, nh) = (int(ceil(1080. * cw / ch)), 1080)
     else:
-        print("Square image")
+        utils.echo("Square image")
+        (cw, ch) = (nw, nh) = (w, h)
         if w > 1080:
-            print("Resizing image")
-            img = img.resize((1080, 1080), Image.ANTIALIAS)
-    (w, h) = img.size
+            utils.echo("Resizing image")
+            (nw, nh) = (1080, 1080)
+
+    if img.format == 'JPEG' and (nw, nh) != (cw, ch):
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, but never below target
+        scale = max(nw * 1. / cw, nh * 1. / ch)
+        (sw, sh) = img.size
+        img.draft('RGB', (int(ceil(sw * scale)), int(ceil(sh * scale))))
+        (fx, fy) = (img.size[0] * 1. / sw, img.size[1] * 1. / sh)
+        if transpose in (Image.ROTATE_90, Image.ROTATE_270):
+            (fx, fy) = (fy, fx)
+        box = (box[0] * fx, box[1] * fy, box[2] * fx, box[3] * fy)
+    img.load()
+    decoded = img.size[0] * img.size[1] * len(img.getbands())
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+    if has_alpha:
+        img = img.convert("RGBA")
+    elif img.mode != 'RGB':
+        img = img.convert("RGB")
+    if transpose is not None:
+        img = img.transpose(transpose)
+    if (nw, nh) != (cw, ch):
+        img = img.resize((nw, nh), Image.LANCZOS, box=box)
+    elif box != (0, 0, w, h):
+        img = img.crop(box)
+
     new_fname = "{}.CONVERTED.jpg".format(fname)
-    print("Saving new image w:{w} h:{h} to `{f}`".format(w=w, h=h, f=new_fname))
-    new = Image.new("RGB", img.size, (255, 255, 255))
-    new.paste(img, (0, 0, w, h), img)
-    new.save(new_fname, quality=95)
+    utils.echo("Saving new image w:{w} h:{h} to `{f}`".format(w=nw, h=nh, f=new_fname))
+    if has_alpha:
+        new = Image.new("RGB", img.size, (255, 255, 255))
+        new.paste(img, (0, 0, nw, nh), img)
+        img = new
+    img.save(new_fname, quality=95)
+    utils.echo("Prepared in {t:.2f} sec, decoded {m:.1f} MB".format(
+        t=time.time() - started, m=decoded / 1024. / 1024.))
     return new_fname
 
 
-def stories_shaper(fname):
+def stories_shaper(fname, as_buffer=False):
     '''
     Find out the size of the uploaded image.
     Processing is not needed if the image is already 1080x1920 pixels.
-    Otherwise, the image height should be 1920 pixels.
-    Substrate formation: Crop the image under 1080x1920 pixels and apply a Gaussian Blur filter.
+    Otherwise, the image is fitted into 1080x1920 pixels.
+    Substrate formation: Cover 1080x1920 pixels with the image and apply a Gaussian Blur filter.
+    The blur is done on a 1/8 size copy which is then upscaled: it looks the same for a background.
     Centering the image depending on its aspect ratio and paste it onto the substrate.
-    Save the image.
+    Save the image, or return it as an in-memory JPEG buffer with `as_buffer`.
     '''
+    from math import ceil
     try:
         from PIL import Image, ImageFilter
     except ImportError as e:
@@ -283,51 +362,37 @@ def stories_shaper(fname):
               "Install with `pip install Pillow` and retry")
         return False
     img = Image.open(fname)
-    if (img.size[0], img.size[1]) == (1080, 1920):
-        print("Image is already 1080x1920. Just converting image.")
-        new_fname = "{}.STORIES.jpg".format(fname)
-        new = Image.new("RGB", (img.size[0], img.size[1]), (255, 255, 255))
-        new.paste(img, (0, 0, img.size[0], img.size[1]))
-        new.save(new_fname)
-        return new_fname
+    (w, h) = img.size
+    if (w, h) == (1080, 1920):
+        if as_buffer and img.format == 'JPEG':
+            with open(fname, 'rb') as f:
+                return BytesIO(f.read())
+        utils.echo("Image is already 1080x1920. Just converting image.")
+        img = img.convert("RGB")
     else:
-        min_width = 1080
-        min_height = 1920
-        if img.size[1] != 1920:
-            height_percent = (min_height / float(img.size[1]))
-            width_size = int((float(img.size[0]) * float(height_percent)))
-            img = img.resize((width_size, min_height), Image.ANTIALIAS)
-        else:
-            pass
-        if img.size[0] < 1080:
-            width_percent = (min_width / float(img.size[0]))
-            height_size = int((float(img.size[1]) * float(width_percent)))
-            img_bg = img.resize((min_width, height_size), Image.ANTIALIAS)
-        else:
-            pass
-        img_bg = img.crop((int((img.size[0] - 1080) / 2),
-                           int((img.size[1] - 1920) / 2),
-                           int(1080 + ((img.size[0] - 1080) / 2)),
-                           int(1920 + ((img.size[1] - 1920) / 2)))).filter(ImageFilter.GaussianBlur(100))
-        if img.size[1] > img.size[0]:
-            height_percent = (min_height / float(img.size[1]))
-            width_size = int((float(img.size[0]) * float(height_percent)))
-            img = img.resize((width_size, min_height), Image.ANTIALIAS)
-            if img.size[0] > 1080:
-                width_percent = (min_width / float(img.size[0]))
-                height_size = int((float(img.size[1]) * float(width_percent)))
-                img = img.resize((min_width, height_size), Image.ANTIALIAS)
-                img_bg.paste(img, (int(540 - img.size[0] / 2), int(960 - img.size[1] / 2)))
-            else:
-                img_bg.paste(img, (int(540 - img.size[0] / 2), 0))
-        else:
-            width_percent = (min_width / float(img.size[0]))
-            height_size = int((float(img.size[1]) * float(width_percent)))
-            img = img.resize((min_width, height_size), Image.ANTIALIAS)
-            img_bg.paste(img, (int(540 - img.size[0] / 2), int(960 - img.size[1] / 2)))
-        new_fname = "{}.STORIES.jpg".format(fname)
-        print("Saving new image w:{w} h:{h} to `{f}`".format(w=img_bg.size[0], h=img_bg.size[1], f=new_fname))
-        new = Image.new("RGB", (img_bg.size[0], img_bg.size[1]), (255, 255, 255))
-        new.paste(img_bg, (0, 0, img_bg.size[0], img_bg.size[1]))
-        new.save(new_fname)
-        return new_fname
+        # The foreground never needs more than 1080x1920 pixels
+        scale = min(1080. / w, 1920. / h)
+        img.draft('RGB', (int(ceil(w * scale)), int(ceil(h * scale))))
+        img = img.convert("RGB")
+        (w, h) = img.size
+
+        scale = max(1080. / w, 1920. / h)
+        (cw, ch) = (1080. / scale, 1920. / scale)
+        box = ((w - cw) / 2, (h - ch) / 2, (w + cw) / 2, (h + ch) / 2)
+        img_bg = img.resize((1080 // 8, 1920 // 8), Image.BOX, box=box)
+        img_bg = img_bg.filter(ImageFilter.GaussianBlur(100 / 8.))
+        img_bg = img_bg.resize((1080, 1920), Image.BILINEAR)
+
+        scale = min(1080. / w, 1920. / h)
+        size = (min(1080, int(round(w * scale))), min(1920, int(round(h * scale))))
+        img_bg.paste(img.resize(size, Image.LANCZOS), ((1080 - size[0]) // 2, (1920 - size[1]) // 2))
+        img = img_bg
+    if as_buffer:
+        buf = BytesIO()
+        img.save(buf, 'JPEG')
+        buf.seek(0)
+        return buf
+    new_fname = "{}.STORIES.jpg".format(fname)
+    utils.echo("Saving new image w:{w} h:{h} to `{f}`".format(w=img.size[0], h=img.size[1], f=new_fname))
+    img.save(new_fname)
+    return new_fname
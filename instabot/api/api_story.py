@@ -1,12 +1,13 @@
 from __future__ import unicode_literals
 import os
-import shutil
 import time
+from io import BytesIO
 from random import randint
-from requests_toolbelt import MultipartEncoder
 import json
 
 from . import config
+from .api_download import media_key
+from .api_media import file_checksum
 from .api_photo import stories_shaper, get_image_size
 
 
@@ -15,26 +16,26 @@ def download_story(self, filename, story_url, username):
     if not os.path.exists(path):
         os.makedirs(path)
     fname = os.path.join(path, filename)
-    if os.path.exists(fname):  # already exists
-        self.logger.info("Stories already downloaded...")
-        return os.path.abspath(fname)
-    response = self.session.get(story_url, stream=True)
-    if response.status_code == 200:
-        with open(fname, 'wb') as f:
-            response.raw.decode_content = True
-            shutil.copyfileobj(response.raw, f)
-        return os.path.abspath(fname)
+    # The CDN asset name identifies the story, whatever the username is now
+    key = media_key('story', os.path.splitext(filename)[0])
+    return self.downloader.download([(story_url, fname, key)], progress=False)[fname]
 
 
 def upload_story_photo(self, photo, upload_id=None):
     if upload_id is None:
         upload_id = str(int(time.time() * 1000))
-    photo = stories_shaper(photo)
-    if not photo:
-        return False
-
-    with open(photo, 'rb') as f:
-        photo_bytes = f.read()
+    checksum = file_checksum(photo)
+    prepared = self.media_cache.get(checksum, 'story') if self.use_media_cache else None
+    if prepared:
+        with open(prepared, 'rb') as f:
+            photo = BytesIO(f.read())
+    else:
+        photo = stories_shaper(photo, as_buffer=True)
+        if not photo:
+            return False
+        if self.use_media_cache:
+            self.media_cache.put_data(checksum, 'story', photo.getvalue())
+    photo_bytes = photo.getvalue()
 
     data = {
         'upload_id': upload_id,
@@ -43,6 +44,7 @@ def upload_story_photo(self, photo, upload_id=None):
         'image_compression': '{"lib_name":"jt","lib_version":"1.3.0","quality":"87"}',
         'photo': ('pending_media_%s.jpg' % upload_id, photo_bytes, 'application/octet-stream', {'Content-Transfer-Encoding': 'binary'})
     }
+    from requests_toolbelt import MultipartEncoder  # imported on the first upload
     m = MultipartEncoder(data, boundary=self.uuid)
     self.session.headers.update({'X-IG-Capabilities': '3Q4=',
                                  'X-IG-Connection-Type': 'WIFI',
@@ -52,8 +54,8 @@ def upload_story_photo(self, photo, upload_id=None):
                                  'Content-type': m.content_type,
                                  'Connection': 'close',
                                  'User-Agent': self.user_agent})
-    response = self.session.post(
-        config.API_URL + "upload/photo/", data=m.to_string())
+    response = self.metrics.request(
+        self.session, 'POST', config.API_URL + "upload/photo/", data=m.to_string())
 
     if response.status_code == 200:
         upload_id = json.loads(response.text).get('upload_id')
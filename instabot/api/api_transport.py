@@ -0,0 +1,219 @@
+"""
+    Record / replay transport of the `API` session.
+
+    `RecordingAdapter` saves every request and response (method, url,
+    endpoint, query params, request size, status, headers, body and time)
+    to a gzip compressed cassette of json lines during a real run.
+    `ReplayAdapter` then answers the same requests from the cassette, with
+    no network: the responses of a request are served in the recorded
+    order (the last one again when they run out), optionally after a
+    simulated latency. Workflows can be profiled offline on identical,
+    real-shaped traffic.
+
+    Requests are matched by method, host, path and the query params that
+    don't change between runs (`VOLATILE_PARAMS` are ignored). A request
+    that was not recorded raises `CassetteMiss`, a `requests.ConnectionError`,
+    which the API handles like a network error.
+
+    Usage:
+        api.start_recording('run.jsonl.gz')
+        ...
+        api.stop_transport()
+
+        api.start_replay('run.jsonl.gz', latency='recorded')
+"""
+from __future__ import unicode_literals
+
+import base64
+import gzip
+import io
+import json
+import threading
+import time
+
+import requests
+import six.moves.urllib as urllib
+from requests.packages.urllib3 import HTTPResponse
+from requests.packages.urllib3._collections import HTTPHeaderDict
+
+from .api_metrics import TimedHTTPAdapter, body_size, normalize_endpoint
+
+VOLATILE_PARAMS = ('rank_token', 'uuid', '_uuid', '_csrftoken', 'signed_body', 'ig_sig_key_version')
+# Hop-by-hop headers, meaningless for a body served from memory
+SKIPPED_HEADERS = ('transfer-encoding', 'connection')
+
+
+class CassetteMiss(requests.ConnectionError):
+    pass
+
+
+def request_key(method, url):
+    parsed = urllib.parse.urlparse(url)
+    params = sorted((key, value) for key, value in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+                    if key not in VOLATILE_PARAMS)
+    return '{} {}{}?{}'.format(method.upper(), parsed.netloc, parsed.path, urllib.parse.urlencode(params))
+
+
+def read_cassette(fname):
+    """Yields the recorded interactions of a cassette."""
+    with gzip.open(fname, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line.decode('utf8'))
+
+
+class _Headers(object):
+    """Set-Cookie headers, where `requests` reads them from"""
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def get_all(self, name, default=None):
+        values = self.headers.getlist(name)
+        return values or default
+
+    def getheaders(self, name):
+        return self.headers.getlist(name)
+
+
+class _OriginalResponse(object):
+
+    def __init__(self, headers, method):
+        self.msg = _Headers(headers)
+        self._method = method
+
+    def isclosed(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def _raw_response(status, headers, body, method):
+    headers = HTTPHeaderDict(headers)
+    raw = HTTPResponse(body=io.BytesIO(body), headers=headers, status=status,
+                       preload_content=False, decode_content=False)
+    raw._original_response = _OriginalResponse(headers, method)
+    return raw
+
+
+class RecordingAdapter(TimedHTTPAdapter):
+    """Sends the requests and appends every interaction to the cassette `fname`."""
+
+    def __init__(self, fname, *args, **kwargs):
+        super(RecordingAdapter, self).__init__(*args, **kwargs)
+        self.fname = fname
+        self.f = gzip.open(fname, 'ab')
+        self._lock = threading.Lock()
+
+    def send(self, request, stream=False, **kwargs):
+        started = time.time()
+        response = super(RecordingAdapter, self).send(request, stream=stream, **kwargs)
+        # The raw (still encoded) body, read once and served again from memory
+        body = response.raw.read(decode_content=False)
+        elapsed = time.time() - started
+        headers = [(key, value) for key, value in response.raw.headers.iteritems()
+                   if key.lower() not in SKIPPED_HEADERS]
+        self.save(request, response.status_code, headers, body, elapsed)
+        raw = _raw_response(response.status_code, headers, body, request.method)
+        return self.build_response(request, raw)
+
+    def save(self, request, status, headers, body, elapsed):
+        parsed = urllib.parse.urlparse(request.url)
+        interaction = {
+            'key': request_key(request.method, request.url),
+            'method': request.method,
+            'url': request.url,
+            'endpoint': normalize_endpoint(request.url),
+            'params': dict(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)),
+            'request_size': body_size(request.body),
+            'status': status,
+            'headers': headers,
+            'elapsed': elapsed,
+        }
+        try:
+            interaction['body'] = body.decode('utf8')
+        except UnicodeDecodeError:
+            interaction['body_base64'] = base64.b64encode(body).decode('ascii')
+        line = json.dumps(interaction, sort_keys=True).encode('utf8') + b'\n'
+        with self._lock:
+            self.f.write(line)
+
+    def close(self):
+        with self._lock:
+            if not self.f.closed:
+                self.f.close()
+        super(RecordingAdapter, self).close()
+
+
+class ReplayAdapter(TimedHTTPAdapter):
+    """
+        Answers requests from the cassette `fname`, without network.
+
+        @param latency  None, seconds slept before every response (Float),
+                        or 'recorded' to sleep as long as the recorded request took
+    """
+
+    def __init__(self, fname, latency=None, *args, **kwargs):
+        super(ReplayAdapter, self).__init__(*args, **kwargs)
+        self.fname = fname
+        self.latency = latency
+        self.interactions = {}
+        for interaction in read_cassette(fname):
+            self.interactions.setdefault(interaction['key'], []).append(interaction)
+        self.served = {}
+        self._lock = threading.Lock()
+
+    def next_interaction(self, request):
+        key = request_key(request.method, request.url)
+        with self._lock:
+            recorded = self.interactions.get(key)
+            if not recorded:
+                raise CassetteMiss("Not in the cassette: {}".format(key), request=request)
+            index = self.served.get(key, 0)
+            self.served[key] = index + 1
+        return recorded[min(index, len(recorded) - 1)]
+
+    def send(self, request, stream=False, **kwargs):
+        interaction = self.next_interaction(request)
+        delay = interaction['elapsed'] if self.latency == 'recorded' else self.latency
+        if delay:
+            time.sleep(delay)
+        if 'body_base64' in interaction:
+            body = base64.b64decode(interaction['body_base64'])
+        else:
+            body = interaction['body'].encode('utf8')
+        raw = _raw_response(interaction['status'], interaction['headers'], body, request.method)
+        return self.build_response(request, raw)
+
+
+class Transport(object):
+    """A record or replay adapter mounted on every session given to `mount`."""
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+
+    @classmethod
+    def recording(cls, fname):
+        return cls(RecordingAdapter(fname))
+
+    @classmethod
+    def replay(cls, fname, latency=None):
+        return cls(ReplayAdapter(fname, latency))
+
+    def mount(self, session):
+        if session is not None and session.get_adapter('https://') is not self.adapter:
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+        return session
+
+    def unmount(self, session):
+        """Back to a plain adapter on `session`."""
+        if session is not None and session.get_adapter('https://') is self.adapter:
+            adapter = TimedHTTPAdapter()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+    def close(self):
+        self.adapter.close()
@@ -1,19 +1,24 @@
 # -*- coding: utf-8 -*-
 import copy
+import hashlib
 import json
 import os
 import re
-import shutil
 import subprocess
 import time
 
-from requests_toolbelt import MultipartEncoder
-
 from . import config
+from .. import utils
+from .api_download import media_key, media_pk
+
+UPLOAD_JOURNAL = 'video_uploads.json'
 
 
 def download_video(self, media_id, filename=None, media=False, folder='videos'):
     video_urls = []
+    paths = self.downloader.index.media_paths(media.get('pk') if media else media_id, 'video')
+    if paths:
+        return paths[-1]
     if not media:
         self.media_info(media_id)
         media = self.last_json['items'][0]
@@ -21,27 +26,24 @@ def download_video(self, media_id, filename=None, media=False, folder='videos'):
 
     try:
         clips = media['video_versions']
-        video_urls.append(clips[0]['url'])
+        video_urls.append((0, clips[0]['url']))
     except KeyError:
         carousels = media.get('carousel_media', [])
-        for carousel in carousels:
-            video_urls.append(carousel['video_versions'][0]['url'])
+        for index, carousel in enumerate(carousels):
+            if carousel.get('video_versions'):
+                video_urls.append((index, carousel['video_versions'][0]['url']))
     except Exception:
         return False
 
-    fname = os.path.join(folder, filename)
-    if os.path.exists(fname):
-        return os.path.abspath(fname)
-
-    for counter, video_url in enumerate(video_urls):
-        response = self.session.get(video_url, stream=True)
-        if response.status_code == 200:
-            fname = os.path.join(folder, '{}_{}'.format(counter, filename))
-            with open(fname, 'wb') as f:
-                response.raw.decode_content = True
-                shutil.copyfileobj(response.raw, f)
-
-    return os.path.abspath(fname)
+    pk = media.get('pk') or media_pk(media_id)
+    jobs = [(video_url, os.path.join(folder, '{}_{}'.format(counter, filename)), media_key('video', pk, index))
+            for counter, (index, video_url) in enumerate(video_urls)]
+    results = list(self.downloader.download(jobs, progress=False).values())
+    if jobs and all(results):
+        self.downloader.index.add_media(pk, results, 'video')
+        self.downloader.index.save()
+    results = [path for path in results if path]
+    return results[-1] if results else False
 
 
 # leaving here function used by old upload_video, no more used now
@@ -70,33 +72,49 @@ def get_video_info(filename):
     return res
 
 
-def upload_video(self, video, caption=None, upload_id=None, thumbnail=None, options={}):
-    """Upload video to Instagram
+def load_upload_journal(self):
+    """Returns the video upload journal: `upload_id` -> acknowledged ranges."""
+    fname = os.path.join(self.base_path, UPLOAD_JOURNAL)
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
 
-    @param video      Path to video file (String)
-    @param caption    Media description (String)
-    @param upload_id  Unique upload_id (String). When None, then generate automatically
-    @param thumbnail  Path to thumbnail for video (String). When None, then thumbnail is generate automatically
-    @param options    Object with difference options, e.g. configure_timeout, rename_thumbnail, rename (Dict)
-                      Designed to reduce the number of function arguments!
-                      This is the simplest request object.
 
-    @return           Object with state of uploading to Instagram (or False)
-    """
-    options = dict({
-        'configure_timeout': 15,
-        'rename_thumbnail': True,
-        'rename': True
-    }, **(options or {}))
-    if upload_id is None:
-        upload_id = str(int(time.time() * 1000))
-    video, thumbnail, width, height, duration = resize_video(video, thumbnail)
+def save_upload_journal(self, journal):
+    fname = os.path.join(self.base_path, UPLOAD_JOURNAL)
+    utils.atomic_write(fname, json.dumps(journal))
+
+
+def find_upload(journal, checksum, upload_id=None):
+    """Finds an unfinished upload of the video with the same content."""
+    if upload_id is not None:
+        entry = journal.get(str(upload_id))
+        return entry if entry and entry['checksum'] == checksum else None
+    for entry in journal.values():
+        if entry['checksum'] == checksum:
+            return entry
+    return None
+
+
+def get_video_segments(size, parts=4):
+    """Splits `size` bytes into `parts` (start, end) ranges, `end` exclusive."""
+    # solve issue #85 TypeError: slice indices must be integers or None or have an __index__ method
+    request_size = size // parts
+    segments = [(i * request_size, (i + 1) * request_size) for i in range(parts - 1)]
+    segments.append(((parts - 1) * request_size, size))
+    return segments
+
+
+def request_video_upload(self, upload_id):
     data = {
         'upload_id': upload_id,
         '_csrftoken': self.token,
         'media_type': '2',
         '_uuid': self.uuid,
     }
+    from requests_toolbelt import MultipartEncoder  # imported on the first upload
     m = MultipartEncoder(data, boundary=self.uuid)
     self.session.headers.update({'X-IG-Capabilities': '3Q4=',
                                  'X-IG-Connection-Type': 'WIFI',
@@ -107,59 +125,148 @@ def upload_video(self, video, caption=None, upload_id=None, thumbnail=None, opti
                                  'Content-type': m.content_type,
                                  'Connection': 'keep-alive',
                                  'User-Agent': self.user_agent})
-    response = self.session.post(config.API_URL + "upload/video/", data=m.to_string())
-    if response.status_code == 200:
-        body = json.loads(response.text)
-        upload_url = body['video_upload_urls'][3]['url']
-        upload_job = body['video_upload_urls'][3]['job']
-
-        with open(video, 'rb') as video_bytes:
-            video_data = video_bytes.read()
-        # solve issue #85 TypeError: slice indices must be integers or None or have an __index__ method
-        request_size = len(video_data) // 4
-        last_request_extra = len(video_data) - 3 * request_size
-
-        headers = copy.deepcopy(self.session.headers)
-        self.session.headers.update({
-            'X-IG-Capabilities': '3Q4=',
-            'X-IG-Connection-Type': 'WIFI',
-            'Cookie2': '$Version=1',
-            'Accept-Language': 'en-US',
-            'Accept-Encoding': 'gzip, deflate',
-            'Content-type': 'application/octet-stream',
-            'Session-ID': upload_id,
-            'Connection': 'keep-alive',
-            'Content-Disposition': 'attachment; filename="video.mov"',
-            'job': upload_job,
-            'Host': 'upload.instagram.com',
-            'User-Agent': self.user_agent
-        })
-        for i in range(4):
-            start = i * request_size
-            if i == 3:
-                end = i * request_size + last_request_extra
-            else:
-                end = (i + 1) * request_size
-            length = last_request_extra if i == 3 else request_size
+    response = self.metrics.request(self.session, 'POST', config.API_URL + "upload/video/", data=m.to_string())
+    if response.status_code != 200:
+        return None
+    body = json.loads(response.text)
+    return {
+        'upload_id': upload_id,
+        'url': body['video_upload_urls'][3]['url'],
+        'job': body['video_upload_urls'][3]['job'],
+        'acked': [],
+    }
+
+
+def upload_video_segments(self, entry, video_data, journal, retries=3):
+    """Posts every segment not yet acknowledged for `entry`.
+
+    Each acknowledged range is written to the journal right away, so an
+    interrupted upload can be resumed later with the same `upload_id`.
+    Returns True only when all the segments were acknowledged.
+    """
+    headers = copy.deepcopy(self.session.headers)
+    self.session.headers.update({
+        'X-IG-Capabilities': '3Q4=',
+        'X-IG-Connection-Type': 'WIFI',
+        'Cookie2': '$Version=1',
+        'Accept-Language': 'en-US',
+        'Accept-Encoding': 'gzip, deflate',
+        'Content-type': 'application/octet-stream',
+        'Session-ID': entry['upload_id'],
+        'Connection': 'keep-alive',
+        'Content-Disposition': 'attachment; filename="video.mov"',
+        'job': entry['job'],
+        'Host': 'upload.instagram.com',
+        'User-Agent': self.user_agent
+    })
+    try:
+        for start, end in get_video_segments(len(video_data)):
+            if [start, end] in entry['acked']:
+                continue
             content_range = "bytes {start}-{end}/{len_video}".format(
                 start=start, end=end - 1, len_video=len(video_data)).encode('utf-8')
-
             self.session.headers.update({'Content-Length': str(end - start), 'Content-Range': content_range})
-            response = self.session.post(upload_url, data=video_data[start:start + length])
+            for attempt in range(retries):
+                try:
+                    response = self.metrics.request(self.session, 'POST', entry['url'],
+                                                    retries=attempt, data=video_data[start:end])
+                except Exception as e:
+                    self.logger.warning(str(e))
+                    continue
+                if response.status_code == 200:
+                    entry['acked'].append([start, end])
+                    save_upload_journal(self, journal)
+                    break
+                self.logger.warning("Video segment {}-{} returns {} error.".format(
+                    start, end - 1, response.status_code))
+            else:
+                return False
+    finally:
         self.session.headers = headers
+    return True
+
+
+def upload_video(self, video, caption=None, upload_id=None, thumbnail=None, options={}):
+    """Upload video to Instagram
 
-        configure_timeout = options.get('configure_timeout')
-        if response.status_code == 200:
-            for attempt in range(4):
-                if configure_timeout:
-                    time.sleep(configure_timeout)
-                if self.configure_video(upload_id, video, thumbnail, width, height, duration, caption, options=options):
-                    media = self.last_json.get('media')
-                    self.expose()
-                    if options.get('rename'):
-                        from os import rename
-                        rename(video, "{}.REMOVE_ME".format(video))
-                    return media
+    @param video      Path to video file (String)
+    @param caption    Media description (String)
+    @param upload_id  Unique upload_id (String). When None, then generate automatically
+    @param thumbnail  Path to thumbnail for video (String). When None, then thumbnail is generate automatically
+    @param options    Object with difference options, e.g. configure_timeout, rename_thumbnail, rename, resume, prepared,
+                      preset, threads (Dict)
+                      Designed to reduce the number of function arguments!
+                      This is the simplest request object.
+                      With `resume` the segments already acknowledged for the
+                      same video (or `upload_id`) are not sent again.
+                      `prepared` is the (video, thumbnail, width, height, duration)
+                      result of `prepare_media_batch`: the video is not resized again.
+                      `preset` and `threads` are passed to the `ffmpeg` encoder.
+
+    @return           Object with state of uploading to Instagram (or False)
+    """
+    options = dict({
+        'configure_timeout': 15,
+        'rename_thumbnail': True,
+        'rename': True,
+        'resume': True
+    }, **(options or {}))
+    source = video
+    if options.get('prepared'):
+        prepared = options['prepared']
+    else:
+        knobs = {key: options[key] for key in ('preset', 'threads') if key in options}
+        prepared = self.prepare_media(video, 'video', **knobs)
+        if not prepared:
+            return False
+    video, prepared_thumbnail, width, height, duration = prepared
+    if not thumbnail:
+        thumbnail = prepared_thumbnail
+        if self.use_media_cache:
+            # Keep the cached thumbnail for the next upload of this video
+            options['rename_thumbnail'] = False
+    with open(video, 'rb') as video_bytes:
+        video_data = video_bytes.read()
+    checksum = hashlib.sha1(video_data).hexdigest()
+
+    journal = load_upload_journal(self)
+    entry = None
+    if options.get('resume'):
+        entry = find_upload(journal, checksum, upload_id)
+    if entry is not None:
+        self.logger.info("Resuming upload {}: {} of 4 segments already sent.".format(
+            entry['upload_id'], len(entry['acked'])))
+        if not upload_video_segments(self, entry, video_data, journal):
+            # The upload url may be expired, start over
+            journal.pop(entry['upload_id'], None)
+            entry = None
+    if entry is None:
+        if upload_id is None or str(upload_id) in journal:
+            upload_id = str(int(time.time() * 1000))
+        entry = request_video_upload(self, str(upload_id))
+        if entry is None:
+            return False
+        entry['checksum'] = checksum
+        journal[entry['upload_id']] = entry
+        save_upload_journal(self, journal)
+        if not upload_video_segments(self, entry, video_data, journal):
+            self.logger.error("Video upload {} is interrupted, it can be resumed.".format(entry['upload_id']))
+            return False
+    upload_id = entry['upload_id']
+
+    configure_timeout = options.get('configure_timeout')
+    for attempt in range(4):
+        if configure_timeout:
+            time.sleep(configure_timeout)
+        if self.configure_video(upload_id, video, thumbnail, width, height, duration, caption, options=options):
+            media = self.last_json.get('media')
+            self.expose()
+            journal.pop(upload_id, None)
+            save_upload_journal(self, journal)
+            if options.get('rename'):
+                from os import rename
+                rename(source, "{}.REMOVE_ME".format(source))
+            return media
     return False
 
 
@@ -205,7 +312,114 @@ def configure_video(self, upload_id, video, thumbnail, width, height, duration,
     return self.send_request('media/configure/?video=1', data)
 
 
-def resize_video(fname, thumbnail=None):
+def which(program):
+    try:
+        from shutil import which
+    except ImportError:  # Python 2
+        from distutils.spawn import find_executable as which
+    return which(program)
+
+
+def probe_video(fname):
+    """Returns (width, height, rotation, duration) of the first video stream, using `ffprobe`."""
+    output = subprocess.check_output([
+        'ffprobe', '-v', 'error', '-print_format', 'json',
+        '-select_streams', 'v:0', '-show_streams', '-show_format', fname])
+    info = json.loads(output.decode('utf-8'))
+    stream = info['streams'][0]
+    rotation = int(float(stream.get('tags', {}).get('rotate', 0)))
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            rotation = int(float(side_data['rotation']))
+    duration = float(stream.get('duration') or info['format']['duration'])
+    return int(stream['width']), int(stream['height']), rotation % 360, duration
+
+
+def resize_video(fname, thumbnail=None, preset='veryfast', threads=0):
+    """Crops, scales and cuts the video to 30 sec and makes a thumbnail.
+
+    Uses a single `ffmpeg` run when `ffmpeg` and `ffprobe` are installed,
+    otherwise falls back to `moviepy`.
+
+    @param preset   x264 preset of `ffmpeg`, from 'ultrafast' to 'veryslow' (String)
+    @param threads  Number of `ffmpeg` encoding threads, 0 is automatic (Integer)
+
+    @return         (new_fname, thumbnail, width, height, duration) or False
+    """
+    if which('ffmpeg') and which('ffprobe'):
+        return resize_video_ffmpeg(fname, thumbnail, preset, threads)
+    return resize_video_moviepy(fname, thumbnail)
+
+
+def resize_video_ffmpeg(fname, thumbnail=None, preset='veryfast', threads=0):
+    from math import ceil
+    utils.echo("Analizing `{}`".format(fname))
+    h_lim = {'w': 90., 'h': 47.}
+    v_lim = {'w': 4., 'h': 5.}
+    d_lim = 30
+    (w, h, deg, duration) = probe_video(fname)
+    if deg in (90, 270):
+        # ffmpeg rotates the frames before the filters
+        (w, h) = (h, w)
+    ratio = w * 1. / h * 1.
+    utils.echo("FOUND w:{w}, h:{h}, rotation={d}, ratio={r}".format(w=w, h=h, r=ratio, d=deg))
+    filters = []
+    if w > h:
+        utils.echo("Horizontal video")
+        if ratio > (h_lim['w'] / h_lim['h']):
+            utils.echo("Cropping video")
+            cut = int(ceil((w - h * h_lim['w'] / h_lim['h']) / 2))
+            w = w - 2 * cut
+            filters.append('crop={}:{}:{}:0'.format(w, h, cut))
+        if w > 1080:
+            utils.echo("Resizing video")
+            (w, h) = (1080, int(round(1080. * h / w)))
+    elif w < h:
+        utils.echo("Vertical video")
+        if ratio < (v_lim['w'] / v_lim['h']):
+            utils.echo("Cropping video")
+            cut = int(ceil((h - w * v_lim['h'] / v_lim['w']) / 2))
+            h = h - 2 * cut
+            filters.append('crop={}:{}:0:{}'.format(w, h, cut))
+        if h > 1080:
+            utils.echo("Resizing video")
+            (w, h) = (int(round(1080. * w / h)), 1080)
+    else:
+        utils.echo("Square video")
+        if w > 1080:
+            utils.echo("Resizing video")
+            (w, h) = (1080, 1080)
+    # libx264 with yuv420p needs even dimensions
+    (w, h) = (w - w % 2, h - h % 2)
+    filters.append('scale={}:{}'.format(w, h))
+    if duration > d_lim:
+        utils.echo("Cutting video to {} sec from start".format(d_lim))
+        duration = d_lim
+    new_fname = "{}.CONVERTED.mp4".format(fname)
+    utils.echo("Saving new video w:{w} h:{h} to `{f}`".format(w=w, h=h, f=new_fname))
+    command = ['ffmpeg', '-y', '-v', 'error', '-i', fname]
+    make_thumbnail = not thumbnail
+    if make_thumbnail:
+        utils.echo("Generating thumbnail...")
+        thumbnail = "{}.jpg".format(fname)
+        command += ['-filter_complex', '[0:v]{},split=2[video][thumbnail]'.format(','.join(filters)),
+                    '-map', '[video]']
+    else:
+        command += ['-filter_complex', '[0:v]{}[video]'.format(','.join(filters)), '-map', '[video]']
+    command += ['-map', '0:a?', '-t', str(d_lim),
+                '-c:v', 'libx264', '-preset', preset, '-threads', str(threads), '-pix_fmt', 'yuv420p',
+                '-c:a', 'aac', '-movflags', '+faststart', new_fname]
+    if make_thumbnail:
+        command += ['-map', '[thumbnail]', '-ss', str(duration / 2.), '-frames:v', '1', thumbnail]
+    try:
+        subprocess.check_call(command)
+    except subprocess.CalledProcessError as e:
+        print("ERROR: {}".format(e))
+        return False
+    return new_fname, thumbnail, w, h, duration
+
+
+def resize_video_moviepy(fname, thumbnail=None):
     from math import ceil
     try:
         import moviepy.editor as mp
@@ -217,7 +431,7 @@ def resize_video(fname, thumbnail=None):
               "pip install --upgrade setuptools\n"
               "pip install numpy --upgrade --ignore-installed")
         return False
-    print("Analizing `{}`".format(fname))
+    utils.echo("Analizing `{}`".format(fname))
     h_lim = {'w': 90., 'h': 47.}
     v_lim = {'w': 4., 'h': 5.}
     d_lim = 30
@@ -225,11 +439,11 @@ def resize_video(fname, thumbnail=None):
     (w, h) = vid.size
     deg = vid.rotation
     ratio = w * 1. / h * 1.
-    print("FOUND w:{w}, h:{h}, rotation={d}, ratio={r}".format(w=w, h=h, r=ratio, d=deg))
+    utils.echo("FOUND w:{w}, h:{h}, rotation={d}, ratio={r}".format(w=w, h=h, r=ratio, d=deg))
     if w > h:
-        print("Horizontal video")
+        utils.echo("Horizontal video")
         if ratio > (h_lim['w'] / h_lim['h']):
-            print("Cropping video")
+            utils.echo("Cropping video")
             cut = int(ceil((w - h * h_lim['w'] / h_lim['h']) / 2))
             left = cut
             right = w - cut
@@ -238,12 +452,12 @@ def resize_video(fname, thumbnail=None):
             vid = vid.crop(x1=left, y1=top, x2=right, y2=bottom)
             (w, h) = vid.size
         if w > 1080:
-            print("Resizing video")
+            utils.echo("Resizing video")
             vid = vid.resize(width=1080)
     elif w < h:
-        print("Vertical video")
+        utils.echo("Vertical video")
         if ratio < (v_lim['w'] / v_lim['h']):
-            print("Cropping video")
+            utils.echo("Cropping video")
             cut = int(ceil((h - w * v_lim['h'] / v_lim['w']) / 2))
             left = 0
             right = w
@@ -252,22 +466,22 @@ def resize_video(fname, thumbnail=None):
             vid = vid.crop(x1=left, y1=top, x2=right, y2=bottom)
             (w, h) = vid.size
         if h > 1080:
-            print("Resizing video")
+            utils.echo("Resizing video")
             vid = vid.resize(height=1080)
     else:
-        print("Square video")
+        utils.echo("Square video")
         if w > 1080:
-            print("Resizing video")
+            utils.echo("Resizing video")
             vid = vid.resize(width=1080)
     (w, h) = vid.size
     if vid.duration > d_lim:
-        print("Cutting video to {} sec from start".format(d_lim))
+        utils.echo("Cutting video to {} sec from start".format(d_lim))
         vid = vid.subclip(0, d_lim)
     new_fname = "{}.CONVERTED.mp4".format(fname)
-    print("Saving new video w:{w} h:{h} to `{f}`".format(w=w, h=h, f=new_fname))
+    utils.echo("Saving new video w:{w} h:{h} to `{f}`".format(w=w, h=h, f=new_fname))
     vid.write_videofile(new_fname, codec="libx264", audio_codec="aac")
     if not thumbnail:
-        print("Generating thumbnail...")
+        utils.echo("Generating thumbnail...")
         thumbnail = "{}.jpg".format(fname)
         vid.save_frame(thumbnail, t=(vid.duration / 2))
     return new_fname, thumbnail, w, h, vid.duration
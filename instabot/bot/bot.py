@@ -6,7 +6,8 @@ import signal
 import time
 
 from .. import utils
-from ..api import API
+from ..api import API, api_logging
+from ..profiling import PROFILER, RunProfiler, timed
 from .bot_archive import archive, archive_medias, unarchive_medias
 from .bot_block import block, block_bots, block_users, unblock, unblock_users
 from .bot_checkpoint import load_checkpoint, save_checkpoint
@@ -46,13 +47,15 @@ from .bot_get import (
     get_user_stories, get_user_reel, get_self_story_viewers,
     get_pending_follow_requests, get_pending_thread_requests
 )
+from .bot_journal import Journal, record_action
 from .bot_like import (
     like, like_comment, like_followers, like_following,
     like_geotag, like_hashtag, like_media_comments,
     like_medias, like_timeline, like_user, like_users, like_location_feed
 )
-from .bot_photo import download_photo, download_photos, upload_photo
-from .bot_stats import save_user_stats
+from .bot_photo import download_photo, download_photos, prepare_media_batch, upload_photo
+from .bot_shared import SharedState, acquire_limit, release_limits
+from .bot_stats import collect_user_stats, save_user_stats
 from .bot_support import (
     check_if_file_exists, console_print, extract_urls,
     read_list_from_file
@@ -119,9 +122,21 @@ class Bot(object):
         blacklist_hashtags=['#shop', '#store', '#free'],
         blocked_actions_protection=True,
         verbosity=True,
-        device=None
+        device=None,
+        profile=False,
+        log_filename='instabot.log',
+        quiet=None,
+        log_level=None,
+        journal_file=None,
+        journal_sync_every=100,
+        checkpoint_interval=60,
+        shared_state=None
     ):
-        self.api = API(device=device, base_path=base_path)
+        # `quiet`: no progress bars, colors or messages, for headless runs.
+        # Like `log_level`, it switches the whole process (see utils.set_quiet).
+        if quiet is not None:
+            utils.set_quiet(quiet)
+        self.api = API(device=device, base_path=base_path, log_filename=log_filename)
         self.base_path = base_path
 
         self.total = {
@@ -224,12 +239,41 @@ class Bot(object):
         self.blacklist_file = utils.file(blacklist_file)
         self.whitelist_file = utils.file(whitelist_file)
 
+        # Journal of the actions, e.g. journal_file='actions.jsonl' (see bot_journal)
+        self.journal = None
+        if journal_file is not None:
+            self.journal = Journal(os.path.join(base_path, journal_file), sync_every=journal_sync_every)
+
+        # Checkpoint of the state, saved after actions (see bot_checkpoint)
+        self._checkpoints = None
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = 0
+
+        # Budget, delays and blocked actions shared with the other processes
+        # of the account, e.g. shared_state='<username>.db' (see bot_shared)
+        self.shared = None
+        self._reserved = {}  # key -> self.total[key] when an action was reserved
+        if shared_state is not None:
+            self.shared = SharedState(os.path.join(base_path, shared_state))
+
         self.proxy = proxy
         self.verbosity = verbosity
 
         self.logger = self.api.logger
+        if log_level is not None:
+            self.set_log_level(log_level)
         self.logger.info('Instabot Started')
 
+        # cProfile (`profile=True` or 'cprofile') or 'pyinstrument' (cProfile when it
+        # is not installed) of the whole run, saved on `logout`, `stop_profile` or at exit
+        self.run_profiler = None
+        if profile:
+            kind = 'pyinstrument' if profile == 'pyinstrument' else 'cprofile'
+            fname = os.path.join(base_path, 'instabot.html' if kind == 'pyinstrument' else 'instabot.prof')
+            self.run_profiler = RunProfiler(kind, fname)
+            self.run_profiler.start()
+            atexit.register(self.stop_profile)
+
     @property
     def user_id(self):
         # For compatibility
@@ -283,18 +327,19 @@ class Bot(object):
         return self._followers
 
     def version(self):
-        try:
-            from pip._vendor import pkg_resources
-        except ImportError:
-            import pkg_resources
-        return next((p.version for p in pkg_resources.working_set if p.project_name.lower() == 'instabot'), "No match")
+        return utils.package_version() or "No match"
 
     def logout(self, *args, **kwargs):
-        save_checkpoint(self)
+        if self.shared is not None:
+            release_limits(self)
+        save_checkpoint(self, full=True)
+        if self.journal is not None:
+            self.journal.close()
         self.api.logout()
         self.logger.info("Bot stopped. "
                          "Worked: %s", datetime.datetime.now() - self.start_time)
         self.print_counters()
+        self.stop_profile()
 
     def login(self, **args):
         if self.proxy:
@@ -307,9 +352,14 @@ class Bot(object):
         return True
 
     def prepare(self):
-        storage = load_checkpoint(self)
-        if storage is not None:
-            self.total, self.blocked_actions, self.api.total_requests, self.start_time = storage
+        load_checkpoint(self)
+
+    def checkpoint(self):
+        """Saves the changes of the state, if `checkpoint_interval` seconds passed since the last save."""
+        now = time.time()
+        if getattr(self.api, 'username', None) and now - self.last_checkpoint >= self.checkpoint_interval:
+            self.last_checkpoint = now
+            save_checkpoint(self)
 
     def print_counters(self):
         for key, val in self.total.items():
@@ -320,9 +370,33 @@ class Bot(object):
             if val:
                 self.logger.info("Blocked {}".format(key))
         self.logger.info("Total requests: {}".format(self.api.total_requests))
-
+        for row in self.api.metrics.summary(sort_by='time', limit=5):
+            self.logger.info("  {method} {endpoint}: {count} requests, {time:.1f}s, "
+                             "{bytes_in} bytes in, {errors} errors".format(**row))
+        self.api.metrics.flush()
+        for line in PROFILER.format_report():
+            self.logger.info(line)
+
+    def stop_profile(self):
+        """Stops the profiler of `Bot(profile=...)` and saves its output."""
+        if self.run_profiler is not None:
+            fname = self.run_profiler.stop()
+            if fname:
+                self.logger.info("Profile saved to {}".format(fname))
+
+    def set_log_level(self, level, console=True, files=True):
+        """Switches the log level, e.g. to 'WARNING', of the console and/or the log files, for every bot of the process."""
+        api_logging.set_level(level, console, files)
+
+    @timed(category='sleep')
     def delay(self, key):
         """Sleep only if elapsed time since `self.last[key]` < `self.delay[key]`."""
+        if self.shared is not None:
+            wait = self.shared.reserve_slot(key, self.delays[key])
+            if wait:
+                time.sleep(wait)
+            self.last[key] = time.time()
+            return
         last_action, target_delay = self.last[key], self.delays[key]
         elapsed_time = time.time() - last_action
         if elapsed_time < target_delay:
@@ -330,12 +404,15 @@ class Bot(object):
             time.sleep(t_remaining * random.uniform(0.25, 1.25))
         self.last[key] = time.time()
 
+    @timed(category='sleep')
     def error_delay(self):
         time.sleep(10)
 
+    @timed(category='sleep')
     def small_delay(self):
         time.sleep(random.uniform(0.75, 3.75))
 
+    @timed(category='sleep')
     def very_small_delay(self):
         time.sleep(random.uniform(0.175, 0.875))
 
@@ -344,6 +421,8 @@ class Bot(object):
         passed_days = (current_date.date() - self.start_time.date()).days
         if passed_days > 0:
             self.reset_counters()
+        if self.shared is not None:
+            return not acquire_limit(self, key)
         return self.max_per_day[key] - self.total[key] <= 0
 
     def reset_counters(self):
@@ -351,6 +430,7 @@ class Bot(object):
             self.total[k] = 0
         for k in self.blocked_actions:
             self.blocked_actions[k] = False
+        self._reserved = {}
         self.start_time = datetime.datetime.now()
 
     # getters
@@ -567,14 +647,28 @@ class Bot(object):
         @param caption       Media description (String)
         @param upload_id     Unique upload_id (String). When None, then generate automatically
         @param from_video    A flag that signals whether the photo is loaded from the video or by itself (Boolean, DEPRECATED: not used)
-        @param options       Object with difference options, e.g. configure_timeout, rename (Dict)
+        @param options       Object with difference options, e.g. configure_timeout, rename, prepared (Dict)
                              Designed to reduce the number of function arguments!
                              This is the simplest request object.
+                             `prepared` is the path `prepare_media_batch` returned for `photo`:
+                             it is uploaded instead, and `photo` is renamed when posted.
 
         @return              Object with state of uploading to Instagram (or False)
         """
         return upload_photo(self, photo, caption, upload_id, from_video, options)
 
+    def prepare_media_batch(self, paths, kind='feed', workers=None):
+        """Prepare media files for uploading in a process pool
+
+        @param paths    Paths to the source files (List)
+        @param kind     'feed' (`upload_photo`), 'story' (`upload_story_photo`) or 'video' (`upload_video`)
+        @param workers  Number of processes (Integer). When None, then the number of CPUs
+
+        @return         OrderedDict: source path -> prepared path (or False).
+                        For videos pass the value to `upload_video` as `options={'prepared': ...}`
+        """
+        return prepare_media_batch(self, paths, kind, workers)
+
     # video
     def upload_video(self, video, caption='', thumbnail=None, options={}):
         """Upload video to Instagram
@@ -742,6 +836,12 @@ class Bot(object):
     def console_print(self, text, color=None):
         return console_print(self, text, color)
 
+    def record_action(self, action, target, result, started=None):
+        return record_action(self, action, target, result, started)
+
     # stats
     def save_user_stats(self, username, path=""):
         return save_user_stats(self, username, path=path)
+
+    def collect_user_stats(self, users, path='stats', workers=8):
+        return collect_user_stats(self, users, path=path, workers=workers)
@@ -1,4 +1,4 @@
-from tqdm import tqdm
+from ..utils import tqdm
 
 
 def archive(self, media_id, undo=False):
@@ -1,15 +1,21 @@
 import random
+import time
 
-from tqdm import tqdm
+from ..utils import tqdm
+from .bot_checkpoint import checkpointed
 
 
+@checkpointed
 def block(self, user_id):
     user_id = self.convert_to_user_id(user_id)
     if self.check_not_bot(user_id):
         return True
     if not self.reached_limit('blocks'):
         self.delay('block')
-        if self.api.block(user_id):
+        started = time.time()
+        _r = self.api.block(user_id)
+        self.record_action('block', user_id, _r, started)
+        if _r:
             self.total['blocks'] += 1
             return True
     else:
@@ -17,11 +23,15 @@ def block(self, user_id):
     return False
 
 
+@checkpointed
 def unblock(self, user_id):
     user_id = self.convert_to_user_id(user_id)
     if not self.reached_limit('unblocks'):
         self.delay('unblock')
-        if self.api.unblock(user_id):
+        started = time.time()
+        _r = self.api.unblock(user_id)
+        self.record_action('unblock', user_id, _r, started)
+        if _r:
             self.total['unblocks'] += 1
             return True
     else:
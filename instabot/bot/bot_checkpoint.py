@@ -1,64 +1,232 @@
 """
     Instabot Checkpoint methods.
+
+    The state of a bot is saved to `<username>.checkpoint`: its counters
+    (.total), .blocked_actions, the total of requests, the day start, the
+    times of the last actions (.last) and the following / followers lists
+    it downloaded. A restarted bot continues from there, without
+    downloading the lists again.
+
+    `save_checkpoint` runs after the actions (`checkpointed`, at most every
+    `checkpoint_interval` seconds) and on logout. A save only appends what
+    changed since the previous one, as a json line, to
+    `<username>.checkpoint.deltas`; every `SNAPSHOT_EVERY` saves, the whole
+    state is written to a temp file renamed over the checkpoint and the
+    deltas file is emptied. Saves are numbered: loading applies the deltas
+    newer than the snapshot and ignores a line cut by a crash.
 """
 
 from datetime import datetime
-import pickle
+import functools
+import json
 import os
+import pickle
+
+from .. import utils
+from ..profiling import timed
 
 CHECKPOINT_PATH = "{fname}.checkpoint"
+DELTAS_PATH = "{fname}.checkpoint.deltas"
+VERSION = 2
+SNAPSHOT_EVERY = 200
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+COUNTERS = ('total', 'blocked_actions', 'last')  # dicts, saved by item
+LISTS = ('following', 'followers')  # saved as added / removed items
 
 
 class Checkpoint(object):
     """
-        Checkpoint for instabot.Bot class which can store:
+        Pickled checkpoint of instabot <= 0.52, still read by `load_checkpoint`:
             .total[<name>] - all Bot's counters
             .blocked_actions[<name>] - Bot's blocked actions
-            .following (list of user_ids)
-            .followers (list of user_ids)
             .date (of checkpoint creation)
     """
 
     def __init__(self, bot):
-        self.total = {}
-        for k in bot.total:
-            self.total[k] = bot.total[k]
-        self.blocked_actions = {}
-        for k in bot.blocked_actions:
-            self.blocked_actions[k] = bot.blocked_actions[k]
+        self.total = dict(bot.total)
+        self.blocked_actions = dict(bot.blocked_actions)
         self.start_time = bot.start_time
         self.date = datetime.now()
         self.total_requests = bot.api.total_requests
 
-    def fill_following(self, bot):
-        self._following = [item["pk"] for item in bot.api.get_total_self_followings()]
-
-    def fill_followers(self, bot):
-        self._followers = [item["pk"] for item in bot.api.get_total_self_followers()]
-
     def dump(self):
         return (self.total, self.blocked_actions, self.total_requests, self.start_time)
 
 
-def save_checkpoint(self):
-    checkpoint = Checkpoint(self)
-    fname = CHECKPOINT_PATH.format(fname=self.api.username)
-    fname = os.path.join(self.base_path, fname)
-    with open(fname, 'wb') as f:
-        pickle.dump(checkpoint, f, -1)
-    return True
+def bot_state(bot):
+    """The checkpointed state of `bot`, as json-able values"""
+    return {
+        'total': dict(bot.total),
+        'blocked_actions': dict(bot.blocked_actions),
+        'last': dict(bot.last),
+        'total_requests': bot.api.total_requests,
+        'start_time': bot.start_time.strftime(DATE_FORMAT),
+        'following': list(bot._following) if bot._following is not None else None,
+        'followers': list(bot._followers) if bot._followers is not None else None,
+    }
+
+
+def restore_state(bot, state):
+    bot.total.update(state['total'])
+    bot.blocked_actions.update(state['blocked_actions'])
+    bot.last.update(state['last'])
+    bot.api.total_requests = state['total_requests']
+    bot.start_time = datetime.strptime(state['start_time'], DATE_FORMAT)
+    bot._following = state['following']
+    bot._followers = state['followers']
+
+
+def state_delta(old, new):
+    """What changed from the state `old` to `new`"""
+    delta = {}
+    for key, value in new.items():
+        if key in COUNTERS:
+            changed = {k: v for k, v in value.items() if old[key].get(k) != v}
+            if changed:
+                delta[key] = changed
+        elif key in LISTS:
+            if value == old[key]:
+                continue  # The common case, much cheaper than the sets below
+            if value is None or old[key] is None:
+                delta[key] = value
+                continue
+            before, after = set(old[key]), set(value)
+            added = [item for item in value if item not in before]
+            removed = [item for item in old[key] if item not in after]
+            if added or removed:
+                delta[key] = {'added': added, 'removed': removed}
+        elif value != old[key]:
+            delta[key] = value
+    return delta
+
+
+def apply_delta(state, delta):
+    for key, value in delta.items():
+        if key in COUNTERS:
+            state[key].update(value)
+        elif key in LISTS and isinstance(value, dict):
+            removed = set(value['removed'])
+            state[key] = [item for item in state[key] if item not in removed] + value['added']
+        else:
+            state[key] = value
+    return state
+
+
+class Checkpoints(object):
+    """Snapshot and deltas files of a bot, see the module docstring."""
+
+    def __init__(self, fname, snapshot_every=SNAPSHOT_EVERY):
+        self.fname = fname
+        self.deltas_fname = DELTAS_PATH.format(fname=os.path.splitext(fname)[0])
+        self.snapshot_every = snapshot_every
+        self.saved = None  # The state at the last save
+        self.seq = 0
+        self.deltas = 0
+        self.f = None
+
+    def read(self):
+        """The saved state: the snapshot and the deltas after it, None if there is none."""
+        try:
+            with open(self.fname) as f:
+                checkpoint = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if checkpoint.get('version') != VERSION:
+            return None
+        state, seq = checkpoint['state'], checkpoint['seq']
+        if os.path.exists(self.deltas_fname):
+            with open(self.deltas_fname) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # Cut by a crash
+                    if entry['seq'] > seq:
+                        state, seq = apply_delta(state, entry['delta']), entry['seq']
+        self.seq = seq
+        return state
+
+    def save(self, state, full=False):
+        """
+            Saves `state`: its changes since the last save, or all of it.
+
+            @return  False if nothing changed
+        """
+        if self.saved is not None and not full:
+            delta = state_delta(self.saved, state)
+            if not delta:
+                return False
+        self.seq += 1
+        if full or self.saved is None or self.deltas >= self.snapshot_every:
+            checkpoint = {'version': VERSION, 'seq': self.seq, 'date': datetime.now().strftime(DATE_FORMAT),
+                          'state': state}
+            utils.atomic_write(self.fname, json.dumps(checkpoint))
+            # Deltas up to `seq` are in the snapshot, ignored if this is not done
+            self.close()
+            self.f = open(self.deltas_fname, 'w')
+            self.deltas = 0
+        else:
+            if self.f is None:
+                self.f = open(self.deltas_fname, 'a')
+            self.f.write(json.dumps({'seq': self.seq, 'delta': delta}) + '\n')
+            self.f.flush()
+            self.deltas += 1
+        self.saved = state
+        return True
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def _checkpoints(self):
+    fname = os.path.join(self.base_path, CHECKPOINT_PATH.format(fname=self.api.username))
+    if self._checkpoints is None or self._checkpoints.fname != fname:
+        if self._checkpoints is not None:
+            self._checkpoints.close()
+        self._checkpoints = Checkpoints(fname)
+    return self._checkpoints
+
+
+def checkpointed(action):
+    """Decorator: `Bot.checkpoint` after the action, once its counters are updated."""
+    @functools.wraps(action)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return action(self, *args, **kwargs)
+        finally:
+            self.checkpoint()
+    return wrapper
+
+
+@timed('save_checkpoint', 'disk')
+def save_checkpoint(self, full=False):
+    """Saves the state of the bot, only its changes unless `full`. Returns False if nothing changed."""
+    return _checkpoints(self).save(bot_state(self), full)
 
 
 def load_checkpoint(self):
+    """
+        Restores the saved state of the bot, also from a pickled checkpoint.
+
+        @return  True if a checkpoint was loaded
+    """
+    checkpoints = _checkpoints(self)
+    state = checkpoints.read()
+    if state is not None:
+        restore_state(self, state)
+        # A fresh snapshot: the deltas file is emptied, also of a cut line
+        checkpoints.save(bot_state(self), full=True)
+        return True
     try:
-        fname = CHECKPOINT_PATH.format(fname=self.api.username)
-        fname = os.path.join(self.base_path, fname)
-        with open(fname, 'rb') as f:
+        with open(checkpoints.fname, 'rb') as f:
             checkpoint = pickle.load(f)
         if isinstance(checkpoint, Checkpoint):
-            return checkpoint.dump()
+            self.total, self.blocked_actions, self.api.total_requests, self.start_time = checkpoint.dump()
+            return True
         else:
-            os.remove(fname)
+            os.remove(checkpoints.fname)
     except Exception:
         pass
-    return None
+    return False
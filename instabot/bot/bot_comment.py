@@ -9,9 +9,14 @@
         kek
 
 """
-from tqdm import tqdm
+import time
 
+from ..profiling import workflow
+from ..utils import tqdm
+from .bot_checkpoint import checkpointed
 
+
+@checkpointed
 def comment(self, media_id, comment_text):
     if self.is_commented(media_id):
         return True
@@ -24,7 +29,9 @@ def comment(self, media_id, comment_text):
                 self.logger.warning('blocked_actions_protection ACTIVE. Skipping `comment` action till, at least, {}.'.format(next_reset))
                 return False
         self.delay('comment')
+        started = time.time()
         _r = self.api.comment(media_id, comment_text)
+        self.record_action('comment', media_id, _r, started)
         if _r == 'feedback_required':
             self.logger.error("`Comment` action has been BLOCKED...!!!")
             return False
@@ -66,6 +73,7 @@ def reply_to_comment(self, media_id, comment_text, parent_comment_id):
     return False
 
 
+@workflow
 def comment_medias(self, medias):
     broken_items = []
     self.logger.info("Going to comment %d medias." % (len(medias)))
@@ -84,12 +92,14 @@ def comment_medias(self, medias):
     return broken_items
 
 
+@workflow
 def comment_hashtag(self, hashtag, amount=None):
     self.logger.info("Going to comment medias by %s hashtag" % hashtag)
     medias = self.get_total_hashtag_medias(hashtag, amount)
     return self.comment_medias(medias)
 
 
+@workflow
 def comment_user(self, user_id, amount=None):
     """ Comments last user_id's medias """
     if not self.check_user(user_id):
@@ -104,6 +114,7 @@ def comment_user(self, user_id, amount=None):
     return self.comment_medias(medias[:amount])
 
 
+@workflow
 def comment_users(self, user_ids, ncomments=None):
     for user_id in user_ids:
         if self.reached_limit('comments'):
@@ -112,6 +123,7 @@ def comment_users(self, user_ids, ncomments=None):
         self.comment_user(user_id, amount=ncomments)
 
 
+@workflow
 def comment_geotag(self, geotag):
     # TODO: comment every media from geotag
     pass
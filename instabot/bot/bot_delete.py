@@ -1,4 +1,4 @@
-from tqdm import tqdm
+from ..utils import tqdm
 
 
 def delete_media(self, media_id):
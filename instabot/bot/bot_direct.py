@@ -1,9 +1,12 @@
 import os
+import time
 from mimetypes import guess_type
 
-from tqdm import tqdm
+from ..utils import tqdm
+from .bot_checkpoint import checkpointed
 
 
+@checkpointed
 def send_message(self, text, user_ids, thread_id=None):
     """
     :param self: bot
@@ -23,13 +26,16 @@ def send_message(self, text, user_ids, thread_id=None):
     self.delay('message')
     urls = self.extract_urls(text)
     item_type = 'link' if urls else 'text'
-    if self.api.send_direct_item(
+    started = time.time()
+    _r = self.api.send_direct_item(
         item_type,
         user_ids,
         text=text,
         thread=thread_id,
         urls=urls
-    ):
+    )
+    self.record_action('message', thread_id or user_ids, _r, started)
+    if _r:
         self.total['messages'] += 1
         return True
 
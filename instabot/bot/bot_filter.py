@@ -1,8 +1,10 @@
 """
     Filter functions for media and user lists.
 """
+from ..profiling import timed
 
 
+@timed()
 def filter_medias(self, media_items, filtration=True, quiet=False, is_comment=False):
     if filtration:
         if not quiet:
@@ -57,6 +59,7 @@ def _get_media_ids(media_items):
     return result
 
 
+@timed()
 def check_media(self, media_id):
     if self.api.media_info(media_id):
         medias = self.api.last_json["items"]
@@ -108,6 +111,7 @@ def search_blacklist_hashtags_in_media(self, media_id):
     return any((h in text) for h in self.blacklist_hashtags)
 
 
+@timed()
 def check_user(self, user_id, unfollowing=False):
     if not self.filter_users and not unfollowing:
         return True
@@ -227,6 +231,7 @@ def check_user(self, user_id, unfollowing=False):
     return True
 
 
+@timed()
 def check_not_bot(self, user_id):
     """ Filter bot from real users. """
     self.small_delay()
@@ -1,8 +1,11 @@
 import time
 
-from tqdm import tqdm
+from ..profiling import workflow
+from ..utils import tqdm
+from .bot_checkpoint import checkpointed
 
 
+@checkpointed
 def follow(self, user_id):
     user_id = self.convert_to_user_id(user_id)
     msg = ' ===> Going to follow `user_id`: {}.'.format(user_id)
@@ -11,7 +14,10 @@ def follow(self, user_id):
         return False
     if not self.reached_limit('follows'):
         self.delay('follow')
-        if self.api.follow(user_id):
+        started = time.time()
+        _r = self.api.follow(user_id)
+        self.record_action('follow', user_id, _r, started)
+        if _r:
             msg = '===> FOLLOWED <==== `user_id`: {}.'.format(user_id)
             self.console_print(msg, 'green')
             self.total['follows'] += 1
@@ -24,6 +30,7 @@ def follow(self, user_id):
     return False
 
 
+@workflow
 def follow_users(self, user_ids):
     broken_items = []
     if self.reached_limit('follows'):
@@ -73,6 +80,7 @@ def follow_users(self, user_ids):
     return broken_items
 
 
+@workflow
 def follow_followers(self, user_id, nfollows=None):
     self.logger.info("Follow followers of: {}".format(user_id))
     if self.reached_limit('follows'):
@@ -89,6 +97,7 @@ def follow_followers(self, user_id, nfollows=None):
         self.follow_users(followers[:nfollows])
 
 
+@workflow
 def follow_following(self, user_id, nfollows=None):
     self.logger.info("Follow following of: {}".format(user_id))
     if self.reached_limit('follows'):
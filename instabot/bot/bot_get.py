@@ -3,7 +3,8 @@
     passed into e.g. like() or comment() functions.
 """
 
-from tqdm import tqdm
+from .. import utils
+from ..utils import tqdm
 
 
 # STORY
@@ -260,21 +261,18 @@ def get_media_comments(self, media_id, only_text=False):
 
 
 def get_media_comments_all(self, media_id, only_text=False, count=False):
-    has_more_comments = True
-    max_id = ''
     comments = []
 
-    while has_more_comments:
-        self.api.get_media_comments(media_id, max_id=max_id)
-        for comment in self.api.last_json['comments']:
-            comments.append(comment)
-        has_more_comments = self.api.last_json['has_more_comments']
-        if count and len(comments) >= count:
-            comments = comments[:count]
-            has_more_comments = False
-            self.logger.info("Getting comments stopped by count (%s)." % count)
-        if has_more_comments:
-            max_id = self.api.last_json['next_max_id']
+    def next_cursor(page):
+        return page['next_max_id'] if page['has_more_comments'] else None
+
+    with self.api.iter_pages(self.api.get_media_comments, next_cursor, media_id) as pages:
+        for page in pages:
+            comments += page['comments']
+            if count and len(comments) >= count:
+                comments = comments[:count]
+                self.logger.info("Getting comments stopped by count (%s)." % count)
+                break
 
     if only_text:
         return [str(item["text"]) for item in sorted(
@@ -310,42 +308,11 @@ def get_media_id_from_link(self, link):
         return False
     link = link.split('/')
     code = link[link.index('p') + 1]
-
-    alphabet = {
-        '-': 62, '1': 53, '0': 52, '3': 55, '2': 54, '5': 57, '4': 56,
-        '7': 59, '6': 58, '9': 61, '8': 60, 'A': 0, 'C': 2, 'B': 1,
-        'E': 4, 'D': 3, 'G': 6, 'F': 5, 'I': 8, 'H': 7, 'K': 10, 'J': 9,
-        'M': 12, 'L': 11, 'O': 14, 'N': 13, 'Q': 16, 'P': 15, 'S': 18,
-        'R': 17, 'U': 20, 'T': 19, 'W': 22, 'V': 21, 'Y': 24, 'X': 23,
-        'Z': 25, '_': 63, 'a': 26, 'c': 28, 'b': 27, 'e': 30, 'd': 29,
-        'g': 32, 'f': 31, 'i': 34, 'h': 33, 'k': 36, 'j': 35, 'm': 38,
-        'l': 37, 'o': 40, 'n': 39, 'q': 42, 'p': 41, 's': 44, 'r': 43,
-        'u': 46, 't': 45, 'w': 48, 'v': 47, 'y': 50, 'x': 49, 'z': 51,
-    }
-
-    result = 0
-    for char in code:
-        result = result * 64 + alphabet[char]
-    return result
+    return utils.shortcode_to_id(code)
 
 
 def get_link_from_media_id(self, media_id):
-    alphabet = {
-        '-': 62, '1': 53, '0': 52, '3': 55, '2': 54, '5': 57, '4': 56,
-        '7': 59, '6': 58, '9': 61, '8': 60, 'A': 0, 'C': 2, 'B': 1,
-        'E': 4, 'D': 3, 'G': 6, 'F': 5, 'I': 8, 'H': 7, 'K': 10, 'J': 9,
-        'M': 12, 'L': 11, 'O': 14, 'N': 13, 'Q': 16, 'P': 15, 'S': 18,
-        'R': 17, 'U': 20, 'T': 19, 'W': 22, 'V': 21, 'Y': 24, 'X': 23,
-        'Z': 25, '_': 63, 'a': 26, 'c': 28, 'b': 27, 'e': 30, 'd': 29,
-        'g': 32, 'f': 31, 'i': 34, 'h': 33, 'k': 36, 'j': 35, 'm': 38,
-        'l': 37, 'o': 40, 'n': 39, 'q': 42, 'p': 41, 's': 44, 'r': 43,
-        'u': 46, 't': 45, 'w': 48, 'v': 47, 'y': 50, 'x': 49, 'z': 51,
-    }
-    result = ''
-    while media_id:
-        media_id, char = media_id // 64, media_id % 64
-        result += list(alphabet.keys())[list(alphabet.values()).index(char)]
-    return 'https://instagram.com/p/' + result[::-1] + '/'
+    return 'https://instagram.com/p/' + utils.id_to_shortcode(media_id) + '/'
 
 
 def get_messages(self):
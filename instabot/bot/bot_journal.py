@@ -0,0 +1,293 @@
+"""
+    Instabot action journal.
+
+    Every action (follow, like, comment, ...) is appended as a json line:
+        {"ts": 1571234567.123, "action": "like", "target": "1234",
+         "result": "ok", "latency": 0.412}
+
+    The journal is a list of segments, `actions.000001.jsonl`,
+    `actions.000002.jsonl`, ..., in time order: a new one is started when
+    the last reaches `max_bytes`. Records are written to the OS at once and
+    fsynced every `sync_every` records or `sync_interval` seconds, whichever
+    comes first (and on `sync` / `close`).
+
+    Bots keep no journal unless asked, e.g. Bot(journal_file='actions.jsonl').
+
+    Queries only read the segments overlapping the asked period, and find
+    its start in a segment by bisection, e.g. the likes of the last 24 hours:
+        bot.journal.count('like', since=time.time() - 24 * 60 * 60)
+
+    `compact(before)` replaces the segments older than `before` by daily
+    totals (`daily_counts`).
+"""
+from __future__ import unicode_literals
+
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+import six
+
+from .. import utils
+from ..profiling import timed
+
+SEGMENT_PATTERN = re.compile(r'\.(\d{6})\.jsonl$')
+
+
+def result_name(result):
+    """'ok', 'failed' or 'blocked' for what the API returned, other strings as they are"""
+    if result == 'feedback_required':
+        return 'blocked'
+    if isinstance(result, six.string_types):
+        return result
+    return 'ok' if result else 'failed'
+
+
+def _timestamp(line):
+    try:
+        return json.loads(line.decode('utf8'))['ts']
+    except (ValueError, KeyError):
+        return None  # A line cut by a crash
+
+
+def _seek(f, size, since):
+    """Moves `f` to the first line with a timestamp >= `since`."""
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        f.seek(max(mid - 1, 0))
+        if mid:
+            f.readline()  # To the first line starting at or after `mid`
+        line = f.readline()
+        ts = _timestamp(line) if line else None
+        if ts is None or ts >= since:
+            hi = mid
+        else:
+            lo = mid + 1
+    f.seek(max(lo - 1, 0))
+    if lo:
+        f.readline()
+
+
+class Journal(object):
+    """
+        Append-only journal of the bot actions.
+
+        @param fname          Journal name, e.g. 'actions.jsonl' (String)
+        @param sync_every     fsync after that many records, 0 to leave it to the OS (Integer)
+        @param sync_interval  fsync at least every `sync_interval` seconds (Float)
+        @param max_bytes      Size of a segment before the next one is started (Integer)
+    """
+
+    def __init__(self, fname='actions.jsonl', sync_every=100, sync_interval=5.0, max_bytes=8 * 1024 * 1024):
+        self.root, _ = os.path.splitext(fname)
+        self.summary_file = self.root + '.summary.json'
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.max_bytes = max_bytes
+        self.f = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self._lock = threading.Lock()
+        # [(first timestamp, path)], the last one is appended to
+        self.segments = []
+        folder, name = os.path.split(self.root)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        pattern = re.compile(re.escape(name) + SEGMENT_PATTERN.pattern)
+        for fname in sorted(os.listdir(folder or '.')):
+            if pattern.match(fname):
+                path = os.path.join(folder, fname)
+                self.segments.append((self._first_timestamp(path), path))
+
+    @staticmethod
+    def _first_timestamp(path):
+        with open(path, 'rb') as f:
+            return _timestamp(f.readline())
+
+    def _segment_path(self, index):
+        return '{}.{:06d}.jsonl'.format(self.root, index)
+
+    def _open(self, ts):
+        """The segment to append to, a new one when there is none or it is full."""
+        if self.f is not None and self.f.tell() < self.max_bytes:
+            return self.f
+        if self.f is None and self.segments:
+            path = self.segments[-1][1]
+            size = os.path.getsize(path)
+            if size < self.max_bytes:
+                self.f = open(path, 'a+b')
+                if size:
+                    self.f.seek(-1, os.SEEK_END)
+                    if self.f.read(1) != b'\n':
+                        self.f.write(b'\n')  # End the line cut by a crash
+                return self.f
+        self._close()
+        index = int(SEGMENT_PATTERN.search(self.segments[-1][1]).group(1)) + 1 if self.segments else 1
+        path = self._segment_path(index)
+        self.segments.append((ts, path))
+        self.f = open(path, 'ab')
+        return self.f
+
+    def _sync(self):
+        if self.f is not None and self.unsynced:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def _close(self):
+        if self.f is not None:
+            self._sync()
+            self.f.close()
+            self.f = None
+
+    @timed('journal.record', 'disk')
+    def record(self, action, target, result=True, latency=None, ts=None):
+        """
+            Appends an action.
+
+            @param action   e.g. 'follow', 'like' (String)
+            @param target   user_id, media_id, ... of the action
+            @param result   True, False, 'feedback_required' or any String
+            @param latency  Seconds the action took (Float)
+        """
+        ts = time.time() if ts is None else ts
+        entry = {
+            'ts': round(ts, 3),
+            'action': action,
+            'target': str(target),
+            'result': result_name(result),
+            'latency': round(latency, 3) if latency is not None else None,
+        }
+        line = json.dumps(entry, separators=(',', ':'), sort_keys=True).encode('utf8') + b'\n'
+        with self._lock:
+            f = self._open(entry['ts'])
+            f.write(line)
+            f.flush()
+            self.unsynced += 1
+            batch_full = self.sync_every and self.unsynced >= self.sync_every
+            if batch_full or time.time() - self.last_sync >= self.sync_interval:
+                self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def query(self, action=None, since=None, until=None, target=None, result=None):
+        """
+            Yields the recorded actions, oldest first, as dicts.
+
+            @param action  Only this action (String), or a tuple of actions
+            @param since   Only from this timestamp (Float)
+            @param until   Only before this timestamp (Float)
+            @param target  Only on this target
+            @param result  Only with this result, e.g. 'ok' (String)
+        """
+        with self._lock:
+            if self.f is not None:
+                self.f.flush()
+            segments = list(self.segments)
+        actions = (action,) if isinstance(action, six.string_types) else action
+        target = str(target) if target is not None else None
+        for index, (first, path) in enumerate(segments):
+            following = segments[index + 1][0] if index + 1 < len(segments) else None
+            if since is not None and following is not None and following < since:
+                continue
+            if until is not None and first is not None and first >= until:
+                break
+            with open(path, 'rb') as f:
+                if since is not None:
+                    _seek(f, os.fstat(f.fileno()).st_size, since)
+                for line in f:
+                    try:
+                        entry = json.loads(line.decode('utf8'))
+                    except ValueError:
+                        continue
+                    if until is not None and entry['ts'] >= until:
+                        return
+                    if since is not None and entry['ts'] < since:
+                        continue
+                    if actions and entry['action'] not in actions:
+                        continue
+                    if target is not None and entry['target'] != target:
+                        continue
+                    if result is not None and entry['result'] != result:
+                        continue
+                    yield entry
+
+    def count(self, action=None, since=None, until=None, result='ok'):
+        """Number of actions in the period, successful ones by default, e.g. count('like', since=time.time() - 86400)"""
+        return sum(1 for _ in self.query(action, since, until, result=result))
+
+    def counts(self, since=None, until=None, result='ok'):
+        """{action: number} in the period"""
+        counts = {}
+        for entry in self.query(since=since, until=until, result=result):
+            counts[entry['action']] = counts.get(entry['action'], 0) + 1
+        return counts
+
+    def _load_summary(self):
+        if not os.path.exists(self.summary_file):
+            return {}
+        with open(self.summary_file) as f:
+            return json.load(f)
+
+    def daily_counts(self, action=None, result='ok'):
+        """{'YYYY-MM-DD': {action: number}} of the whole journal, compacted days included"""
+        days = {}
+        for day, actions in self._load_summary().items():
+            for name, results in actions.items():
+                if (action is None or name == action) and results.get(result):
+                    days.setdefault(day, {})[name] = results[result]
+        for entry in self.query(action=action, result=result):
+            day = days.setdefault(datetime.fromtimestamp(entry['ts']).strftime('%Y-%m-%d'), {})
+            day[entry['action']] = day.get(entry['action'], 0) + 1
+        return days
+
+    def compact(self, before):
+        """
+            Replaces the segments with only actions older than `before` by
+            their daily totals. The segment appended to is kept.
+
+            @return  Number of compacted actions
+        """
+        with self._lock:
+            old = [path for index, (_, path) in enumerate(self.segments[:-1])
+                   if self.segments[index + 1][0] is not None and self.segments[index + 1][0] <= before]
+        if not old:
+            return 0
+        summary = self._load_summary()
+        compacted = 0
+        for path in old:
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line.decode('utf8'))
+                    except ValueError:
+                        continue
+                    day = datetime.fromtimestamp(entry['ts']).strftime('%Y-%m-%d')
+                    results = summary.setdefault(day, {}).setdefault(entry['action'], {})
+                    results[entry['result']] = results.get(entry['result'], 0) + 1
+                    compacted += 1
+        # The totals first: a crash then at worst leaves an action counted twice
+        utils.atomic_write(self.summary_file, json.dumps(summary, sort_keys=True))
+        with self._lock:
+            self.segments = [segment for segment in self.segments if segment[1] not in old]
+        for path in old:
+            os.remove(path)
+        return compacted
+
+
+def record_action(self, action, target, result, started=None):
+    """Journals `action` of the bot, if it has a journal; `started` is the time.time() of its start."""
+    if self.journal is not None:
+        latency = time.time() - started if started is not None else None
+        self.journal.record(action, target, result, latency)
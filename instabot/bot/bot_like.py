@@ -1,6 +1,11 @@
-from tqdm import tqdm
+import time
 
+from ..profiling import workflow
+from ..utils import tqdm
+from .bot_checkpoint import checkpointed
 
+
+@checkpointed
 def like(self, media_id, check_media=True):
     if not self.reached_limit('likes'):
         if self.blocked_actions['likes']:
@@ -11,7 +16,9 @@ def like(self, media_id, check_media=True):
         self.delay('like')
         if check_media and not self.check_media(media_id):
             return False
+        started = time.time()
         _r = self.api.like(media_id)
+        self.record_action('like', media_id, _r, started)
         if _r == 'feedback_required':
             self.logger.error("`Like` action has been BLOCKED...!!!")
             self.blocked_actions['likes'] = True
@@ -25,6 +32,7 @@ def like(self, media_id, check_media=True):
     return False
 
 
+@checkpointed
 def like_comment(self, comment_id):
     if not self.reached_limit('likes'):
         if self.blocked_actions['likes']:
@@ -35,7 +43,9 @@ def like_comment(self, comment_id):
                 self.logger.warning('blocked_actions_protection ACTIVE. Skipping `like` action till, at least, {}.'.format(next_reset))
                 return False
         self.delay('like')
+        started = time.time()
         _r = self.api.like_comment(comment_id)
+        self.record_action('like_comment', comment_id, _r, started)
         if _r == 'feedback_required':
             self.logger.error("`Like` action has been BLOCKED...!!!")
             self.blocked_actions['likes'] = True
@@ -71,6 +81,7 @@ def like_media_comments(self, media_id):
     return broken_items
 
 
+@workflow
 def like_medias(self, medias, check_media=True):
     broken_items = []
     if not medias:
@@ -85,12 +96,14 @@ def like_medias(self, medias, check_media=True):
     return broken_items
 
 
+@workflow
 def like_timeline(self, amount=None):
     self.logger.info("Liking timeline feed:")
     medias = self.get_timeline_medias()[:amount]
     return self.like_medias(medias, check_media=False)
 
 
+@workflow
 def like_user(self, user_id, amount=None, filtration=True):
     """ Likes last user_id's medias """
     if filtration:
@@ -106,6 +119,7 @@ def like_user(self, user_id, amount=None, filtration=True):
     return self.like_medias(medias[:amount], filtration)
 
 
+@workflow
 def like_users(self, user_ids, nlikes=None, filtration=True):
     for user_id in user_ids:
         if self.reached_limit('likes'):
@@ -114,6 +128,7 @@ def like_users(self, user_ids, nlikes=None, filtration=True):
         self.like_user(user_id, amount=nlikes, filtration=filtration)
 
 
+@workflow
 def like_hashtag(self, hashtag, amount=None):
     """ Likes last medias from hashtag """
     self.logger.info("Going to like media with hashtag #%s." % hashtag)
@@ -121,11 +136,13 @@ def like_hashtag(self, hashtag, amount=None):
     return self.like_medias(medias)
 
 
+@workflow
 def like_geotag(self, geotag, amount=None):
     # TODO: like medias by geotag
     pass
 
 
+@workflow
 def like_followers(self, user_id, nlikes=None, nfollows=None):
     self.logger.info("Like followers of: %s." % user_id)
     if self.reached_limit('likes'):
@@ -141,6 +158,7 @@ def like_followers(self, user_id, nlikes=None, nfollows=None):
         self.like_users(follower_ids[:nfollows], nlikes)
 
 
+@workflow
 def like_following(self, user_id, nlikes=None, nfollows=None):
     self.logger.info("Like following of: %s." % user_id)
     if self.reached_limit('likes'):
@@ -156,6 +174,7 @@ def like_following(self, user_id, nlikes=None, nfollows=None):
         self.like_users(following_ids, nlikes)
 
 
+@workflow
 def like_location_feed(self, place, amount):
     self.logger.info("Searching location: {}".format(place))
     self.api.search_location(place)
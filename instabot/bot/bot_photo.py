@@ -1,7 +1,9 @@
 import os
 from io import open
 
-from tqdm import tqdm
+from ..api.api_photo import photo_download_jobs
+from ..profiling import workflow
+from ..utils import tqdm
 
 
 def upload_photo(self, photo, caption=None, upload_id=None, from_video=False, options={}):
@@ -11,9 +13,11 @@ def upload_photo(self, photo, caption=None, upload_id=None, from_video=False, op
     @param caption       Media description (String)
     @param upload_id     Unique upload_id (String). When None, then generate automatically
     @param from_video    A flag that signals whether the photo is loaded from the video or by itself (Boolean, DEPRECATED: not used)
-    @param options       Object with difference options, e.g. configure_timeout, rename (Dict)
+    @param options       Object with difference options, e.g. configure_timeout, rename, prepared (Dict)
                          Designed to reduce the number of function arguments!
                          This is the simplest request object.
+                         `prepared` is the path `prepare_media_batch` returned for `photo`:
+                         it is uploaded instead, and `photo` is renamed when posted.
 
     @return              Object with state of uploading to Instagram (or False)
     """
@@ -31,12 +35,7 @@ def download_photo(self, media_id, folder='photos', filename=None, save_descript
     if not os.path.exists(folder):
         os.makedirs(folder)
     if save_description:
-        media = self.get_media_info(media_id)[0]
-        caption = media['caption']['text'] if media['caption'] else ''
-        username = media['user']['username']
-        fname = os.path.join(folder, '{}_{}.txt'.format(username, media_id))
-        with open(fname, encoding='utf8', mode='w') as f:
-            f.write(caption)
+        save_media_description(self.get_media_info(media_id)[0], media_id, folder)
     try:
         return self.api.download_photo(media_id, filename, False, folder)
     except Exception:
@@ -44,14 +43,60 @@ def download_photo(self, media_id, folder='photos', filename=None, save_descript
         return False
 
 
+def save_media_description(media, media_id, folder):
+    caption = media['caption']['text'] if media['caption'] else ''
+    username = media['user']['username']
+    fname = os.path.join(folder, '{}_{}.txt'.format(username, media_id))
+    with open(fname, encoding='utf8', mode='w') as f:
+        f.write(caption)
+
+
+@workflow
 def download_photos(self, medias, folder, save_description=False):
     broken_items = []
     if not medias:
         self.logger.info("Nothing to downloads.")
         return broken_items
     self.logger.info("Going to download {} medias.".format(len(medias)))
-    for media in tqdm(medias):
-        if not self.download_photo(media, folder, save_description=save_description):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    # Media info goes through the API with the usual delays, while the
+    # photos are fetched from the CDN in background by `api.downloader`.
+    index = self.api.downloader.index
+    downloads = []
+    for media_id in tqdm(medias, desc='Getting media info'):
+        if index.media_paths(media_id):
+            continue  # Downloaded before, maybe under another name
+        self.small_delay()
+        try:
+            media = self.get_media_info(media_id)[0]
+            if save_description:
+                save_media_description(media, media_id, folder)
+            jobs = photo_download_jobs(media, media_id, folder)
+        except Exception:
+            self.logger.info("Media with `{}` is not downloaded.".format(media_id))
             self.error_delay()
-            broken_items = medias[medias.index(media):]
+            broken_items.append(media_id)
+            continue
+        downloads.append((media_id, [self.api.downloader.submit(*job) for job in jobs]))
+    for media_id, results in tqdm(downloads, desc='Downloading photos'):
+        paths = [result.get() for result in results]
+        if not all(paths):
+            self.logger.info("Media with `{}` is not downloaded.".format(media_id))
+            broken_items.append(media_id)
+        elif paths:
+            index.add_media(media_id, paths)
+    index.save()
     return broken_items
+
+
+def prepare_media_batch(self, paths, kind='feed', workers=None):
+    if not paths:
+        self.logger.info("Nothing to prepare.")
+        return {}
+    self.logger.info("Going to prepare {} medias for `{}`.".format(len(paths), kind))
+    prepared = self.api.prepare_media_batch(paths, kind, workers)
+    broken_items = [path for path, result in prepared.items() if not result]
+    if broken_items:
+        self.logger.warning("Can't prepare {} medias: {}".format(len(broken_items), broken_items))
+    return prepared
@@ -0,0 +1,168 @@
+"""
+    Instabot state shared between processes.
+
+    Bots of one account running in several processes on a host, e.g.
+    `like_hashtags.py` and `follow_user_followers.py`, share one daily
+    budget, one delay clock per action and the blocked actions through
+    `Bot(shared_state='<account>.db')`, an SQLite database in WAL mode.
+    Every operation is one `BEGIN IMMEDIATE` transaction, so it is atomic
+    across processes.
+
+    `Bot.reached_limit(key)` checks and reserves one action of the day's
+    budget at once; the reservation is given back at the next check of
+    `key` when `Bot.total[key]` didn't grow (the action failed or didn't
+    happen). `Bot.delay(key)` reserves the next slot of the shared delay
+    clock, so actions of all processes are spaced by the delays.
+"""
+from __future__ import unicode_literals
+
+import datetime
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS counters (day TEXT, key TEXT, value INTEGER, PRIMARY KEY (day, key));
+CREATE TABLE IF NOT EXISTS blocked (day TEXT, key TEXT, PRIMARY KEY (day, key));
+CREATE TABLE IF NOT EXISTS last_actions (key TEXT PRIMARY KEY, ts REAL);
+'''
+
+
+def _today():
+    return datetime.date.today().isoformat()
+
+
+class SharedState(object):
+    """
+        Counters, blocked actions and last action times in the SQLite
+        database `fname`, shared by all the processes opening it.
+
+        @param timeout  Seconds to wait for another process's transaction (Float)
+    """
+
+    def __init__(self, fname, timeout=30.0):
+        self.fname = fname
+        self.timeout = timeout
+        self._local = threading.local()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        """The connection of the current thread"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.fname, timeout=self.timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def transaction(self):
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    @staticmethod
+    def _count(db, key, day):
+        row = db.execute('SELECT value FROM counters WHERE day = ? AND key = ?', (day, key)).fetchone()
+        return row[0] if row else 0
+
+    def count(self, key):
+        """Today's counter `key` of all the processes"""
+        return self._count(self.db, key, _today())
+
+    def totals(self):
+        """{key: counter} of today"""
+        return dict(self.db.execute('SELECT key, value FROM counters WHERE day = ?', (_today(),)))
+
+    def acquire(self, key, limit):
+        """Increments today's counter `key` if it is below `limit`. Returns False if it is not."""
+        day = _today()
+        with self.transaction() as db:
+            value = self._count(db, key, day)
+            if value >= limit:
+                return False
+            db.execute('INSERT OR REPLACE INTO counters VALUES (?, ?, ?)', (day, key, value + 1))
+        return True
+
+    def release(self, key):
+        """Gives back one action of today's counter `key`."""
+        with self.transaction() as db:
+            db.execute('UPDATE counters SET value = MAX(value - 1, 0) WHERE day = ? AND key = ?', (_today(), key))
+
+    def blocked(self):
+        """The keys of the actions blocked today"""
+        return set(row[0] for row in self.db.execute('SELECT key FROM blocked WHERE day = ?', (_today(),)))
+
+    def set_blocked(self, key):
+        with self.transaction() as db:
+            db.execute('INSERT OR IGNORE INTO blocked VALUES (?, ?)', (_today(), key))
+
+    def reserve_slot(self, key, delay):
+        """
+            Takes the next slot of the delay clock `key`: after the last slot
+            taken by any process, which may still be pending, plus what
+            remains of `delay` seconds with a random factor in 0.25 - 1.25.
+            Slots are handed out in order, the clock never goes back.
+
+            @return  Seconds to sleep before the action
+        """
+        with self.transaction() as db:
+            row = db.execute('SELECT ts FROM last_actions WHERE key = ?', (key,)).fetchone()
+            now = time.time()
+            last = row[0] if row else 0
+            remaining = min(delay, max(delay - (now - last), 0))
+            wait = max(last - now, 0) + remaining * random.uniform(0.25, 1.25)
+            db.execute('INSERT OR REPLACE INTO last_actions VALUES (?, ?)', (key, max(now + wait, last)))
+        return wait
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+def _settle(self, key):
+    """Gives back the reservation of `key` if `total[key]` didn't grow since it was taken."""
+    total = self._reserved.pop(key, None)
+    if total is not None and self.total[key] <= total:
+        self.shared.release(key)
+
+
+def sync_blocked(self):
+    """Actions blocked in any process are blocked in all of them."""
+    blocked = self.shared.blocked()
+    for key, value in self.blocked_actions.items():
+        if value and key not in blocked:
+            self.shared.set_blocked(key)
+        elif key in blocked:
+            self.blocked_actions[key] = True
+
+
+def acquire_limit(self, key):
+    """
+        Reserves one action `key` of the shared daily budget.
+
+        @return  False if the budget is used up
+    """
+    _settle(self, key)
+    sync_blocked(self)
+    if not self.shared.acquire(key, self.max_per_day[key]):
+        return False
+    self._reserved[key] = self.total[key]
+    return True
+
+
+def release_limits(self):
+    """Gives back the pending reservations, e.g. on logout."""
+    for key in list(self._reserved):
+        _settle(self, key)
@@ -1,5 +1,36 @@
+"""
+    Instabot stats of users.
+
+    `save_user_stats` appends a line to `<username>.tsv` per call.
+
+    `collect_user_stats` fetches many users concurrently into a columnar
+    `StatsStore`: a folder per day with a file of fixed-width little-endian
+    values per column (ts as float64, the others as int64), appended to on
+    every collection. Loading a day reads whole columns at once, without
+    parsing, e.g. `numpy.fromfile('2019-10-16/followers.bin', '<i8')`.
+
+    Usage:
+        bot.collect_user_stats(usernames, path='stats')
+        store = StatsStore('stats')
+        store.growth_rates('followers', since=time.time() - 7 * 24 * 60 * 60)
+        store.export_tsv('tsv')
+"""
+from __future__ import unicode_literals
+
 import datetime
+import json
 import os
+import struct
+import threading
+import time
+
+from .. import utils
+from ..profiling import timed
+
+COLUMNS = ('ts', 'user_id', 'followers', 'following', 'medias')
+FORMATS = {'ts': 'd'}  # int64 ('q') for the others
+ITEM_SIZE = 8
+USERS_FILE = 'users.json'
 
 
 def get_tsv_line(dictionary):
@@ -21,14 +52,195 @@ def ensure_dir(file_path):
 
 
 def dump_data(data, path):
-    ensure_dir(path)
-    if not os.path.exists(path):
-        with open(path, "w") as f:
+    try:
+        f = open(path, "a")
+    except IOError:
+        ensure_dir(path)
+        f = open(path, "a")
+    with f:
+        if f.tell() == 0:
             f.write(get_header_line(data))
-            f.write(get_tsv_line(data))
-    else:
-        with open(path, "a") as f:
-            f.write(get_tsv_line(data))
+        f.write(get_tsv_line(data))
+
+
+def _date(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
+
+
+def _pack(column, values):
+    return struct.pack(str('<{}{}').format(len(values), FORMATS.get(column, 'q')), *values)
+
+
+def _unpack(column, data):
+    count = len(data) // ITEM_SIZE
+    return list(struct.unpack(str('<{}{}').format(count, FORMATS.get(column, 'q')), data[:count * ITEM_SIZE]))
+
+
+class StatsStore(object):
+    """
+        Columnar store of users' stats, in the folder `path`.
+
+        A row is a dict of `COLUMNS`: ts (time.time() of the fetch),
+        user_id, followers, following and medias.
+    """
+
+    def __init__(self, path='stats'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._usernames = None
+
+    def _column_file(self, day, column):
+        return os.path.join(self.path, day, column + '.bin')
+
+    @property
+    def usernames(self):
+        """{user_id: username} of the stored users"""
+        if self._usernames is None:
+            try:
+                with open(os.path.join(self.path, USERS_FILE)) as f:
+                    self._usernames = {int(user_id): name for user_id, name in json.load(f).items()}
+            except (IOError, ValueError):
+                self._usernames = {}
+        return self._usernames
+
+    def days(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, name)))
+
+    @timed('stats.append', 'disk')
+    def append(self, rows, usernames=None):
+        """
+            Appends `rows`.
+
+            @param rows       List of dicts of `COLUMNS`
+            @param usernames  {user_id: username} of the rows' users, for the TSV export
+        """
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(_date(row['ts']), []).append(row)
+        with self._lock:
+            for day, day_rows in by_day.items():
+                folder = os.path.join(self.path, day)
+                if os.path.isdir(folder):
+                    self._repair_day(day)
+                else:
+                    os.makedirs(folder)
+                for column in COLUMNS:
+                    with open(self._column_file(day, column), 'ab') as f:
+                        f.write(_pack(column, [row[column] for row in day_rows]))
+            new = {int(user_id): name for user_id, name in (usernames or {}).items()
+                   if self.usernames.get(int(user_id)) != name}
+            if new:
+                self.usernames.update(new)
+                data = json.dumps({str(user_id): name for user_id, name in self.usernames.items()}, sort_keys=True)
+                utils.atomic_write(os.path.join(self.path, USERS_FILE), data)
+
+    def _repair_day(self, day):
+        """Cuts the columns of `day` to their complete rows, left by a crash during an append."""
+        sizes = {}
+        for column in COLUMNS:
+            fname = self._column_file(day, column)
+            sizes[column] = os.path.getsize(fname) if os.path.exists(fname) else 0
+        size = min(sizes.values()) // ITEM_SIZE * ITEM_SIZE
+        for column in COLUMNS:
+            if sizes[column] > size:
+                with open(self._column_file(day, column), 'r+b') as f:
+                    f.truncate(size)
+
+    def _load_day(self, day):
+        columns = {}
+        for column in COLUMNS:
+            data = b''
+            fname = self._column_file(day, column)
+            if os.path.exists(fname):
+                with open(fname, 'rb') as f:
+                    data = f.read()
+            columns[column] = _unpack(column, data)
+        # Columns cut by a crash during an append: the complete rows only
+        rows = min(len(values) for values in columns.values())
+        return {column: values[:rows] for column, values in columns.items()}
+
+    @timed('stats.load', 'disk')
+    def load(self, since=None, until=None, user_ids=None):
+        """
+            Columns of the rows fetched between `since` and `until`, oldest first.
+
+            @param since     Only from this timestamp (Float)
+            @param until     Only before this timestamp (Float)
+            @param user_ids  Only these users
+            @return          {column: list}
+        """
+        first = _date(since) if since is not None else None
+        last = _date(until) if until is not None else None
+        wanted = set(int(user_id) for user_id in user_ids) if user_ids is not None else None
+        result = {column: [] for column in COLUMNS}
+        for day in self.days():
+            if first is not None and day < first or last is not None and day > last:
+                continue
+            columns = self._load_day(day)
+            for index, ts in enumerate(columns['ts']):
+                if since is not None and ts < since or until is not None and ts >= until:
+                    continue
+                if wanted is not None and columns['user_id'][index] not in wanted:
+                    continue
+                for column in COLUMNS:
+                    result[column].append(columns[column][index])
+        return result
+
+    def series(self, column='followers', since=None, until=None, user_ids=None):
+        """{user_id: [(ts, value)]} in time order"""
+        columns = self.load(since, until, user_ids)
+        series = {}
+        for ts, user_id, value in zip(columns['ts'], columns['user_id'], columns[column]):
+            series.setdefault(user_id, []).append((ts, value))
+        for points in series.values():
+            points.sort()
+        return series
+
+    def deltas(self, column='followers', since=None, until=None, user_ids=None):
+        """{user_id: last value - first value} in the period"""
+        return {user_id: points[-1][1] - points[0][1]
+                for user_id, points in self.series(column, since, until, user_ids).items()}
+
+    def growth_rates(self, column='followers', since=None, until=None, user_ids=None, per=24 * 60 * 60):
+        """
+            {user_id: average relative growth per `per` seconds (a day by
+            default)} in the period, e.g. 0.01 for 1% a day. Users with less
+            than two rows or a first value of 0 are left out.
+        """
+        rates = {}
+        for user_id, points in self.series(column, since, until, user_ids).items():
+            (first_ts, first), (last_ts, last) = points[0], points[-1]
+            if last_ts > first_ts and first > 0:
+                rates[user_id] = (float(last) / first) ** (per / (last_ts - first_ts)) - 1
+        return rates
+
+    def export_tsv(self, path='', since=None, until=None, user_ids=None):
+        """
+            Writes the rows to `<path>/<username>.tsv` (the user_id without a
+            username), in the format of `save_user_stats`.
+
+            @return  List of the written files
+        """
+        columns = self.load(since, until, user_ids)
+        lines = {}
+        for index, user_id in enumerate(columns['user_id']):
+            data = {
+                "date": str(datetime.datetime.fromtimestamp(columns['ts'][index]).replace(microsecond=0)),
+                "followers": columns['followers'][index],
+                "following": columns['following'][index],
+                "medias": columns['medias'][index],
+            }
+            lines.setdefault(user_id, [get_header_line(data)]).append(get_tsv_line(data))
+        fnames = []
+        for user_id, user_lines in lines.items():
+            fname = os.path.join(path, "%s.tsv" % self.usernames.get(user_id, user_id))
+            ensure_dir(fname)
+            with open(fname, 'w') as f:
+                f.writelines(user_lines)
+            fnames.append(fname)
+        return fnames
 
 
 def save_user_stats(self, username, path=""):
@@ -47,3 +259,49 @@ def save_user_stats(self, username, path=""):
         dump_data(data_to_save, file_path)
         self.logger.info("Stats saved at %s." % data_to_save["date"])
     return False
+
+
+def _fetch_stats(self, user):
+    user_id = self.convert_to_user_id(user)
+    info = self.get_user_info(user_id, use_cache=False) if user_id else None
+    if not info:
+        return None
+    return {
+        'ts': time.time(),
+        'user_id': int(user_id),
+        'followers': int(info['follower_count']),
+        'following': int(info['following_count']),
+        'medias': int(info['media_count']),
+    }, info.get('username')
+
+
+def collect_user_stats(self, users, path='stats', workers=8):
+    """
+        Fetches the stats of `users` concurrently and appends them to the
+        `StatsStore` in `path`.
+
+        @param users    usernames or user_ids
+        @param workers  Concurrent requests (Integer)
+        @return         Number of users saved
+    """
+    from multiprocessing.pool import ThreadPool  # not needed by `import instabot`
+    users = list(users)
+    pool = ThreadPool(max(min(workers, len(users)), 1))
+    try:
+        results = pool.map(lambda user: _fetch_stats(self, user), users)
+    finally:
+        pool.close()
+        pool.join()
+    rows, usernames = [], {}
+    for result in results:
+        if result is not None:
+            row, username = result
+            rows.append(row)
+            if username:
+                usernames[row['user_id']] = username
+    failed = len(users) - len(rows)
+    if failed:
+        self.logger.warning("No stats of {} users.".format(failed))
+    StatsStore(path).append(rows, usernames)
+    self.logger.info("Stats of {} users saved to {}.".format(len(rows), path))
+    return len(rows)
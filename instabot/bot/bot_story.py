@@ -1,3 +1,8 @@
+import os
+
+from ..api.api_download import media_key
+
+
 def download_stories(self, username):
     user_id = self.get_user_id_from_username(username)
     list_image, list_video = self.get_user_stories(user_id)
@@ -6,12 +11,17 @@ def download_stories(self, username):
             "Make sure that '{}' is NOT private and that posted some stories".format(username))
         return False
     self.logger.info("Downloading stories...")
-    for story_url in list_image:
-        filename = story_url.split('/')[-1].split('.')[0] + ".jpg"
-        self.api.download_story(filename, story_url, username)
-    for story_url in list_video:
-        filename = story_url.split('/')[-1].split('.')[0] + ".mp4"
-        self.api.download_story(filename, story_url, username)
+    folder = "stories/{}".format(username)
+    jobs = []
+    for story_urls, ext in ((list_image, ".jpg"), (list_video, ".mp4")):
+        for story_url in story_urls:
+            name = story_url.split('/')[-1].split('.')[0]
+            jobs.append((story_url, os.path.join(folder, name + ext), media_key('story', name)))
+    results = self.api.downloader.download(jobs, desc='Downloading stories')
+    broken_items = [fname for fname, result in results.items() if not result]
+    if broken_items:
+        self.logger.warning("Can't download {} stories.".format(len(broken_items)))
+    return not broken_items
 
 
 def upload_story_photo(self, photo, upload_id=None):
@@ -9,7 +9,7 @@ import os
 import re
 import sys
 
-import huepy
+from .. import utils
 
 
 def check_if_file_exists(file_path, quiet=False):
@@ -40,10 +40,10 @@ def read_list_from_file(file_path, quiet=False):
 
 
 def console_print(self, text, color=None):
-    if self.verbosity:
+    if self.verbosity and not utils.QUIET:
         text = '\n' + text
         if color is not None:
-            text = getattr(huepy, color)(text)
+            text = utils.colored(text, color)
         print(text)
 
 
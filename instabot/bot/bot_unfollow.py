@@ -1,6 +1,11 @@
-from tqdm import tqdm
+import time
 
+from ..profiling import workflow
+from ..utils import tqdm
+from .bot_checkpoint import checkpointed
 
+
+@checkpointed
 def unfollow(self, user_id):
     user_id = self.convert_to_user_id(user_id)
     user_info = self.get_user_info(user_id)
@@ -11,7 +16,10 @@ def unfollow(self, user_id):
         return True  # whitelisted user
     if not self.reached_limit('unfollows'):
         self.delay('unfollow')
-        if self.api.unfollow(user_id):
+        started = time.time()
+        _r = self.api.unfollow(user_id)
+        self.record_action('unfollow', user_id, _r, started)
+        if _r:
             msg = '===> Unfollowed, `user_id`: {}, user_name: {}'
             self.console_print(msg.format(user_id, username), 'yellow')
             self.unfollowed_file.append(user_id)
@@ -24,6 +32,7 @@ def unfollow(self, user_id):
     return False
 
 
+@workflow
 def unfollow_users(self, user_ids):
     broken_items = []
     self.logger.info("Going to unfollow {} users.".format(len(user_ids)))
@@ -42,6 +51,7 @@ def unfollow_users(self, user_ids):
     return broken_items
 
 
+@workflow
 def unfollow_non_followers(self, n_to_unfollows=None):
     self.logger.info("Unfollowing non-followers.")
     self.console_print(" ===> Start unfollowing non-followers <===", 'red')
@@ -55,5 +65,6 @@ def unfollow_non_followers(self, n_to_unfollows=None):
     self.console_print(" ===> Unfollow non-followers done! <===", 'red')
 
 
+@workflow
 def unfollow_everyone(self):
     self.unfollow_users(self.following)
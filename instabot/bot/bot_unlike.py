@@ -1,10 +1,17 @@
-from tqdm import tqdm
+import time
 
+from ..utils import tqdm
+from .bot_checkpoint import checkpointed
 
+
+@checkpointed
 def unlike(self, media_id):
     if not self.reached_limit('unlikes'):
         self.delay('unlike')
-        if self.api.unlike(media_id):
+        started = time.time()
+        _r = self.api.unlike(media_id)
+        self.record_action('unlike', media_id, _r, started)
+        if _r:
             self.total['unlikes'] += 1
             return True
     else:
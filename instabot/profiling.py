@@ -0,0 +1,198 @@
+"""
+    Spans and timers of the bot workflows.
+
+    `span(name, category)` times a block; `timed` does the same for a
+    function. Every name gets a count and a total time. Spans with a
+    category ('sleep', 'network' or 'disk') also add their own time,
+    without the categorized spans nested in them, to the workflow running
+    in the thread (the outermost `workflow` function, e.g. `follow_users`).
+    The rest of the workflow's wall time is reported as 'cpu'.
+
+    The timers are process wide (`PROFILER`) and cheap enough to stay on;
+    `PROFILER.enabled = False` turns them off.
+
+    Usage:
+        with profiling.span('check_user'):
+            ...
+
+        @profiling.timed('file.append', 'disk')
+        def append(...):
+
+        print('\\n'.join(profiling.PROFILER.format_report()))
+"""
+from __future__ import unicode_literals
+
+import functools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+CATEGORIES = ('sleep', 'network', 'disk')
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.enabled = True
+        self.timers = {}  # name -> [count, seconds]
+        self.workflows = OrderedDict()  # name -> {'runs', 'wall', 'sleep', 'network', 'disk'}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name, category=None):
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        if category is not None:
+            stack.append([category, 0.0])  # time of the categorized spans inside
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self._lock:
+                timer = self.timers.setdefault(name, [0, 0.0])
+                timer[0] += 1
+                timer[1] += elapsed
+            if category is not None:
+                _, nested = stack.pop()
+                if stack:
+                    stack[-1][1] += elapsed
+                workflow = getattr(self._local, 'workflow', None)
+                if workflow is not None:
+                    workflow[category] += elapsed - nested
+
+    @contextmanager
+    def run(self, name):
+        """Times the workflow `name`, unless another workflow already runs in this thread."""
+        if not self.enabled or getattr(self._local, 'workflow', None) is not None:
+            yield
+            return
+        current = self._local.workflow = dict.fromkeys(CATEGORIES, 0.0)
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._local.workflow = None
+            wall = time.time() - started
+            with self._lock:
+                totals = self.workflows.setdefault(name, dict.fromkeys(('runs', 'wall') + CATEGORIES, 0))
+                totals['runs'] += 1
+                totals['wall'] += wall
+                for category in CATEGORIES:
+                    totals[category] += current[category]
+
+    def report(self):
+        """
+            @return  List of dicts per workflow: name, runs, wall, sleep,
+                     network, disk and cpu (the rest of the wall time) seconds
+        """
+        with self._lock:
+            rows = [dict(totals, name=name) for name, totals in self.workflows.items()]
+        for row in rows:
+            row['cpu'] = max(row['wall'] - sum(row[category] for category in CATEGORIES), 0.0)
+        return rows
+
+    def top_timers(self, limit=10):
+        """[(name, count, seconds)] of the spans with the most total time"""
+        with self._lock:
+            timers = [(name, count, seconds) for name, (count, seconds) in self.timers.items()]
+        return sorted(timers, key=lambda timer: timer[2], reverse=True)[:limit]
+
+    def format_report(self):
+        lines = []
+        for row in self.report():
+            parts = ', '.join('{} {:.1f}s ({:.0%})'.format(key, row[key], row[key] / row['wall'] if row['wall'] else 0)
+                              for key in ('sleep', 'network', 'cpu', 'disk'))
+            lines.append('{name}: {runs} runs, {wall:.1f}s: '.format(**row) + parts)
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.workflows = OrderedDict()
+
+
+PROFILER = Profiler()
+span = PROFILER.span
+
+
+def timed(name=None, category=None):
+    """Decorator: the function runs in a span `name` (its name by default)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.span(name or func.__name__, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def workflow(func):
+    """Decorator: the function is a workflow of the profile report."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with PROFILER.run(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class RunProfiler(object):
+    """
+        cProfile, or pyinstrument when installed and asked for, over a whole run.
+        Without pyinstrument, cProfile is used, with a `.prof` output.
+
+        @param kind   'cprofile' or 'pyinstrument' (String)
+        @param fname  Output: pstats dump for cProfile, html for pyinstrument (String)
+    """
+
+    def __init__(self, kind='cprofile', fname='instabot.prof'):
+        self.kind = kind
+        self.fname = fname
+        if kind == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler as Pyinstrument
+            except ImportError:
+                self.kind, self.fname = 'cprofile', os.path.splitext(fname)[0] + '.prof'
+                logging.getLogger('instabot').warning(
+                    "pyinstrument is not installed, profiling with cProfile to {}".format(self.fname))
+        if self.kind == 'pyinstrument':
+            self.profiler = Pyinstrument()
+        else:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        if self.kind == 'pyinstrument':
+            self.profiler.start()
+        else:
+            self.profiler.enable()
+        self.running = True
+
+    def stop(self):
+        """Stops profiling and writes `fname`. Returns `fname`, or None if not running."""
+        if not self.running:
+            return None
+        self.running = False
+        if self.kind == 'pyinstrument':
+            self.profiler.stop()
+            with open(self.fname, 'w') as f:
+                f.write(self.profiler.output_html())
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.fname)
+        return self.fname
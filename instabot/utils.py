@@ -1,8 +1,59 @@
 
+import os
 import random
 from collections import OrderedDict
 
-from huepy import bold, green, orange
+from .profiling import timed
+
+# Headless runs: no progress bars, colors, console messages of the files or
+# `echo` messages. A switch of the whole process, i.e. of every bot in it.
+QUIET = False
+
+
+def set_quiet(quiet=True):
+    """Switches quiet mode of the whole process on or off."""
+    global QUIET
+    QUIET = quiet
+
+
+def echo(text):
+    """Prints a progress message, unless quiet. Errors are printed anyway."""
+    if not QUIET:
+        print(text)
+
+
+def colored(text, *styles):
+    """`text` in the huepy `styles`, e.g. colored(msg, 'green', 'bold'). huepy is imported on the first call."""
+    if QUIET:
+        return text
+    import huepy
+    for style in styles:
+        text = getattr(huepy, style)(text)
+    return text
+
+
+def tqdm(*args, **kwargs):
+    """`tqdm.tqdm`, imported on the first progress bar, disabled when quiet"""
+    from tqdm import tqdm
+    if QUIET:
+        kwargs['disable'] = True
+    return tqdm(*args, **kwargs)
+
+
+def package_version(name='instabot'):
+    """Version of the installed package `name` from its metadata, None if not installed"""
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:  # Python < 3.8
+        try:
+            import pkg_resources
+            return pkg_resources.get_distribution(name).version
+        except Exception:
+            return None
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
 
 
 class file(object):
@@ -12,6 +63,7 @@ class file(object):
         open(self.fname, 'a').close()
 
     @property
+    @timed('file.list', 'disk')
     def list(self):
         with open(self.fname, 'r') as f:
             lines = [x.strip('\n') for x in f.readlines()]
@@ -28,26 +80,30 @@ class file(object):
     def __len__(self):
         return len(self.list)
 
+    @timed('file.append', 'disk')
     def append(self, item, allow_duplicates=False):
-        if self.verbose:
+        if self.verbose and not QUIET:
             msg = "Adding '{}' to `{}`.".format(item, self.fname)
-            print(bold(green(msg)))
+            print(colored(msg, 'green', 'bold'))
 
         if not allow_duplicates and str(item) in self.list:
-            msg = "'{}' already in `{}`.".format(item, self.fname)
-            print(bold(orange(msg)))
+            if not QUIET:
+                msg = "'{}' already in `{}`.".format(item, self.fname)
+                print(colored(msg, 'orange', 'bold'))
             return
 
         with open(self.fname, 'a') as f:
             f.write('{item}\n'.format(item=item))
 
+    @timed('file.remove', 'disk')
     def remove(self, x):
         x = str(x)
         items = self.list
         if x in items:
             items.remove(x)
-            msg = "Removing '{}' from `{}`.".format(x, self.fname)
-            print(bold(green(msg)))
+            if not QUIET:
+                msg = "Removing '{}' from `{}`.".format(x, self.fname)
+                print(colored(msg, 'green', 'bold'))
             self.save_list(items)
 
     def random(self):
@@ -56,7 +112,60 @@ class file(object):
     def remove_duplicates(self):
         return list(OrderedDict.fromkeys(self.list))
 
+    @timed('file.save_list', 'disk')
     def save_list(self, items):
         with open(self.fname, 'w') as f:
             for item in items:
                 f.write('{item}\n'.format(item=item))
+
+
+def replace_file(src, dst):
+    # `os.replace` is Python 3 only and `os.rename` can't overwrite on Windows
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+@timed('atomic_write', 'disk')
+def atomic_write(fname, data, mode='w'):
+    """Writes `data` to a temp file next to `fname` and renames it over."""
+    tmp_fname = '{}.tmp'.format(fname)
+    with open(tmp_fname, mode) as f:
+        f.write(data)
+    replace_file(tmp_fname, fname)
+
+
+# Media shortcodes (instagram.com/p/<shortcode>/) are media pks in base 64
+SHORTCODE_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+SHORTCODE_TABLE = {char: index for index, char in enumerate(SHORTCODE_ALPHABET)}
+
+
+def shortcode_to_id(shortcode):
+    """Media pk (Integer) of a shortcode, KeyError on a wrong character."""
+    table = SHORTCODE_TABLE
+    result = 0
+    for char in shortcode:
+        result = result * 64 + table[char]
+    return result
+
+
+def id_to_shortcode(media_id):
+    """Shortcode of a media pk, or of a '<pk>_<user_id>' media id."""
+    media_id = int(str(media_id).split('_')[0])
+    alphabet = SHORTCODE_ALPHABET
+    chars = []
+    while media_id:
+        media_id, index = divmod(media_id, 64)
+        chars.append(alphabet[index])
+    return ''.join(reversed(chars))
+
+
+def shortcodes_to_ids(shortcodes):
+    return [shortcode_to_id(shortcode) for shortcode in shortcodes]
+
+
+def ids_to_shortcodes(media_ids):
+    return [id_to_shortcode(media_id) for media_id in media_ids]
@@ -1,12 +1,18 @@
 import json
+import os
+import tempfile
 try:
     from unittest.mock import Mock, patch
 except ImportError:
     from mock import Mock, patch
 
+import pytest
 import requests
+import responses
 
 from instabot import Bot
+from instabot.api.api_metrics import JsonLinesExporter, PrometheusTextfileExporter, normalize_endpoint
+from instabot.api.config import API_URL
 
 
 class TestBot:
@@ -16,7 +22,7 @@ class TestBot:
         self.PASSWORD = 'test_password'
         self.FULLNAME = 'test_full_name'
         self.TOKEN = 'abcdef123456'
-        self.bot = Bot()
+        self.bot = Bot(base_path=tempfile.mkdtemp())
         self.prepare_api(self.bot)
 
     def prepare_api(self, bot):
@@ -100,3 +106,135 @@ class TestBotAPI(TestBot):
         self.bot.reset_counters()
         for key in keys:
             assert self.bot.total[key] == 0
+
+    @pytest.mark.parametrize('url,expected', [
+        (API_URL + 'media/1234_5678/like/', 'media/{id}/like/'),
+        (API_URL + 'feed/tag/cats/?max_id=abc', 'feed/tag/{tag}/'),
+        (API_URL + 'users/someone/usernameinfo/', 'users/{username}/usernameinfo/'),
+        (API_URL + 'friendships/42/followers/?rank_token=x', 'friendships/{id}/followers/'),
+        ('https://scontent.cdninstagram.com/v/t51/123_n.jpg?oh=1', 'scontent.cdninstagram.com'),
+    ])
+    def test_normalize_endpoint(self, url, expected):
+        assert normalize_endpoint(url) == expected
+
+    @responses.activate
+    def test_request_metrics(self):
+        folder = tempfile.mkdtemp()
+        metrics = self.bot.api.metrics
+        metrics.exporters.append(JsonLinesExporter(os.path.join(folder, 'requests.jsonl')))
+        metrics.exporters.append(PrometheusTextfileExporter(os.path.join(folder, 'instabot.prom')))
+        responses.add(responses.GET, API_URL + 'users/1/info/', json={'status': 'ok'}, status=200)
+        responses.add(responses.GET, API_URL + 'users/2/info/', json={'status': 'fail'}, status=404)
+        responses.add(responses.POST, API_URL + 'media/3_4/like/', json={'status': 'ok'}, status=200)
+
+        self.bot.api.send_request('users/1/info/')
+        self.bot.api.send_request('users/2/info/')
+        self.bot.api.send_request('media/3_4/like/', post='signed_body=x', with_signature=False)
+        metrics.close()
+
+        rows = {(row['method'], row['endpoint']): row for row in metrics.summary()}
+        assert rows[('GET', 'users/{id}/info/')]['count'] == 2
+        assert rows[('GET', 'users/{id}/info/')]['statuses'] == {200: 1, 404: 1}
+        assert rows[('POST', 'media/{id}/like/')]['bytes_out'] == len('signed_body=x')
+        assert rows[('POST', 'media/{id}/like/')]['bytes_in'] == len('{"status": "ok"}')
+
+        with open(os.path.join(folder, 'requests.jsonl')) as f:
+            samples = [json.loads(line) for line in f]
+        assert [sample['endpoint'] for sample in samples] == ['users/{id}/info/'] * 2 + ['media/{id}/like/']
+        with open(os.path.join(folder, 'instabot.prom')) as f:
+            text = f.read()
+        assert 'instabot_requests_total{endpoint="users/{id}/info/",method="GET",status="404"} 1' in text
+        assert 'instabot_request_total_seconds_count{endpoint="media/{id}/like/",method="POST"} 1' in text
+
+    def test_record_and_replay(self):
+        cassette = os.path.join(tempfile.mkdtemp(), 'run.jsonl.gz')
+        with responses.RequestsMock() as mock:
+            mock.add(responses.GET, API_URL + 'users/1/info/', json={'status': 'ok', 'user': {'pk': 1}},
+                     headers={'Set-Cookie': 'csrftoken=recorded; Path=/'})
+            mock.add(responses.GET, API_URL + 'users/1/info/', json={'status': 'ok', 'user': {'pk': 2}})
+            mock.add(responses.GET, API_URL + 'feed/tag/cats/?rank_token=a', json={'status': 'ok', 'items': []})
+            self.bot.api.start_recording(cassette)
+            assert self.bot.api.send_request('users/1/info/')
+            assert self.bot.api.send_request('users/1/info/')
+            assert self.bot.api.send_request('feed/tag/cats/?rank_token=a')
+            self.bot.api.stop_transport()
+
+        self.prepare_api(self.bot)
+        self.bot.api.start_replay(cassette)
+        assert self.bot.api.send_request('users/1/info/')
+        assert self.bot.api.last_json['user']['pk'] == 1
+        assert self.bot.api.session.cookies.get('csrftoken') == 'recorded'
+        assert self.bot.api.send_request('users/1/info/')
+        assert self.bot.api.last_json['user']['pk'] == 2
+        # Volatile params don't matter, requests out of the cassette fail
+        assert self.bot.api.send_request('feed/tag/cats/?rank_token=b')
+        assert not self.bot.api.send_request('users/3/info/')
+
+    def test_api_shares_log_handlers(self):
+        import gc
+        import logging
+
+        from instabot import API
+        from instabot.api.api_logging import LOGGER_NAME, flush, open_log_files
+
+        folder = tempfile.mkdtemp()
+        log_file = os.path.join(folder, 'instabot.log')
+        console = list(logging.getLogger(LOGGER_NAME).handlers)
+        apis = [API(base_path=folder) for _ in range(20)]
+        # No files until something is logged, one handler for all the instances
+        assert os.listdir(folder) == []
+        assert open_log_files()[log_file] == 20
+        assert len(set(api.logger for api in apis)) == 1
+        assert logging.getLogger(LOGGER_NAME).handlers == console
+
+        apis[0].logger.info('hello')
+        flush()
+        assert os.listdir(folder) == ['instabot.log']
+        apis[0].close()
+        apis[0].close()
+        assert open_log_files()[log_file] == 19
+        del apis
+        gc.collect()
+        assert log_file not in open_log_files()
+
+        api = API(base_path=folder, log_filename=None)
+        assert api.logger.name == LOGGER_NAME
+        assert log_file not in open_log_files()
+
+    def test_log_levels_and_queue(self):
+        import logging
+
+        from instabot import API
+        from instabot.api.api_logging import LOGGER_NAME, flush, set_level
+
+        folder = tempfile.mkdtemp()
+        api = API(base_path=folder)
+        # The caller only enqueues, the listener thread writes
+        handlers = logging.getLogger(LOGGER_NAME).handlers
+        assert [type(handler).__name__ for handler in handlers] == ['QueueHandler']
+        try:
+            self.bot.set_log_level('WARNING', console=False)
+            api.logger.info('hidden')
+            api.logger.warning('shown')
+            flush()
+            with open(os.path.join(folder, 'instabot.log')) as f:
+                lines = f.read()
+            assert 'shown' in lines and 'hidden' not in lines
+            set_level(logging.WARNING)
+            assert not api.logger.isEnabledFor(logging.INFO)
+        finally:
+            set_level(logging.DEBUG, files=False)
+            set_level(logging.INFO, console=False)
+        assert api.logger.isEnabledFor(logging.DEBUG)
+        api.close()
+
+    def test_quiet(self):
+        from instabot import utils
+
+        utils.set_quiet()
+        try:
+            assert utils.colored('text', 'green') == 'text'
+            assert utils.tqdm(range(3)).disable
+        finally:
+            utils.set_quiet(False)
+        assert utils.colored('text', 'green') != 'text'
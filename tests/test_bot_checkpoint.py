@@ -0,0 +1,104 @@
+import os
+import pickle
+import tempfile
+import time
+
+import responses
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from instabot import Bot
+from instabot.api.config import API_URL
+from instabot.bot.bot_checkpoint import Checkpoint, Checkpoints, load_checkpoint, save_checkpoint
+
+from .test_bot import TestBot
+
+
+def make_bot(folder):
+    bot = Bot(base_path=folder)
+    bot.api.username = 'test_username'
+    return bot
+
+
+class TestBotCheckpoint(TestBot):
+
+    def test_restart_recovers_state(self):
+        folder = tempfile.mkdtemp()
+        bot = make_bot(folder)
+        bot._following = [str(user_id) for user_id in range(1000)]
+        assert save_checkpoint(bot)
+        assert not save_checkpoint(bot)
+
+        bot.total['likes'] = 7
+        bot.blocked_actions['follows'] = True
+        bot.last['like'] = 1571234567.5
+        bot._following.remove('10')
+        bot._following.append('1000')
+        bot._followers = ['1', '2']
+        assert save_checkpoint(bot)
+        with open(os.path.join(folder, 'test_username.checkpoint.deltas')) as f:
+            assert len(f.readlines()) == 1
+
+        restarted = make_bot(folder)
+        assert load_checkpoint(restarted)
+        assert restarted.total == bot.total
+        assert restarted.blocked_actions == bot.blocked_actions
+        assert restarted.last == bot.last
+        assert restarted.start_time == bot.start_time
+        # No download of the lists
+        assert restarted.following == bot._following
+        assert restarted.followers == ['1', '2']
+
+    def test_cut_delta_is_ignored(self):
+        folder = tempfile.mkdtemp()
+        bot = make_bot(folder)
+        save_checkpoint(bot)
+        bot.total['likes'] = 1
+        save_checkpoint(bot)
+        with open(os.path.join(folder, 'test_username.checkpoint.deltas'), 'a') as f:
+            f.write('{"seq": 3, "delta": {"total": {"li')
+
+        restarted = make_bot(folder)
+        assert load_checkpoint(restarted)
+        assert restarted.total['likes'] == 1
+
+    def test_pickled_checkpoint(self):
+        folder = tempfile.mkdtemp()
+        bot = make_bot(folder)
+        bot.total['follows'] = 3
+        with open(os.path.join(folder, 'test_username.checkpoint'), 'wb') as f:
+            pickle.dump(Checkpoint(bot), f, -1)
+
+        restarted = make_bot(folder)
+        assert load_checkpoint(restarted)
+        assert restarted.total['follows'] == 3
+
+    def test_delta_is_cheap(self):
+        bot = make_bot(tempfile.mkdtemp())
+        bot._following = [str(user_id) for user_id in range(1000)]
+        save_checkpoint(bot)
+        timings = []
+        for like in range(50):
+            bot.total['likes'] = like + 1
+            started = time.time()
+            save_checkpoint(bot)
+            timings.append(time.time() - started)
+        assert min(timings) < 0.001
+
+    @responses.activate
+    @patch('time.sleep', return_value=None)
+    def test_saved_after_action(self, patched_time_sleep):
+        for media_id in (1, 2):
+            responses.add(responses.POST, "{api_url}media/{media_id}/unlike/".format(
+                api_url=API_URL, media_id=media_id), json={'status': 'ok'}, status=200)
+        fname = os.path.join(self.bot.base_path, 'test_username.checkpoint')
+
+        assert self.bot.unlike(1)
+        assert Checkpoints(fname).read()['total']['unlikes'] == 1
+
+        # Not again within `checkpoint_interval`
+        assert self.bot.unlike(2)
+        assert Checkpoints(fname).read()['total']['unlikes'] == 1
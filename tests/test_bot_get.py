@@ -1,5 +1,7 @@
 
 import tempfile
+import threading
+from random import Random
 
 import pytest
 import responses
@@ -9,6 +11,8 @@ try:
 except ImportError:
     from mock import patch
 
+from instabot.api.api_dump import CSV_FIELDS, read_bin_dump
+from instabot.api.api_pages import PagePrefetcher
 from instabot.api.config import API_URL, SIG_KEY_VERSION
 from instabot import utils
 
@@ -394,6 +398,22 @@ class TestBotGet(TestBot):
 
         assert result == media_id
 
+    def test_get_link_from_media_id(self):
+        assert self.bot.get_link_from_media_id(1713527555896569026) == 'https://instagram.com/p/BfHrDvCDuzC/'
+        assert self.bot.get_link_from_media_id('1713527555896569026_1234') == 'https://instagram.com/p/BfHrDvCDuzC/'
+
+    def test_shortcodes_round_trip(self):
+        random = Random(39)
+        media_ids = [0, 1, 63, 64, 2 ** 63 - 1] + [random.getrandbits(random.randint(1, 64)) for _ in range(1000)]
+
+        shortcodes = utils.ids_to_shortcodes(media_ids)
+
+        assert utils.shortcodes_to_ids(shortcodes) == media_ids
+        assert all(set(shortcode) <= set(utils.SHORTCODE_ALPHABET) for shortcode in shortcodes)
+        assert utils.shortcodes_to_ids(['A', 'B', '_', 'BA']) == [0, 1, 63, 64]
+        with pytest.raises(KeyError):
+            utils.shortcode_to_id('Bf+')
+
     @responses.activate
     @pytest.mark.parametrize('comments', [
         ['comment1', 'comment2', 'comment3'],
@@ -788,6 +808,61 @@ class TestBotGet(TestBot):
 
         assert user_ids == [str(TEST_FOLLOWER_ITEM['pk']) for _ in range(results_3)]
 
+    @responses.activate
+    @patch('time.sleep', return_value=None)
+    def test_get_total_followers_filter_business(self, patched_time_sleep):
+        user_id = 1234567890
+        responses.add(
+            responses.GET, '{api_url}users/{user_id}/info/'.format(api_url=API_URL, user_id=user_id),
+            status=200, json={'status': 'ok', 'user': TEST_USERNAME_INFO_ITEM})
+        users = [dict(TEST_FOLLOWER_ITEM, pk=pk, is_private=pk == 2, is_verified=False) for pk in range(1, 8)]
+        responses.add(
+            responses.GET, "{api_url}friendships/{user_id}/followers/?rank_token={rank_token}".format(
+                api_url=API_URL, user_id=user_id, rank_token=self.bot.api.rank_token
+            ), json={'status': 'ok', 'big_list': True, 'next_max_id': 'next', 'users': users}, status=200)
+        for pk in range(1, 8):
+            responses.add(
+                responses.GET, '{api_url}users/{user_id}/info/'.format(api_url=API_URL, user_id=pk),
+                status=200, json={'status': 'ok', 'user': {'pk': pk, 'is_business': pk == 3}})
+
+        result = self.bot.api.get_total_followers_or_followings(
+            user_id, 3, filter_private=True, filter_business=True)
+        # Private 2 is skipped for free, business 3 costs one lookup, 6 and 7 are never looked up
+        assert [item['pk'] for item in result] == [1, 4, 5]
+        assert len(responses.calls) == 6
+
+        self.bot.api.get_total_followers_or_followings(
+            user_id, 3, filter_private=True, filter_business=True)
+        assert len(responses.calls) == 8
+
+    @responses.activate
+    @pytest.mark.parametrize('to_file_format', ['txt', 'csv', 'bin'])
+    def test_get_total_followers_to_file(self, to_file_format):
+        user_id = 1234567890
+        responses.add(
+            responses.GET, '{api_url}users/{user_id}/info/'.format(api_url=API_URL, user_id=user_id),
+            status=200, json={'status': 'ok', 'user': TEST_USERNAME_INFO_ITEM})
+        users = [dict(TEST_FOLLOWER_ITEM, pk=pk, username='user{}'.format(pk)) for pk in range(1, 4)]
+        responses.add(
+            responses.GET, "{api_url}friendships/{user_id}/followers/?rank_token={rank_token}".format(
+                api_url=API_URL, user_id=user_id, rank_token=self.bot.api.rank_token
+            ), json={'status': 'ok', 'big_list': False, 'users': users}, status=200)
+        fname = tempfile.mkstemp()[1]
+
+        result = self.bot.api.get_total_followers_or_followings(
+            user_id, to_file=fname, overwrite=True, usernames=True, to_file_format=to_file_format)
+
+        assert result == users
+        if to_file_format == 'bin':
+            assert [item['username'] for item in read_bin_dump(fname)] == ['user1', 'user2', 'user3']
+        else:
+            with open(fname) as f:
+                lines = f.read().splitlines()
+            if to_file_format == 'csv':
+                assert lines[0] == ','.join(CSV_FIELDS)
+                lines = [line.split(',')[1] for line in lines[1:]]
+            assert lines == ['user1', 'user2', 'user3']
+
     @responses.activate
     @pytest.mark.parametrize('username', [
         '1234567890', 1234567890
@@ -925,3 +1000,81 @@ class TestBotGet(TestBot):
                 api_url=API_URL), json=response_data, status=200)
         inbox = self.bot.get_messages()
         assert inbox == response_data
+
+    def test_page_prefetcher(self):
+        requested = []
+        received = []
+        prefetching = threading.Event()
+        page_taken = threading.Event()
+
+        def fetch(max_id):
+            requested.append(max_id)
+            if len(requested) > 1:
+                prefetching.set()
+                page_taken.wait(1)
+            received.append(max_id)
+            return True, {'items': [max_id], 'next_max_id': len(requested)}
+
+        seen = []
+        with PagePrefetcher(fetch, lambda page: page['next_max_id'], depth=1, on_page=seen.append) as pages:
+            for page in pages:
+                # The next page is requested while this one is processed
+                assert prefetching.wait(1)
+                page_taken.set()
+                break
+
+        assert page['items'] == ['']
+        assert seen == [page]
+        # The page taken and `depth` page ahead, nothing more; stop() waited for the request in flight
+        assert requested == ['', 1]
+        assert received == requested
+
+    def test_page_prefetcher_depth(self):
+        requested = []
+        ahead = threading.Event()
+
+        def fetch(max_id):
+            requested.append(max_id)
+            if len(requested) == 5:
+                ahead.set()
+            return True, {'next_max_id': len(requested)}
+
+        with PagePrefetcher(fetch, lambda page: page['next_max_id'], depth=2) as pages:
+            for number, page in enumerate(pages, 1):
+                if number == 3:
+                    break
+            assert ahead.wait(1)
+        # 3 pages asked for and 2 ahead
+        assert requested == ['', 1, 2, 3, 4]
+
+    def test_page_prefetcher_error(self):
+        pages = PagePrefetcher(lambda max_id: (False, {'status': 'fail'}), lambda page: None)
+        seen = []
+        pages.on_page = seen.append
+
+        assert list(pages) == []
+        assert seen == [{'status': 'fail'}]
+
+    def test_page_prefetcher_exceptions(self):
+        def fetch(max_id):
+            if max_id == '2':
+                raise ValueError('fetch')
+            return True, {'max_id': max_id}
+
+        def next_cursor(page):
+            if page['max_id'] == '1':
+                raise KeyError('next_max_id')
+            return str(int(page['max_id'] or 0) + 1)
+
+        received = []
+        with pytest.raises(ValueError):
+            for page in PagePrefetcher(fetch, lambda page: str(int(page['max_id'] or 0) + 1)):
+                received.append(page['max_id'])
+        assert received == ['', '1']
+
+        received = []
+        with pytest.raises(KeyError):
+            for page in PagePrefetcher(fetch, next_cursor):
+                received.append(page['max_id'])
+        # The page the cursor failed on is still received
+        assert received == ['', '1']
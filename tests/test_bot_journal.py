@@ -0,0 +1,103 @@
+import os
+import tempfile
+
+import responses
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from instabot import Bot
+from instabot.api.config import API_URL
+from instabot.bot.bot_journal import Journal
+
+from .test_bot import TestBot
+
+DAY = 24 * 60 * 60
+NOW = 1571234567.0
+
+
+def make_journal(**kwargs):
+    return Journal(os.path.join(tempfile.mkdtemp(), 'actions.jsonl'), **kwargs)
+
+
+class TestBotJournal(TestBot):
+
+    def test_query(self):
+        journal = make_journal()
+        for hour in range(48):
+            journal.record('like', hour, True, 0.5, ts=NOW - DAY * 2 + hour * 3600)
+        journal.record('follow', 1, 'feedback_required', ts=NOW - 10)
+        journal.record('like', 2, False, ts=NOW - 5)
+
+        assert journal.count('like', since=NOW - DAY) == 24
+        assert journal.count('like', since=NOW - DAY, result='failed') == 1
+        assert journal.count('like', since=NOW - 2 * DAY, until=NOW - DAY) == 24
+        assert journal.counts(since=NOW - 20) == {}
+        assert journal.counts(since=NOW - 20, result=None) == {'follow': 1, 'like': 1}
+        entries = list(journal.query(target=1))
+        assert [entry['action'] for entry in entries] == ['like', 'follow']
+        assert entries[0] == {'ts': NOW - DAY * 2 + 3600, 'action': 'like', 'target': '1',
+                              'result': 'ok', 'latency': 0.5}
+        assert entries[1]['result'] == 'blocked'
+        journal.close()
+
+        reopened = Journal(journal.root + '.jsonl')
+        assert reopened.count(result=None) == 50
+
+    def test_rotation_and_compaction(self):
+        journal = make_journal(max_bytes=1000)
+        for minute in range(100):
+            journal.record('like', minute, True, ts=NOW - DAY * 3 + minute * 60)
+        journal.record('follow', 1, True, ts=NOW)
+        assert len(journal.segments) > 5
+        assert journal.count('like', since=NOW - DAY * 3 + 50 * 60) == 50
+
+        compacted = journal.compact(before=NOW - DAY)
+        # The segment appended to is kept whole
+        assert len(journal.segments) == 1
+        assert compacted + journal.count('like') == 100
+        assert journal.count('follow') == 1
+        days = journal.daily_counts()
+        assert sum(day.get('like', 0) for day in days.values()) == 100
+        assert sum(day.get('follow', 0) for day in days.values()) == 1
+
+    def test_cut_line(self):
+        journal = make_journal(sync_every=1)
+        journal.record('like', 1, True, ts=NOW)
+        journal.close()
+        with open(journal.segments[-1][1], 'ab') as f:
+            f.write(b'{"ts":')
+        journal = Journal(journal.root + '.jsonl')
+        journal.record('like', 2, True, ts=NOW + 1)
+        assert [entry['target'] for entry in journal.query(since=NOW)] == ['1', '2']
+
+    def test_new_folder(self):
+        folder = os.path.join(tempfile.mkdtemp(), 'new')
+        journal = Journal(os.path.join(folder, 'actions.jsonl'))
+        journal.record('like', 1, True, ts=NOW)
+        assert os.listdir(folder) == ['actions.000001.jsonl']
+
+    def test_bot_journal_is_opt_in(self):
+        folder = tempfile.mkdtemp()
+        assert Bot(base_path=folder).journal is None
+        bot = Bot(base_path=folder, journal_file='actions.jsonl')
+        assert bot.journal.root == os.path.join(folder, 'actions')
+
+    @responses.activate
+    @patch('time.sleep', return_value=None)
+    def test_bot_records_actions(self, patched_time_sleep):
+        self.bot.journal = make_journal()
+        media_id = 111111
+        responses.add(
+            responses.POST, "{api_url}media/{media_id}/unlike/".format(
+                api_url=API_URL, media_id=media_id
+            ), json="{'status': 'ok'}", status=200
+        )
+        assert self.bot.unlike(media_id)
+        entries = list(self.bot.journal.query('unlike'))
+        assert len(entries) == 1
+        assert entries[0]['target'] == str(media_id)
+        assert entries[0]['result'] == 'ok'
+        assert entries[0]['latency'] >= 0
@@ -0,0 +1,241 @@
+import gzip
+import io
+import os
+import struct
+import tempfile
+
+import pytest
+import responses
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from instabot.api.api_download import MediaDownloader
+from instabot.api.api_media import MediaCache, file_checksum, prepare_media_batch
+from instabot.api.api_photo import PROBE_SIZE, get_image_size
+from instabot.api.config import API_URL
+
+from .test_bot import TestBot
+
+CDN_URL = 'https://scontent.cdninstagram.com/{}.jpg'
+
+PNG_HEADER = b''.join([
+    b'\x89PNG\r\n\x1a\n', struct.pack('>I', 13), b'IHDR',
+    struct.pack('>ii', 1080, 1350), b'\x08\x02\x00\x00\x00'])
+GIF_HEADER = b''.join([b'GIF89a', struct.pack('<HH', 1080, 1350), b'\x00' * 14])
+JPEG_HEADER = b''.join([
+    b'\xff\xd8',
+    b'\xff\xe0', struct.pack('>H', 16), b'JFIF\x00', b'\x00' * 9,
+    b'\xff\xe1', struct.pack('>H', 65000), b'\x00' * 64998,  # EXIF past the first read
+    b'\xff\xc4', struct.pack('>H', 4), b'\x00\x00',  # DHT is not a SOFn
+    b'\xff\xff\xc2', struct.pack('>HBHH', 11, 8, 1350, 1080), b'\x00' * 6])
+
+WEBP_HEADER = b''.join([
+    b'RIFF', struct.pack('<I', 100), b'WEBPVP8X', struct.pack('<I', 10), b'\x00' * 4,
+    struct.pack('<I', 1079)[:3], struct.pack('<I', 1349)[:3]])
+
+
+def gzip_bytes(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+class TestBotPhoto:
+
+    @pytest.mark.parametrize('header', [PNG_HEADER, GIF_HEADER, JPEG_HEADER, WEBP_HEADER])
+    def test_get_image_size(self, header):
+        fname = tempfile.mkstemp()[1]
+        with open(fname, 'wb') as f:
+            f.write(header)
+
+        assert get_image_size(fname) == (1080, 1350)
+
+        os.remove(fname)
+
+    def test_get_image_size_fill_bytes_past_probe(self):
+        # 0xff fill bytes before the SOF marker, across the end of the first read
+        segment = PROBE_SIZE - 24
+        header = b''.join([
+            b'\xff\xd8', b'\xff\xe1', struct.pack('>H', segment), b'\x00' * (segment - 2),
+            b'\xff' * 40, b'\xc0', struct.pack('>HBHH', 11, 8, 1350, 1080), b'\x00' * 6])
+        fname = tempfile.mkstemp()[1]
+        with open(fname, 'wb') as f:
+            f.write(header)
+
+        assert get_image_size(fname) == (1080, 1350)
+
+        os.remove(fname)
+
+    def test_get_image_size_unsupported(self):
+        fname = tempfile.mkstemp()[1]
+        with open(fname, 'wb') as f:
+            f.write(b'BM' + b'\x00' * 40)
+
+        with pytest.raises(RuntimeError):
+            get_image_size(fname)
+
+        os.remove(fname)
+
+    def test_prepare_media_batch(self):
+        folder = tempfile.mkdtemp()
+        paths = []
+        for name in ('first.png', 'second.png'):
+            paths.append(os.path.join(folder, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(PNG_HEADER)
+        cache = MediaCache(os.path.join(folder, 'media_cache'))
+
+        prepared = prepare_media_batch(paths, workers=1, cache=cache)
+
+        assert list(prepared) == paths
+        assert prepared[paths[0]] == prepared[paths[1]]
+        assert sorted(os.listdir(cache.folder)) == [
+            os.path.basename(prepared[paths[0]]), MediaCache.MANIFEST]
+        assert os.path.exists(paths[0])
+
+        os.remove(paths[0])
+        with open(paths[0], 'wb') as f:
+            f.write(PNG_HEADER)
+        cache = MediaCache(cache.folder)
+        assert prepare_media_batch(paths[:1], workers=1, cache=cache) == {paths[0]: prepared[paths[0]]}
+
+    def test_media_cache_evicts_least_recently_used(self):
+        cache = MediaCache(tempfile.mkdtemp(), max_size=20)
+        first = cache.put_data(file_checksum(__file__), 'story', b'0' * 10)
+        second = cache.put_data('0' * 40, 'story', b'1' * 10)
+        cache.manifest['0' * 40 + '.story']['used'] -= 60
+        assert cache.get(file_checksum(__file__), 'story') == first
+
+        third = cache.put_data('1' * 40, 'story', b'2' * 10)
+
+        assert os.path.exists(first) and os.path.exists(third)
+        assert not os.path.exists(second)
+        assert cache.get('0' * 40, 'story') is None
+        assert cache.size == 20
+
+    def test_prepare_media_batch_wrong_kind(self):
+        with pytest.raises(ValueError):
+            prepare_media_batch([], kind='reel')
+
+    @responses.activate
+    def test_media_downloader(self):
+        folder = tempfile.mkdtemp()
+        responses.add(responses.GET, CDN_URL.format(1), body=b'first', status=200)
+        responses.add(responses.GET, CDN_URL.format(2), body=b'', status=404)
+        jobs = [(CDN_URL.format(1), os.path.join(folder, '1.jpg')),
+                (CDN_URL.format(2), os.path.join(folder, '2.jpg'))]
+
+        results = MediaDownloader(workers=2, per_host=1).download(jobs, progress=False)
+
+        assert results == {jobs[0][1]: jobs[0][1], jobs[1][1]: False}
+        assert os.listdir(folder) == ['1.jpg']
+        with open(jobs[0][1], 'rb') as f:
+            assert f.read() == b'first'
+
+    @responses.activate
+    def test_media_downloader_resume(self):
+        folder = tempfile.mkdtemp()
+        fname = os.path.join(folder, 'video.mp4')
+        index = os.path.join(folder, 'downloads.json')
+        with open(fname + '.part', 'wb') as f:
+            f.write(b'01234')
+        responses.add(
+            responses.GET, CDN_URL.format(1), body=b'56789', status=206,
+            headers={'Content-Range': 'bytes 5-9/10', 'ETag': '"781e5e245d69b566979b86e28d23f2c7"'})
+
+        assert MediaDownloader(index=index).download([(CDN_URL.format(1), fname)], progress=False)[fname]
+
+        assert responses.calls[0].request.headers['Range'] == 'bytes=5-'
+        assert sorted(os.listdir(folder)) == ['downloads.json', 'video.mp4']
+        with open(fname, 'rb') as f:
+            assert f.read() == b'0123456789'
+        assert MediaDownloader(index=index).fetch(CDN_URL.format(1), fname) == os.path.abspath(fname)
+        assert len(responses.calls) == 1
+
+        # A deleted file is downloaded again
+        os.remove(fname)
+        responses.replace(responses.GET, CDN_URL.format(1), body=b'0123456789', status=200)
+        assert MediaDownloader(index=index).fetch(CDN_URL.format(1), fname) == os.path.abspath(fname)
+        assert len(responses.calls) == 2
+        assert os.path.exists(fname)
+
+    @responses.activate
+    def test_media_downloader_gzip(self):
+        fname = os.path.join(tempfile.mkdtemp(), '1.jpg')
+        body = gzip_bytes(b'photo' * 100)
+        responses.add(responses.GET, CDN_URL.format(1), body=body, status=200,
+                      headers={'Content-Encoding': 'gzip', 'Content-Length': str(len(body))})
+        downloader = MediaDownloader()
+
+        assert downloader.fetch(CDN_URL.format(1), fname)
+
+        assert responses.calls[0].request.headers['Accept-Encoding'] == 'identity'
+        with open(fname, 'rb') as f:
+            assert f.read() == b'photo' * 100
+        assert downloader._paths == {}
+
+    @responses.activate
+    def test_media_downloader_truncated(self):
+        folder = tempfile.mkdtemp()
+        fname = os.path.join(folder, '1.jpg')
+        responses.add(responses.GET, CDN_URL.format(1), body=b'012', status=200,
+                      headers={'Content-Length': '10'})
+
+        assert not MediaDownloader().fetch(CDN_URL.format(1), fname)
+        assert os.listdir(folder) == ['1.jpg.part']
+
+
+class TestBotDownloadPhotos(TestBot):
+
+    @responses.activate
+    @patch('time.sleep', return_value=None)
+    def test_download_photos(self, patched_time_sleep):
+        folder = tempfile.mkdtemp()
+        self.bot.api.base_path = folder
+        photo = {'pk': 1, 'media_type': 1, 'user': {'username': 'test'},
+                 'image_versions2': {'candidates': [{'url': CDN_URL.format(1)}]}}
+        carousel = {'pk': 2, 'media_type': 8, 'user': {'username': 'test'}, 'carousel_media': [
+            {'media_type': 1, 'image_versions2': {'candidates': [{'url': CDN_URL.format(2)}]}},
+            {'media_type': 2, 'video_versions': [{'url': CDN_URL.format('video')}]},
+            {'media_type': 1, 'image_versions2': {'candidates': [{'url': CDN_URL.format(3)}]}}]}
+        for index in (1, 2):
+            responses.add(responses.GET, CDN_URL.format(index), body=b'photo', status=200)
+        responses.add(responses.GET, CDN_URL.format(3), body=b'', status=500)
+
+        with patch('instabot.Bot.get_media_info', side_effect=[[photo], [carousel]]):
+            broken_items = self.bot.download_photos(['1_1', '2_1'], folder)
+
+        assert broken_items == ['2_1']
+        assert sorted(os.listdir(folder)) == ['downloads.json', 'test_1_1.jpg', 'test_2_1_0.jpg']
+
+        # The same media under a new username: no API call, no download
+        self.bot.api._downloader = None
+        with patch('instabot.Bot.get_media_info') as patched_get_media_info:
+            assert self.bot.download_photos(['1_1'], os.path.join(folder, 'renamed')) == []
+        assert not patched_get_media_info.called
+        assert self.bot.api.download_photo('1', None, dict(photo, user={'username': 'renamed'})) == \
+            os.path.join(folder, 'test_1_1.jpg')
+        assert len(responses.calls) == 3
+
+    @responses.activate
+    @patch('instabot.API.configure_photo', return_value=True)
+    @patch('instabot.API.expose', return_value=True)
+    @patch('time.sleep', return_value=None)
+    def test_upload_prepared_photo(self, patched_time_sleep, patched_expose, patched_configure):
+        folder = tempfile.mkdtemp()
+        photo, prepared = os.path.join(folder, 'photo.png'), os.path.join(folder, 'prepared.jpg')
+        for fname in (photo, prepared):
+            with open(fname, 'wb') as f:
+                f.write(PNG_HEADER)
+        self.bot.api.last_json = {'media': {'pk': 1}}
+        responses.add(responses.POST, API_URL + 'upload/photo/', json={'status': 'ok'}, status=200)
+
+        assert self.bot.upload_photo(photo, options={'prepared': prepared})
+
+        assert patched_configure.call_args[0][1] == prepared
+        # The original is marked as posted, the cached file is kept
+        assert sorted(os.listdir(folder)) == ['photo.png.REMOVE_ME', 'prepared.jpg']
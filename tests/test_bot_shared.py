@@ -0,0 +1,75 @@
+import multiprocessing
+import os
+import tempfile
+
+import responses
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from instabot import Bot
+from instabot.api.config import API_URL
+from instabot.bot.bot_shared import SharedState
+
+from .test_bot import TestBot
+
+
+def acquire_many(fname, attempts, limit):
+    state = SharedState(fname)
+    return sum(state.acquire('likes', limit) for _ in range(attempts))
+
+
+class TestBotShared(TestBot):
+
+    def make_bot(self, fname, likes):
+        bot = Bot(base_path=os.path.dirname(fname), shared_state=fname)
+        bot.max_per_day['likes'] = likes
+        self.prepare_api(bot)
+        return bot
+
+    def test_acquire_is_atomic_across_processes(self):
+        fname = os.path.join(tempfile.mkdtemp(), 'state.db')
+        pool = multiprocessing.Pool(4)
+        try:
+            acquired = pool.starmap(acquire_many, [(fname, 50, 120)] * 4)
+        finally:
+            pool.close()
+            pool.join()
+        assert sum(acquired) == 120
+        assert SharedState(fname).count('likes') == 120
+
+    def test_delay_clock(self):
+        fname = os.path.join(tempfile.mkdtemp(), 'state.db')
+        states = [SharedState(fname) for _ in range(3)]
+        with patch('time.time', return_value=1000.0):
+            slots = [1000.0 + states[attempt % 3].reserve_slot('like', 10) for attempt in range(20)]
+        assert slots[0] == 1000.0
+        # In order and at least the smallest random delay apart, whichever process asks
+        for previous, slot in zip(slots, slots[1:]):
+            assert slot - previous >= 10 * 0.25 - 1e-6
+
+    @responses.activate
+    @patch('time.sleep', return_value=None)
+    def test_bots_share_budget(self, patched_time_sleep):
+        fname = os.path.join(tempfile.mkdtemp(), 'state.db')
+        first, second = self.make_bot(fname, 2), self.make_bot(fname, 2)
+        for media_id, status in ((1, 200), (2, 400), (3, 200)):
+            responses.add(
+                responses.POST, '{api_url}media/{media_id}/like/'.format(api_url=API_URL, media_id=media_id),
+                json={'status': 'ok'}, status=status)
+
+        assert first.like(1, check_media=False)
+        # A failed like doesn't use the budget
+        assert not second.like(2, check_media=False)
+        assert second.like(3, check_media=False)
+        assert first.reached_limit('likes')
+        assert second.reached_limit('likes')
+        assert first.total['likes'] == second.total['likes'] == 1
+        assert first.shared.count('likes') == 2
+
+        second.blocked_actions['comments'] = True
+        second.reached_limit('comments')
+        first.reached_limit('comments')
+        assert first.blocked_actions['comments']
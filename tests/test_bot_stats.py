@@ -0,0 +1,76 @@
+import os
+import tempfile
+
+import responses
+
+from instabot.api.config import API_URL
+from instabot.bot.bot_stats import StatsStore
+
+from .test_bot import TestBot
+from .test_variables import TEST_USERNAME_INFO_ITEM
+
+DAY = 24 * 60 * 60
+NOW = 1571234567.0
+
+
+def make_row(ts, user_id, followers):
+    return {'ts': ts, 'user_id': user_id, 'followers': followers, 'following': 10, 'medias': 5}
+
+
+class TestBotStats(TestBot):
+
+    def test_store(self):
+        store = StatsStore(tempfile.mkdtemp())
+        for day in range(3):
+            store.append([make_row(NOW + day * DAY, 1, 100 * 2 ** day),
+                          make_row(NOW + day * DAY, 2, 50)], {1: 'first'})
+        assert len(store.days()) == 3
+
+        columns = store.load(since=NOW + DAY)
+        assert list(columns['user_id']) == [1, 2, 1, 2]
+        assert list(columns['followers']) == [200, 50, 400, 50]
+        assert store.deltas() == {1: 300, 2: 0}
+        assert isinstance(columns['ts'][0], float) and isinstance(columns['followers'][0], int)
+        assert store.deltas(user_ids=[1], until=NOW + DAY) == {1: 0}
+        rates = store.growth_rates()
+        assert abs(rates[1] - 1.0) < 1e-9 and rates[2] == 0
+
+        # A crash in the middle of an append: the next append starts at the complete rows
+        with open(os.path.join(store.path, store.days()[-1], 'ts.bin'), 'ab') as f:
+            f.write(b'\x00' * 12)
+        assert len(StatsStore(store.path).load()['ts']) == 6
+        store.append([make_row(NOW + 2 * DAY + 60, 2, 60)])
+        columns = store.load(since=NOW + 2 * DAY)
+        assert list(columns['ts']) == [NOW + 2 * DAY, NOW + 2 * DAY, NOW + 2 * DAY + 60]
+        assert list(columns['user_id']) == [1, 2, 2]
+        assert list(columns['followers']) == [400, 50, 60]
+
+        folder = tempfile.mkdtemp()
+        fnames = store.export_tsv(folder)
+        assert sorted(os.path.basename(fname) for fname in fnames) == ['2.tsv', 'first.tsv']
+        with open(os.path.join(folder, 'first.tsv')) as f:
+            lines = f.read().splitlines()
+        assert lines[0] == 'date\tfollowers\tfollowing\tmedias'
+        assert lines[1].split('\t')[1:] == ['100', '10', '5']
+        assert len(lines) == 4
+        with open(os.path.join(folder, '2.tsv')) as f:
+            assert f.read().splitlines()[-1].split('\t')[1] == '60'
+
+    @responses.activate
+    def test_collect_user_stats(self):
+        for user_id in (1, 2, 3):
+            item = dict(TEST_USERNAME_INFO_ITEM, pk=user_id, username='user{}'.format(user_id),
+                        follower_count=user_id * 10, following_count=1, media_count=2)
+            responses.add(
+                responses.GET, '{api_url}users/{user_id}/info/'.format(api_url=API_URL, user_id=user_id),
+                json={'status': 'ok', 'user': item}, status=200)
+        responses.add(
+            responses.GET, '{api_url}users/4/info/'.format(api_url=API_URL),
+            json={'status': 'fail'}, status=404)
+        path = tempfile.mkdtemp()
+
+        assert self.bot.collect_user_stats([1, 2, 3, 4], path=path, workers=4) == 3
+        store = StatsStore(path)
+        columns = store.load()
+        assert sorted(zip(columns['user_id'], columns['followers'])) == [(1, 10), (2, 20), (3, 30)]
+        assert store.usernames == {1: 'user1', 2: 'user2', 3: 'user3'}
@@ -3,9 +3,18 @@ from __future__ import unicode_literals
 
 import os
 import sys
+import tempfile
 
 import pytest
 
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from instabot import Bot, utils
+from instabot.profiling import Profiler
+
 from .test_bot import TestBot
 
 
@@ -56,3 +65,67 @@ class TestBotSupport(TestBot):
             assert output == result
         finally:
             sys.stdout = saved_stdout
+
+    def test_profiler_workflow_breakdown(self):
+        clock = [0.0]
+
+        def advance(seconds):
+            clock[0] += seconds
+
+        profiler = Profiler()
+        with patch('instabot.profiling.time.time', lambda: clock[0]):
+            with profiler.run('follow_users'):
+                advance(1)  # cpu
+                with profiler.span('send_request', 'network'):
+                    advance(2)
+                    with profiler.span('sleep_429', 'sleep'):
+                        advance(5)
+                with profiler.span('file.append', 'disk'):
+                    advance(0.5)
+                    with profiler.span('file.list', 'disk'):
+                        advance(0.5)
+                with profiler.run('follow'):  # nested workflows count for the outer one
+                    with profiler.span('delay', 'sleep'):
+                        advance(3)
+
+        report, = profiler.report()
+        assert report['name'] == 'follow_users'
+        assert report['wall'] == 12
+        assert (report['sleep'], report['network'], report['disk'], report['cpu']) == (8, 2, 1, 1)
+        assert profiler.timers['send_request'] == [1, 7]
+        assert profiler.top_timers(1) == [('send_request', 1, 7)]
+
+    def test_run_profile_survives_print_counters(self):
+        folder = tempfile.mkdtemp()
+        bot = Bot(base_path=folder, profile=True)
+        bot.print_counters()
+        assert bot.run_profiler.running
+
+        bot.stop_profile()
+        assert not bot.run_profiler.running
+        assert os.path.exists(os.path.join(folder, 'instabot.prof'))
+
+    def test_quiet_switch(self, capsys):
+        folder = tempfile.mkdtemp()
+        try:
+            Bot(base_path=folder, quiet=True)
+            utils.echo('resizing')
+            Bot(base_path=folder)
+            assert utils.QUIET
+            utils.echo('resizing')
+            Bot(base_path=folder, quiet=False)
+            assert not utils.QUIET
+            utils.echo('cropping')
+        finally:
+            utils.set_quiet(False)
+        assert capsys.readouterr().out == 'cropping\n'
+
+    def test_run_profile_without_pyinstrument(self):
+        folder = tempfile.mkdtemp()
+        with patch.dict('sys.modules', {'pyinstrument': None}):
+            bot = Bot(base_path=folder, profile='pyinstrument')
+        assert bot.run_profiler.kind == 'cprofile'
+
+        bot.stop_profile()
+        assert os.path.exists(os.path.join(folder, 'instabot.prof'))
+        assert not os.path.exists(os.path.join(folder, 'instabot.html'))
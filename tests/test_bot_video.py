@@ -0,0 +1,96 @@
+import os
+import tempfile
+
+import responses
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from instabot.api.api_video import get_video_segments, load_upload_journal, resize_video
+from instabot.api.config import API_URL
+
+from .test_bot import TestBot
+
+UPLOAD_URL = 'https://upload.instagram.com/test_upload_url'
+
+
+class TestBotVideo(TestBot):
+
+    def prepare_video(self):
+        self.bot.api.base_path = tempfile.mkdtemp()
+        video = os.path.join(self.bot.api.base_path, 'video.mp4')
+        with open(video, 'wb') as f:
+            f.write(b'0123456789' * 10)
+        return video
+
+    def test_get_video_segments(self):
+        segments = get_video_segments(103)
+        assert segments == [(0, 25), (25, 50), (50, 75), (75, 103)]
+
+    @responses.activate
+    @patch('instabot.API.configure_video', return_value=True)
+    @patch('instabot.API.expose', return_value=True)
+    @patch('time.sleep', return_value=None)
+    def test_upload_video_resume(self, patched_time_sleep, patched_expose, patched_configure):
+        video = self.prepare_video()
+        self.bot.api.last_json = {'media': {'pk': 1}}
+
+        responses.add(
+            responses.POST, API_URL + 'upload/video/',
+            json={'video_upload_urls': [{'url': UPLOAD_URL, 'job': 'job'}] * 4,
+                  'status': 'ok'}, status=200)
+        responses.add(responses.POST, UPLOAD_URL, body='0-24/100', status=200)
+        for _ in range(3):
+            responses.add(responses.POST, UPLOAD_URL, body='', status=500)
+
+        options = {'rename': False, 'prepared': (video, 'thumb.jpg', 100, 100, 1)}
+        assert not self.bot.upload_video(video, options=options)
+        journal = load_upload_journal(self.bot.api)
+        assert len(journal) == 1
+        entry = list(journal.values())[0]
+        assert entry['acked'] == [[0, 25]]
+
+        responses.reset()
+        responses.add(responses.POST, UPLOAD_URL, body='ok', status=200)
+        assert self.bot.upload_video(video, options=options)
+
+        assert len(responses.calls) == 3
+        assert patched_configure.call_args[0][0] == entry['upload_id']
+        assert load_upload_journal(self.bot.api) == {}
+
+    @patch('instabot.api.api_video.which', return_value='/usr/bin/ffmpeg')
+    @patch('instabot.api.api_video.probe_video', return_value=(1920, 1080, 90, 45.))
+    @patch('subprocess.check_call', return_value=0)
+    def test_resize_video_ffmpeg(self, patched_check_call, patched_probe_video, patched_which):
+        result = resize_video('video.mp4', preset='ultrafast', threads=2)
+
+        assert result == ('video.mp4.CONVERTED.mp4', 'video.mp4.jpg', 864, 1080, 30)
+        command = patched_check_call.call_args[0][0]
+        assert patched_check_call.call_count == 1
+        assert '[0:v]crop=1080:1350:0:285,scale=864:1080,split=2[video][thumbnail]' in command
+        assert command[command.index('-t') + 1] == '30'
+        assert command[command.index('-preset') + 1] == 'ultrafast'
+        assert command[command.index('-threads') + 1] == '2'
+        assert command[-1] == 'video.mp4.jpg'
+
+    @responses.activate
+    def test_download_carousel_video(self):
+        folder = tempfile.mkdtemp()
+        self.bot.api.base_path = folder
+        self.bot.api._downloader = None
+        url = 'https://scontent.cdninstagram.com/{}'
+        carousel = {'pk': 2, 'media_type': 8, 'user': {'username': 'test'}, 'carousel_media': [
+            {'media_type': 1, 'image_versions2': {'candidates': [{'url': url.format('photo.jpg')}]}},
+            {'media_type': 2, 'video_versions': [{'url': url.format('video.mp4')}]}]}
+        responses.add(responses.GET, url.format('photo.jpg'), body=b'photo', status=200)
+        responses.add(responses.GET, url.format('video.mp4'), body=b'video', status=200)
+
+        assert self.bot.api.download_photo('2_1', None, carousel, folder)
+        video = self.bot.api.download_video('2_1', None, carousel, folder)
+
+        with open(video, 'rb') as f:
+            assert f.read() == b'video'
+        index = self.bot.api.downloader.index
+        assert sorted(index.files) == ['photo/2/0', 'video/2/1']
@@ -0,0 +1,52 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+# Seconds for `from instabot import Bot` in a new interpreter, ~0.2 s when it was added
+IMPORT_BUDGET = 1.0
+# Imported on first use only
+DEFERRED = ('tqdm', 'huepy', 'PIL', 'moviepy', 'pkg_resources', 'requests_toolbelt', 'multiprocessing.pool')
+
+SCRIPT = '''
+import json, sys, time
+started = time.time()
+{statement}
+elapsed = time.time() - started
+print(json.dumps({{'elapsed': elapsed, 'modules': sorted(sys.modules)}}))
+'''
+
+
+def run_import(statement):
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT.format(statement=statement)])
+    return json.loads(output.decode('utf8').strip().splitlines()[-1])
+
+
+class TestImport:
+
+    def test_import_instabot_is_lazy(self):
+        result = run_import('import instabot')
+        assert 'requests' not in result['modules']
+        assert 'instabot.bot' not in result['modules']
+
+    @pytest.mark.parametrize('name', DEFERRED)
+    def test_bot_defers_imports(self, name):
+        result = run_import('from instabot import Bot')
+        assert name not in result['modules']
+
+    def test_bot_import_budget(self):
+        elapsed = min(run_import('from instabot import Bot')['elapsed'] for _ in range(3))
+        assert elapsed < IMPORT_BUDGET
+
+    def test_lazy_attributes(self):
+        import instabot
+        from instabot.api import API
+        from instabot.bot import Bot
+
+        assert instabot.API is API
+        assert instabot.Bot is Bot
+        assert instabot.utils.file
+        assert 'Bot' in dir(instabot)
+        with pytest.raises(AttributeError):
+            instabot.missing